@@ -15,6 +15,11 @@ config = {}
 session = None
 logger = None
 
+# sessions and pools of the parent process, kept by after_fork() so that
+# they are never garbage collected (returning or closing their connections
+# would roll back or close the parent's)
+inherited = []
+
 
 def init_app(local_config=None):
     """This function must be called before you start working with the application
@@ -39,6 +44,21 @@ def init_app(local_config=None):
     session = scoped_session(session_factory)
     session.configure(bind=engine)
 
+
+def after_fork():
+    """Gives a forked process a session and database connections of its
+    own; the session and the connections of the parent process are left
+    alone"""
+    if session is None:
+        return
+    if session.registry.has():
+        inherited.append(session.registry())
+    session.registry.clear()
+    engine = session.bind
+    inherited.append(engine.pool)
+    engine.pool = engine.pool.recreate()
+
+
 def close_app():
     """Closes the app"""
     global logger, session
@@ -48,11 +68,13 @@ def close_app():
 
     
 @contextmanager
-def session_scope():
+def session_scope(factory=None):
     """Provides a transactional session - ie. the session for the 
     current thread/work of unit. The application has to be properly
     initialized before you use method. See :object: 
     `ADSDeploy.app.session`
+
+    :param factory: session factory to use instead of the app's
     
     Use as:
     
@@ -61,11 +83,12 @@ def session_scope():
             session.add(o)
     """
 
-    if session is None:
+    factory = factory or session
+    if factory is None:
         raise Exception('init_app() must be called before you can use the session')
     
     # create local session (optional step)
-    s = session()
+    s = factory()
     
     try:
         yield s
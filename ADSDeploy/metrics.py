@@ -0,0 +1,127 @@
+"""
+Metrics of the workers and the webapp, in the Prometheus format. The
+workers count what they consume, publish and forward (labelled by worker
+class and queue), time process_payload and the acknowledgements; the
+TaskMaster and the webapp expose the numbers over HTTP.
+
+Workers started as separate processes write their numbers into files of
+a shared directory (memory mapped, see prometheus_client's multiprocess
+mode) that are summed up when the metrics are scraped; enable_multiprocess()
+has to be called before the workers are created.
+"""
+
+import glob
+import os
+
+from prometheus_client import Counter, Histogram, CollectorRegistry, \
+    REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess, values
+from prometheus_client import start_http_server as _start_http_server
+
+
+MULTIPROC_ENV = 'prometheus_multiproc_dir'
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1, 2.5, 5, 10, 30, 60)
+
+MESSAGES = Counter('adsdeploy_messages_total',
+                   'Messages consumed by the workers',
+                   ['worker', 'queue', 'outcome'])
+PROCESSING = Histogram('adsdeploy_processing_seconds',
+                       'Time spent processing a message (or a batch)',
+                       ['worker', 'queue'], buckets=LATENCY_BUCKETS)
+ACK = Histogram('adsdeploy_ack_seconds',
+                'Time from the delivery of a message to its acknowledgement',
+                ['worker', 'queue'], buckets=LATENCY_BUCKETS)
+PUBLISHED = Counter('adsdeploy_published_total',
+                    'Messages published, forwarded or spooled by the workers',
+                    ['worker', 'queue', 'kind'])
+RECONNECTS = Counter('adsdeploy_reconnects_total',
+                     'Connections to RabbitMQ the workers lost',
+                     ['worker'])
+RESTARTS = Counter('adsdeploy_worker_restarts_total',
+                   'Worker processes (or threads) the TaskMaster replaced',
+                   ['worker'])
+RESTART_LATENCY = Histogram('adsdeploy_worker_restart_seconds',
+                            'Time from the exit of a worker to the start of '
+                            'its replacement', ['worker'],
+                            buckets=LATENCY_BUCKETS)
+REQUESTS = Counter('adsdeploy_http_requests_total',
+                   'Requests to the webapp', ['endpoint', 'status'])
+REQUEST_TIME = Histogram('adsdeploy_http_request_seconds',
+                         'Time spent answering a request of the webapp',
+                         ['endpoint'], buckets=LATENCY_BUCKETS)
+
+
+def enable_multiprocess(directory, clear=True):
+    """
+    Makes the metrics of all the processes (started from now on) go to
+    the shared directory
+
+    :param directory: where the processes keep their numbers
+    :param clear: remove the numbers of previous runs
+    :return: no return
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if clear:
+        for name in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(name)
+    os.environ[MULTIPROC_ENV] = directory
+    values.ValueClass = values.get_value_class()
+
+
+def registry():
+    """
+    :return: the registry to expose - in the multiprocess mode one that
+             sums up the numbers of all the processes
+    """
+    if MULTIPROC_ENV in os.environ:
+        r = CollectorRegistry()
+        multiprocess.MultiProcessCollector(r)
+        return r
+    return REGISTRY
+
+
+def expose(registry_=None):
+    """
+    :return: (text of the metrics, content type)
+    """
+    return generate_latest(registry_ or registry()), CONTENT_TYPE_LATEST
+
+
+def start_http_server(port, addr=''):
+    """
+    Serves the metrics on http://<addr>:<port>/ from a daemon thread
+
+    :return: no return
+    """
+    _start_http_server(port, addr, registry=registry())
+
+
+class WorkerMetrics(object):
+    """
+    The metrics of one worker, labelled once (labels() is not free and
+    this is on the path of every message)
+    """
+
+    def __init__(self, worker, queue=None):
+        self.worker = worker
+        self.queue = queue or ''
+        self.ok = MESSAGES.labels(worker, self.queue, 'ok')
+        self.error = MESSAGES.labels(worker, self.queue, 'error')
+        self.processing = PROCESSING.labels(worker, self.queue)
+        self.ack = ACK.labels(worker, self.queue)
+        self.reconnects = RECONNECTS.labels(worker)
+        self._published = {}
+
+    def published(self, queue, kind='publish'):
+        """
+        :param queue: routing key the messages went to
+        :param kind: publish, forward or spool
+        :return: the counter
+        """
+        key = (queue, kind)
+        if key not in self._published:
+            self._published[key] = PUBLISHED.labels(self.worker, queue or '',
+                                                    kind)
+        return self._published[key]
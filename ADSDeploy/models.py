@@ -2,6 +2,7 @@
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, Text, TIMESTAMP
+from .utils import get_date
 
 Base = declarative_base()
 
@@ -13,3 +14,22 @@ class KeyValue(Base):
     
     def toJSON(self):
         return {'key': self.key, 'value': self.value } 
+
+
+class FailedMessage(Base):
+    """Message that a worker could not process (stored by the ErrorHandler)"""
+    __tablename__ = 'failed_messages'
+    id = Column(Integer, primary_key=True)
+    worker = Column(String(255))
+    queue = Column(String(255))
+    payload = Column(Text)
+    exception = Column(Text)
+    created = Column(TIMESTAMP, default=get_date)
+    replayed = Column(TIMESTAMP)
+    
+    def toJSON(self):
+        return {'id': self.id, 'worker': self.worker, 'queue': self.queue,
+                'payload': self.payload, 'exception': self.exception,
+                'created': self.created and self.created.isoformat() or None,
+                'replayed': self.replayed and self.replayed.isoformat() or None}
+
@@ -0,0 +1,130 @@
+"""
+The part of pika's BlockingConnection/BlockingChannel that the workers
+use, for the brokers that are not RabbitMQ: the local transport
+(transports.py) and the in-memory broker (memory.py). The connection
+keeps the channels and the timers, the channel the flags and the frames
+pika hands to the callbacks; the subclasses do the publishing, consuming
+and acknowledging, and process_data_events() - the event loop.
+"""
+
+import pika
+import time
+
+
+class EmulatedChannel(object):
+    """
+    Base of the channels, see pika.BlockingChannel
+    """
+
+    def __init__(self, connection, channel_number):
+        self.connection = connection
+        self.channel_number = channel_number
+        self.delivery_tag = 0
+        self.prefetch_count = 0
+        self.confirm = False
+        self.transactional = False
+        self.is_open = True
+
+    def method(self, method):
+        """
+        :return: the frame pika returns for <method>, e.g. DeclareOk
+        """
+        return pika.frame.Method(self.channel_number, method)
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, all_channels=False):
+        self.prefetch_count = prefetch_count
+
+    def confirm_delivery(self):
+        self.confirm = True
+
+    def tx_select(self):
+        self.transactional = True
+        return self.method(pika.spec.Tx.SelectOk())
+
+    def tx_commit(self):
+        return self.method(pika.spec.Tx.CommitOk())
+
+    def tx_rollback(self):
+        return self.method(pika.spec.Tx.RollbackOk())
+
+    def basic_reject(self, delivery_tag=None, requeue=True):
+        self.basic_nack(delivery_tag, multiple=False, requeue=requeue)
+
+    def encode_body(self, body):
+        """
+        :return: the body as pika sends it (bytes)
+        """
+        if isinstance(body, unicode):
+            return body.encode('utf8')
+        return body
+
+    def dispatch(self, callback, delivery_tag, exchange, routing_key,
+                 properties, body, consumer_tag=None, redelivered=False):
+        """
+        Calls the consumer with the frames pika would give it
+
+        :return: no return
+        """
+        callback(self,
+                 pika.spec.Basic.Deliver(consumer_tag, delivery_tag,
+                                         redelivered, exchange, routing_key),
+                 properties or pika.BasicProperties(),
+                 body)
+
+
+class EmulatedConnection(object):
+    """
+    Base of the connections, see pika.BlockingConnection
+    """
+
+    # made by channel()
+    channel_class = EmulatedChannel
+
+    def __init__(self, url):
+        self.url = url
+        self.channels = []
+        self.timers = {}
+        self.timer_id = 0
+        self.is_open = True
+
+    def channel(self, channel_number=None):
+        if not self.is_open:
+            raise pika.exceptions.ConnectionClosed(320, 'CONNECTION_FORCED')
+        channel = self.channel_class(self,
+                                     channel_number or len(self.channels) + 1)
+        self.channels.append(channel)
+        return channel
+
+    def add_timeout(self, deadline, callback_method):
+        self.timer_id += 1
+        self.timers[self.timer_id] = (time.time() + deadline, callback_method)
+        return self.timer_id
+
+    def remove_timeout(self, timeout_id):
+        self.timers.pop(timeout_id, None)
+
+    def run_timers(self):
+        """
+        Calls the timers that are due
+
+        :return: number of timers called
+        """
+        fired = 0
+        now = time.time()
+        for timer_id, (when, callback) in sorted(self.timers.items(),
+                                                 key=lambda x: x[1][0]):
+            if when <= now and self.timers.pop(timer_id, None):
+                callback()
+                fired += 1
+        return fired
+
+    def process_data_events(self, time_limit=0):
+        raise NotImplementedError
+
+    def sleep(self, duration):
+        self.process_data_events(time_limit=duration)
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+        self.is_open = False
@@ -1,9 +1,141 @@
+from .. import app
+from ADSDeploy import models
 from ADSDeploy.pipeline import generic
+from ADSDeploy.utils import get_date
+import json
+import time
+import traceback
 
 """Generic handling of error states
 
-TODO: improve this worker"""
-        
+The ErrorHandler consumes the error queue and stores the failed messages
+in the database; replay() sends them back to the queues they came from."""
+
 class ErrorHandler(generic.RabbitMQWorker):
-    def process_payload(self, msg):
-        pass
+    """
+    Stores messages from the error queue, a batch at a time, in the
+    failed_messages table. The app has to be initialised (start_pipeline
+    does it); the session is the app's unless another one is given.
+    """
+    def __init__(self, params=None, session=None):
+        params = dict(params or {})
+        params.setdefault('batch_size', 100)
+        super(ErrorHandler, self).__init__(params)
+        self.session = session
+
+    def process_payload(self, msg, **kwargs):
+        """
+        :param msg: payload, as published by the failed worker, example:
+            {'ExampleWorker': {'foo': '....'}}
+        :type: dict
+
+        :return: no return
+        """
+        return self.process_batch([msg],
+                                  header_frames=[kwargs.get('header_frame')])
+
+    def process_batch(self, payloads, channel=None, method_frames=None,
+                      header_frames=None):
+        """
+        Inserts the whole batch in one transaction
+
+        :param payloads: list of messages from the error queue
+        :return: no failures (if the insert fails, the exception is raised)
+        """
+        header_frames = header_frames or [None] * len(payloads)
+        records = []
+        for payload, header_frame in zip(payloads, header_frames):
+            headers = getattr(header_frame, 'headers', None) or {}
+            if isinstance(payload, dict) and len(payload) == 1:
+                worker, message = payload.items()[0]
+            else:
+                worker, message = None, payload
+            records.append(models.FailedMessage(
+                worker=worker,
+                queue=headers.get(generic.SOURCE_HEADER),
+                payload=json.dumps(message),
+                exception=headers.get(generic.ERROR_HEADER)))
+
+        with app.session_scope(self.session) as session:
+            session.bulk_save_objects(records)
+
+        self.logger.debug('Stored {0} failed messages'.format(len(records)))
+        return []
+
+    def offload(self, message, exception, header_frame=None, retry=True,
+                trace=None):
+        """
+        Failures of the ErrorHandler are not sent back to the error queue
+        (it would loop); the exception is raised instead, so the worker
+        dies without acknowledging the messages and they are redelivered
+        once the worker is restarted. Messages that cannot even be decoded
+        are dropped.
+        """
+        if not retry:
+            self.logger.error('Dropping undecodable message: {0}'.format(message))
+            return
+        self.logger.error('Cannot store failed message: {0} ({1})'.format(
+                            exception, trace or traceback.format_exc()))
+        raise exception
+
+
+def replay(worker=None, ids=None, limit=1000, rate=100, window=100,
+           session=None):
+    """
+    Publishes stored failures back to their source queues, at most <rate>
+    messages per second, using batched publishes
+
+    :param worker: only replay failures of this worker class
+    :param ids: only replay failures with these ids
+    :param limit: replay at most this many failures
+    :param rate: messages per second
+    :param window: messages per batch
+    :param session: session factory, by default the app's
+    :return: (number of replayed, number of failed) messages
+    """
+
+    app.init_app()
+
+    publisher = generic.RabbitMQWorker(params={
+                        'exchange': app.config.get('EXCHANGE'),
+                    })
+    publisher.connect(app.config.get('RABBITMQ_URL'), confirm_delivery=True)
+
+    replayed = failed = 0
+    with app.session_scope(session) as session:
+        q = session.query(models.FailedMessage).filter(
+                models.FailedMessage.replayed == None,
+                models.FailedMessage.queue != None)
+        if worker:
+            q = q.filter(models.FailedMessage.worker == worker)
+        if ids:
+            q = q.filter(models.FailedMessage.id.in_(ids))
+        records = q.order_by(models.FailedMessage.id).limit(limit).all()
+
+        for i in range(0, len(records), window):
+            start = time.time()
+            chunk = records[i:i + window]
+
+            by_queue = {}
+            for r in chunk:
+                by_queue.setdefault(r.queue, []).append(r)
+
+            for queue, items in by_queue.items():
+                failures = publisher.publish_batch(
+                    [r.payload for r in items], topic=queue, window=window)
+                failed_positions = set(x[0] for x in failures)
+                for j, r in enumerate(items):
+                    if j in failed_positions:
+                        failed += 1
+                    else:
+                        r.replayed = get_date()
+                        replayed += 1
+            session.commit()
+
+            # keep the rate
+            wait = len(chunk) / float(rate) - (time.time() - start)
+            if wait > 0:
+                time.sleep(wait)
+
+    publisher.connection.close()
+    return replayed, failed
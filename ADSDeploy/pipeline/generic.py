@@ -1,9 +1,120 @@
+from .. import metrics
 from .. import utils
+from . import memory
+from . import profiling
+from . import serializers
+from . import spool
+from . import transports
+from concurrent.futures import ThreadPoolExecutor
+from pika.adapters.tornado_connection import TornadoConnection
+from tornado import ioloop
+from tornado.concurrent import Future, is_future
+import Queue
+import base64
+import copy
+import os
 import pika
+import random
+import signal
 import sys
+import threading
 import json
+import time
 import traceback
 
+
+# how often a draining worker checks whether it should stop consuming
+DRAIN_CHECK_INTERVAL = 0.5
+
+# header that counts how many times the message was retried
+RETRY_HEADER = 'x-retry-attempt'
+
+# headers of messages in the error queue: why the message failed and the
+# queue it came from (where it can be replayed to)
+ERROR_HEADER = 'x-exception'
+SOURCE_HEADER = 'x-source-queue'
+
+# reply codes of channel errors that a new connection can get past (320
+# CONNECTION_FORCED, 405 RESOURCE_LOCKED, 541 INTERNAL_ERROR); others,
+# e.g. 404 NOT_FOUND or 403 ACCESS_REFUSED, stay whatever the worker does
+TRANSIENT_REPLY_CODES = (320, 405, 541)
+
+# connection errors of the configuration (credentials, vhost, broker
+# version): every new connection fails the same way
+PERMANENT_CONNECTION_ERRORS = (pika.exceptions.ProbableAuthenticationError,
+                               pika.exceptions.ProbableAccessDeniedError,
+                               pika.exceptions.IncompatibleProtocolError)
+
+
+def is_transient(error):
+    """
+    :param error: exception raised by pika
+    :return: True if reconnecting may help: the connection was lost (but
+             not refused for one of PERMANENT_CONNECTION_ERRORS), the
+             broker cancelled the consumer (e.g. on a failover) or the
+             channel was closed with one of TRANSIENT_REPLY_CODES
+    """
+    if isinstance(error, PERMANENT_CONNECTION_ERRORS):
+        return False
+    if isinstance(error, (pika.exceptions.AMQPConnectionError,
+                          pika.exceptions.ConsumerCancelled)):
+        return True
+    if isinstance(error, pika.exceptions.ChannelClosed):
+        return bool(error.args) and error.args[0] in TRANSIENT_REPLY_CODES
+    return False
+
+
+def content_properties(header_frame):
+    """
+    :param header_frame: contains header information of the packet
+    :return: (content type, content encoding) of the message, None for
+             those it does not have
+    """
+    content_type = getattr(header_frame, 'content_type', None)
+    content_encoding = getattr(header_frame, 'content_encoding', None)
+    return (content_type if isinstance(content_type, basestring) else None,
+            content_encoding if isinstance(content_encoding, basestring)
+            else None)
+
+
+def get_retry_queues(params):
+    """
+    Delayed retry queues of a worker: the n-th retry waits about
+    delay * multiplier**n milliseconds in a retry queue and is then
+    dead-lettered back to the worker's queue. Configured by the 'retry'
+    parameter of the worker, e.g.
+
+        'retry': {'attempts': 3, 'delay': 1000, 'multiplier': 2,
+                  'jitter': 0.1, 'tiers': 3}
+
+    RabbitMQ only expires the messages at the head of a queue, so all the
+    messages of a retry queue wait the same time (its x-message-ttl); the
+    jitter is in the choice of the queue instead: every attempt has
+    'tiers' queues, spread over the last 'jitter' fraction of its delay.
+
+    :param params: dictionary of parameters of the worker
+    :return: list of [(queue name, delay in ms), ...] tiers, one list per
+             retry attempt
+    """
+
+    retry = params.get('retry')
+    if not retry or not params.get('subscribe'):
+        return []
+
+    delay = retry.get('delay', 1000)
+    multiplier = retry.get('multiplier', 2)
+    jitter = retry.get('jitter', 0.1)
+    tiers = retry.get('tiers', 3) if jitter else 1
+    queues = []
+    for n in range(retry.get('attempts', 3)):
+        longest = delay * multiplier ** n
+        ttls = sorted(set(
+            int(longest * (1 - jitter * i / float(max(tiers - 1, 1))))
+            for i in range(tiers)))
+        queues.append([('{0}.retry.{1}'.format(params['subscribe'], ttl), ttl)
+                       for ttl in ttls])
+    return queues
+
 class RabbitMQWorker(object):
     """
     Base worker class. Defines the plumbing to communicate with rabbitMQ
@@ -28,6 +139,43 @@ class RabbitMQWorker(object):
         self.channel = None
         self.fwd_topic = None
         self.fwd_exchange = None
+        self.fwd_connection = None
+        self.fwd_channel = None
+        self.confirm_delivery = False
+        self.fwd_confirm_delivery = False
+        self.tx_channel = None
+        self.fwd_tx_channel = None
+        self.publish_window = params.get('publish_window', 100)
+        self.batch_size = params.get('batch_size', 0)
+        self.batch_timeout = params.get('batch_timeout', 1000)
+        self.batch = []
+        self.batch_timer = None
+        self.batch_started = None
+        self.execution = params.get('execution', 'inline')
+        self.threads = params.get('threads', 1)
+        self.executor = None
+        self.completed = Queue.Queue()
+        # what process_payload publishes in a pool thread waits here (per
+        # thread) and is published by the connection thread, see outbox()
+        self.outboxes = threading.local()
+        self.pending = 0
+        self.consuming = False
+        self.draining = False
+        self.drained = 0
+        self.consumer_tag = None
+        self.spool = None
+        self.fwd_spool = None
+        self.drainers = []
+        self.generation = 0
+        self.content_type = params.get('content_type', serializers.JSON)
+        self.compression = params.get('compression', None)
+        self.compression_threshold = params.get('compression_threshold', 1024)
+        self.passthrough = (params.get('forwarding') or {}).get('passthrough',
+                                                                False)
+        self.metrics = metrics.WorkerMetrics(self.__class__.__name__,
+                                             params.get('subscribe'))
+        self.reconnects = 0
+        self.downtime = 0.0
         if 'publish' in self.params and self.params['publish']:
             self.publish_topic = self.params['publish']
 
@@ -52,37 +200,156 @@ class RabbitMQWorker(object):
         """
 
         try:
-            self.connection = pika.BlockingConnection(pika.URLParameters(url))
+            self.connection = self.open_connection(url)
             self.channel = self.connection.channel()
+            self.tx_channel = None
+            self.confirm_delivery = confirm_delivery
             if confirm_delivery:
                 self.channel.confirm_delivery()
-            self.channel.basic_qos(prefetch_count=1)
+            if self.params.get('prefetch'):
+                self.channel.basic_qos(prefetch_count=self.params['prefetch'])
+            elif self.execution == 'threadpool':
+                self.channel.basic_qos(prefetch_count=self.threads)
+            else:
+                self.channel.basic_qos(prefetch_count=max(1, self.batch_size))
             
             for x in ('publish', 'subscribe'):
                 if x in self.params and self.params[x]:
                     self.channel.queue_declare(queue=self.params[x], passive=True)
                     
+            if self.params.get('spool') and self.spool is None:
+                self.spool = self.start_spool('publish', url, confirm_delivery)
+
             if self.params.get('forwarding'):
                 fwd = self.params.get('forwarding')
-                self.fwd_connection = pika.BlockingConnection(pika.URLParameters(fwd.get('url', url)))
-                self.fwd_channel = self.fwd_connection.channel()
-                if fwd.get('confirm_delivery', confirm_delivery):
-                    self.fwd_channel.confirm_delivery()
-                    self.fwd_channel.basic_qos(prefetch_count=1)
-                if fwd.get('publish'):
-                    self.fwd_channel.queue_declare(queue=fwd['publish'], passive=True)
-                    self.fwd_topic = fwd['publish']
-                if fwd.get('exchange'):
-                    self.fwd_exchange = fwd['exchange']
-                else:
+                if not fwd.get('exchange'):
                     raise Exception('exchange must be specified for forwarding')
-                    
+                self.fwd_exchange = fwd['exchange']
+                self.fwd_topic = fwd.get('publish')
+                self.fwd_confirm_delivery = fwd.get('confirm_delivery', confirm_delivery)
+                if self.params.get('spool') and self.fwd_spool is None:
+                    self.fwd_spool = self.start_spool(
+                        'forward', fwd.get('url', url), self.fwd_confirm_delivery)
+                try:
+                    self.fwd_connection = self.open_connection(fwd.get('url', url))
+                    self.fwd_channel = self.fwd_connection.channel()
+                    self.fwd_tx_channel = None
+                    if self.fwd_confirm_delivery:
+                        self.fwd_channel.confirm_delivery()
+                        self.fwd_channel.basic_qos(prefetch_count=1)
+                    if fwd.get('publish'):
+                        self.fwd_channel.queue_declare(queue=fwd['publish'], passive=True)
+                except pika.exceptions.AMQPConnectionError:
+                    if self.fwd_spool is None:
+                        raise
+                    # the messages wait in the spool until the target is back
+                    self.logger.warning('Forwarding target unreachable, '
+                                        'spooling: {0}'.format(sys.exc_info()))
+                    self.fwd_channel = None
+
             return True
+        except (pika.exceptions.AMQPConnectionError,
+                pika.exceptions.AMQPChannelError):
+            # keep the type, so that the caller can decide to reconnect
+            self.logger.error(sys.exc_info())
+            raise
         except:
             self.logger.error(sys.exc_info())
             raise Exception(sys.exc_info())
 
 
+    def open_connection(self, url):
+        """
+        Opens the connection through the transport the url asks for: the
+        local transport (local://) between workers on the same host, the
+        in-memory broker (memory://) for tests, AMQP otherwise
+
+        :param url: URI of the RabbitMQ instance (or local://, memory://)
+        :return: pika.BlockingConnection, transports.LocalConnection or
+                 memory.MemoryConnection
+        """
+        if transports.is_local(url):
+            return transports.LocalConnection(url)
+        if memory.is_memory(url):
+            return memory.MemoryConnection(url)
+        return pika.BlockingConnection(pika.URLParameters(url))
+
+
+    def encode(self, message, properties=None):
+        """
+        Serializes the message with the worker's content type (and
+        compression) and stamps them into the message properties
+
+        :param message: the message to serialize
+        :param properties: pika.BasicProperties of the message, if any
+        :return: (body, properties)
+        """
+        body, content_type, content_encoding = serializers.encode(
+                    message,
+                    content_type=self.content_type,
+                    compression=self.compression,
+                    threshold=self.compression_threshold)
+        # the caller's properties are left as they are
+        properties = copy.copy(properties) if properties is not None \
+            else pika.BasicProperties()
+        properties.content_type = content_type
+        properties.content_encoding = content_encoding
+        return body, properties
+
+
+    def decode(self, body, header_frame=None):
+        """
+        Deserializes the message according to its content type and
+        encoding (plain JSON if it has none)
+
+        :param body: contains the message inside the packet
+        :param header_frame: contains header information of the packet
+        :return: the message
+        """
+        content_type, content_encoding = content_properties(header_frame)
+        return serializers.decode(body, content_type=content_type,
+                                  content_encoding=content_encoding)
+
+
+    def undecodable(self, body, exception, header_frame=None):
+        """
+        Sends a message that cannot be decoded (unknown encoding, corrupt
+        body...) to the error queue, without retries; the raw body goes in
+        base64, together with the content type and encoding it came with
+
+        :param body: contains the message inside the packet
+        :param exception: the exception raised while decoding it
+        :param header_frame: contains header information of the packet
+        :return: no return
+        """
+        content_type, content_encoding = content_properties(header_frame)
+        self.metrics.error.inc()
+        self.offload({'undecodable': base64.b64encode(body),
+                      'content_type': content_type,
+                      'content_encoding': content_encoding},
+                     exception, header_frame=header_frame, retry=False)
+
+
+    def start_spool(self, name, url, confirm_delivery=False):
+        """
+        Opens the disk spool for outgoing messages (see the 'spool'
+        parameter) and starts the thread that publishes it to <url>
+
+        :param name: 'publish' or 'forward'
+        :param url: URI of the RabbitMQ instance the messages are for
+        :param confirm_delivery: should the drainer confirm delivery
+        :return: spool.Spool
+        """
+        s = spool.Spool(os.path.join(self.params['spool'],
+                                     self.__class__.__name__, name),
+                        fsync_every=self.params.get('spool_fsync', 100))
+        drainer = spool.SpoolDrainer(s, url, confirm_delivery=confirm_delivery,
+                                     connect=self.open_connection)
+        drainer.start()
+        self.drainers.append(drainer)
+        return s
+
+
     def publish_to_error_queue(self, message, exchange=None, routing_key=None,
                                **kwargs):
         """
@@ -99,9 +366,40 @@ class RabbitMQWorker(object):
             exchange = self.params.get('exchange', 'ads-orcid')
 
         if not routing_key:
-            routing_key = self.params.get('error', 'ads.orcid.error')
+            routing_key = self.params.get('error', 'ads.deploy.error')
 
-        self.publish(message, topic=routing_key, properties=kwargs['header_frame'])
+        header_frame = kwargs.get('header_frame')
+        headers = dict(getattr(header_frame, 'headers', None) or {})
+        headers.pop(RETRY_HEADER, None)
+        if kwargs.get('exception') is not None:
+            headers[ERROR_HEADER] = repr(kwargs['exception'])
+        if self.params.get('subscribe'):
+            headers[SOURCE_HEADER] = self.params['subscribe']
+
+        self.publish(message, topic=routing_key,
+                     properties=pika.BasicProperties(
+                         headers=headers,
+                         delivery_mode=getattr(header_frame, 'delivery_mode',
+                                               None)))
+
+
+    def outbox(self, method, message, topic, kwargs):
+        """
+        pika connections are not thread-safe: in a thread of the pool the
+        messages are only collected, process_in_thread() hands them to the
+        connection thread, which publishes them (before the ack)
+
+        :param method: name of the method that publishes them
+        :param message: message (or list of messages)
+        :param topic: the routing key
+        :param kwargs: the other arguments of the method
+        :return: True if the message was collected for later
+        """
+        outbox = getattr(self.outboxes, 'messages', None)
+        if outbox is None:
+            return False
+        outbox.append((method, message, topic, kwargs))
+        return True
 
 
     def forward(self, message, topic=None, **kwargs):
@@ -112,19 +410,41 @@ class RabbitMQWorker(object):
         if not (topic or self.fwd_topic):
             self.logger.error('Whaaaat? No forwarding topic/queue configured!')
             return
+
+        if self.outbox('forward', message, topic, kwargs):
+            return
         
+        properties = kwargs.get('properties')
+        if not isinstance(message, basestring):
+            message, properties = self.encode(message, properties)
+
+        # while anything waits in the spool, new messages queue up behind
+        if self.fwd_spool is not None and (len(self.fwd_spool) or not self.fwd_channel):
+            self.fwd_spool.append(self.fwd_exchange, topic or self.fwd_topic,
+                                  message, properties)
+            self.metrics.published(topic or self.fwd_topic, 'spool').inc()
+            return
+
         if not self.fwd_channel:
             raise Exception('You must connect to a channel before caling forward()')
         
-        self.logger.debug('Publish to {0} using topic {1}'.format(
-                                    self.fwd_exchange,
-                                    topic or self.fwd_topic))
+        self.logger.debug('Publish to %s using topic %s', self.fwd_exchange,
+                          topic or self.fwd_topic)
         
-        if not isinstance(message, basestring):
-            message = json.dumps(message)
-        self.fwd_channel.basic_publish(exchange=self.fwd_exchange,
-                                   routing_key=topic or self.fwd_topic,
-                                   body=message)
+        try:
+            self.fwd_channel.basic_publish(exchange=self.fwd_exchange,
+                                           routing_key=topic or self.fwd_topic,
+                                           body=message,
+                                           properties=properties)
+            self.metrics.published(topic or self.fwd_topic, 'forward').inc()
+        except pika.exceptions.AMQPError, e:
+            if self.fwd_spool is None:
+                raise
+            self.logger.warning('Forwarding failed, spooling: {0}'.format(e))
+            self.fwd_channel = None
+            self.fwd_spool.append(self.fwd_exchange, topic or self.fwd_topic,
+                                  message, properties)
+            self.metrics.published(topic or self.fwd_topic, 'spool').inc()
         
         
     def publish(self, message, topic=None, **kwargs):
@@ -135,28 +455,236 @@ class RabbitMQWorker(object):
         :param message: message to be publishes
         :param topic: String (the routing key) - overrides this worker's 
                routing key
-        :param kwargs: extra keywords that may be needed
+        :param kwargs: extra keywords that may be needed, e.g. properties
+               (pika.BasicProperties of the message)
         :return: no return
         """
 
         if not (topic or self.publish_topic):
             self.logger.error('Whaaaat? No topic/queue configured!')
             return
+
+        if self.outbox('publish', message, topic, kwargs):
+            return
         
+        properties = kwargs.get('properties')
+        if not isinstance(message, basestring):
+            message, properties = self.encode(message, properties)
+
+        # while anything waits in the spool, new messages queue up behind
+        if self.spool is not None and (len(self.spool) or not self.channel):
+            self.spool.append(self.exchange, topic or self.publish_topic,
+                              message, properties)
+            self.metrics.published(topic or self.publish_topic, 'spool').inc()
+            return
+
         if not self.channel:
             self.logger.error('You must connect to a channel before caling publish()')
             return
         
-        self.logger.debug('Publish to {0} using topic {1}'.format(
-                                    self.exchange,
-                                    topic or self.publish_topic))
-        
-        if not isinstance(message, basestring):
-            message = json.dumps(message)
-        self.channel.basic_publish(exchange=self.exchange,
-                                   routing_key=topic or self.publish_topic,
-                                   body=message)
+        # per-message lines are formatted lazily, only if they are written
+        self.logger.debug('Publish to %s using topic %s', self.exchange,
+                          topic or self.publish_topic)
         
+        try:
+            self.channel.basic_publish(exchange=self.exchange,
+                                       routing_key=topic or self.publish_topic,
+                                       body=message,
+                                       properties=properties)
+            self.metrics.published(topic or self.publish_topic).inc()
+        except pika.exceptions.AMQPError, e:
+            if self.spool is None:
+                raise
+            self.logger.warning('Publishing failed, spooling: {0}'.format(e))
+            self.spool.append(self.exchange, topic or self.publish_topic,
+                              message, properties)
+            self.metrics.published(topic or self.publish_topic, 'spool').inc()
+
+
+    def forward_batch(self, messages, topic=None, window=None, **kwargs):
+        """
+        Forwards many messages to another server/exchange/queue, waiting
+        for the broker only once per window. See publish_batch()
+
+        :param messages: iterable of messages (dicts or strings)
+        :param topic: String (the routing key) - overrides the forwarding
+               routing key
+        :param window: how many messages are sent before waiting for the
+               broker; defaults to the 'publish_window' parameter
+        :param kwargs: extra keywords that may be needed, e.g. properties
+               (list of pika.BasicProperties, one per message)
+        :return: list of (position, exception) tuples for failed messages
+        """
+
+        if not (topic or self.fwd_topic):
+            self.logger.error('Whaaaat? No forwarding topic/queue configured!')
+            return [(i, Exception('No forwarding topic/queue configured'))
+                    for i, _ in enumerate(messages)]
+
+        if self.outbox('forward_batch', messages, topic,
+                       dict(kwargs, window=window)):
+            return []
+
+        # while anything waits in the spool, new messages queue up behind
+        if self.fwd_spool is not None and (len(self.fwd_spool) or not self.fwd_channel):
+            properties = kwargs.get('properties') or [None] * len(messages)
+            for message, props in zip(messages, properties):
+                if not isinstance(message, basestring):
+                    message, props = self.encode(message, props)
+                self.fwd_spool.append(self.fwd_exchange, topic or self.fwd_topic,
+                                      message, props)
+            self.metrics.published(topic or self.fwd_topic, 'spool').inc(
+                                       len(messages))
+            return []
+
+        if not self.fwd_channel:
+            raise Exception('You must connect to a channel before caling forward_batch()')
+
+        if self.fwd_confirm_delivery:
+            if not self.fwd_tx_channel:
+                self.fwd_tx_channel = self.fwd_connection.channel()
+                self.fwd_tx_channel.tx_select()
+            channel = self.fwd_tx_channel
+        else:
+            channel = self.fwd_channel
+
+        failures = self._publish_batch(channel, messages,
+                                       exchange=self.fwd_exchange,
+                                       routing_key=topic or self.fwd_topic,
+                                       window=window or self.publish_window,
+                                       transactional=self.fwd_confirm_delivery,
+                                       properties=kwargs.get('properties'))
+        if failures and self.fwd_confirm_delivery:
+            self.fwd_tx_channel = self.discard_channel(channel)
+        self.metrics.published(topic or self.fwd_topic, 'forward').inc(
+                                   len(messages) - len(failures))
+        return failures
+
+
+    def publish_batch(self, messages, topic=None, window=None, **kwargs):
+        """
+        Publishes many messages to the queue. Unlike publish(), which (when
+        delivery is confirmed) waits for the broker after every message,
+        the messages are sent in windows and the broker is waited for only
+        once per window.
+
+        The blocking pika channel cannot have several confirms in flight,
+        so a confirmed batch goes through a separate transactional channel
+        of the same connection: each window is committed with tx_commit()
+        and a successful commit means the broker has taken the whole window.
+
+        :param messages: iterable of messages (dicts or strings)
+        :param topic: String (the routing key) - overrides this worker's
+               routing key
+        :param window: how many messages are sent before waiting for the
+               broker; defaults to the 'publish_window' parameter
+        :param kwargs: extra keywords that may be needed, e.g. properties
+               (list of pika.BasicProperties, one per message)
+        :return: list of (position, exception) tuples for failed messages
+        """
+
+        if not (topic or self.publish_topic):
+            self.logger.error('Whaaaat? No topic/queue configured!')
+            return [(i, Exception('No topic/queue configured'))
+                    for i, _ in enumerate(messages)]
+
+        if self.outbox('publish_batch', messages, topic,
+                       dict(kwargs, window=window)):
+            return []
+
+        if not self.channel:
+            self.logger.error('You must connect to a channel before caling publish_batch()')
+            return [(i, Exception('Not connected'))
+                    for i, _ in enumerate(messages)]
+
+        if self.confirm_delivery:
+            if not self.tx_channel:
+                self.tx_channel = self.connection.channel()
+                self.tx_channel.tx_select()
+            channel = self.tx_channel
+        else:
+            channel = self.channel
+
+        failures = self._publish_batch(channel, messages,
+                                       exchange=self.exchange,
+                                       routing_key=topic or self.publish_topic,
+                                       window=window or self.publish_window,
+                                       transactional=self.confirm_delivery,
+                                       properties=kwargs.get('properties'))
+        if failures and self.confirm_delivery:
+            self.tx_channel = self.discard_channel(channel)
+        self.metrics.published(topic or self.publish_topic).inc(
+                                   len(messages) - len(failures))
+        return failures
+
+
+    def discard_channel(self, channel):
+        """
+        Closes a transactional channel after a failed batch: a commit that
+        raised leaves it closed (or in an unknown state), so the next batch
+        opens a new one
+
+        :param channel: the channel
+        :return: None, to be assigned to the attribute that held it
+        """
+        try:
+            if channel.is_open:
+                channel.close()
+        except Exception, e:
+            self.logger.debug('Closing the channel failed: {0}'.format(e))
+        return None
+
+
+    def _publish_batch(self, channel, messages, exchange, routing_key,
+                       window=100, transactional=False, properties=None):
+        """
+        Sends the messages through the channel, committing every <window>
+        messages when the channel is transactional
+
+        :return: list of (position, exception) tuples for failed messages
+        """
+
+        properties = properties or [None] * len(messages)
+
+        self.logger.debug('Batch publish to %s using topic %s', exchange,
+                          routing_key)
+
+        failures = []
+        pending = []
+
+        def commit():
+            if not (transactional and pending):
+                return
+            try:
+                channel.tx_commit()
+            except Exception, e:
+                self.logger.warning('Window of {0} messages was not committed: '
+                                    '{1}'.format(len(pending), e))
+                failures.extend([(i, e) for i in pending])
+            del pending[:]
+
+        for i, (message, props) in enumerate(zip(messages, properties)):
+            try:
+                if not isinstance(message, basestring):
+                    message, props = self.encode(message, props)
+                channel.basic_publish(exchange=exchange,
+                                      routing_key=routing_key,
+                                      body=message,
+                                      properties=props)
+                pending.append(i)
+            except Exception, e:
+                self.logger.warning('Message {0} was not published: {1}'
+                                    .format(i, e))
+                failures.append((i, e))
+                continue
+
+            if len(pending) >= window:
+                commit()
+
+        commit()
+        failures.sort(key=lambda x: x[0])
+        return failures
+
 
     def subscribe(self, callback, **kwargs):
         """
@@ -175,7 +703,138 @@ class RabbitMQWorker(object):
             if not self.params.get('TEST_RUN', False):
                 self.logger.debug('Worker consuming from queue: {0}'.format(
                     self.params['subscribe']))
-                self.channel.start_consuming()
+                if self.executor:
+                    self.consume_threaded()
+                else:
+                    self.consuming = True
+                    self.connection.add_timeout(DRAIN_CHECK_INTERVAL,
+                                                self.check_draining)
+                    self.channel.start_consuming()
+
+
+    def drain(self, os_signal=None, frame=None):
+        """
+        Asks the worker to stop gracefully: it stops consuming, finishes
+        and acknowledges the messages it has (counted in self.drained),
+        and run() returns. It only
+        sets a flag (the consuming loop does the rest), so it is safe to
+        call from a signal handler or from another thread.
+
+        :param os_signal: the signal, when used as a signal handler
+        :param frame: the frame, when used as a signal handler
+        :return: no return
+        """
+        self.draining = True
+
+
+    def check_draining(self):
+        """
+        Timer of the consuming loop (also called after every message):
+        once drain() was called, processes the collected batch and stops
+        consuming (pika requeues the messages it has received but not
+        handed to the worker yet)
+
+        :return: no return
+        """
+        if not self.consuming:
+            return
+        if not self.draining:
+            self.connection.add_timeout(DRAIN_CHECK_INTERVAL,
+                                        self.check_draining)
+            return
+        self.consuming = False
+        self.logger.info('Draining: consuming stopped')
+        self.drained += len(self.batch)
+        self.flush_batch()
+        self.channel.stop_consuming()
+
+
+    def consume_threaded(self, poll_interval=0.05):
+        """
+        Consuming loop used with the thread pool: the connection is only
+        ever touched from this thread, between the polls it sends the acks
+        (and error messages) of the payloads finished by the pool
+
+        :param poll_interval: how long to wait for the broker in one go
+        :return: no return
+        """
+        self.consuming = True
+        stopped = False
+        while self.consuming:
+            self.connection.process_data_events(time_limit=poll_interval)
+            self.ack_completed()
+            if self.draining:
+                if not stopped:
+                    stopped = True
+                    self.logger.info('Draining: consuming stopped, {0} '
+                                     'messages in the pool'.format(
+                                        self.pending))
+                    self.channel.stop_consuming()
+                if not self.pending:
+                    self.consuming = False
+
+
+    def ack_completed(self):
+        """
+        Publishes what the thread pool has produced and acknowledges the
+        messages it has finished with
+
+        :return: number of acknowledged messages
+        """
+        acked = 0
+        while True:
+            try:
+                message, error, trace, outbox, method_frame, header_frame, \
+                    generation, received = self.completed.get_nowait()
+            except Queue.Empty:
+                return acked
+            self.pending -= 1
+            if generation != self.generation:
+                # received on a connection that is gone; the broker will
+                # deliver the message again
+                continue
+            for method, body, topic, kwargs in outbox:
+                getattr(self, method)(body, topic, **kwargs)
+            if error is not None:
+                self.offload(message, error, header_frame=header_frame,
+                             trace=trace)
+            self.channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            self.metrics.ack.observe(time.time() - received)
+            acked += 1
+            if self.draining:
+                self.drained += 1
+
+
+    def process_in_thread(self, message, channel, method_frame, header_frame,
+                          generation=0, received=None):
+        """
+        Runs process_payload inside the thread pool; the outcome (and the
+        messages it published, see outbox()) is handed back to the
+        connection thread through the (thread-safe) queue, tagged with the
+        connection it was received on. process_payload must not use the
+        channel it is given directly, the connection belongs to the
+        other thread.
+        """
+        error = trace = None
+        outbox = self.outboxes.messages = []
+        start = time.time()
+        try:
+            self.results = self.process_payload(message,
+                                                channel=channel,
+                                                method_frame=method_frame,
+                                                header_frame=header_frame)
+            self.metrics.ok.inc()
+        except Exception, e:
+            trace = traceback.format_exc()
+            self.logger.warning('Exception in thread pool: {0} ({1})'.format(
+                                    e, trace))
+            self.metrics.error.inc()
+            error = e
+        finally:
+            self.outboxes.messages = None
+        self.metrics.processing.observe(time.time() - start)
+        self.completed.put((message, error, trace, outbox, method_frame,
+                            header_frame, generation, received or start))
 
     
     def process_payload(self, payload, 
@@ -186,6 +845,194 @@ class RabbitMQWorker(object):
         raise NotImplementedError("Missing impl of process_payload")
         
 
+    def process_batch(self, payloads,
+                      channel=None,
+                      method_frames=None,
+                      header_frames=None):
+        """
+        Processes a batch of messages at once (when the worker runs with
+        'batch_size'). Override it to e.g. write the whole batch in one
+        transaction; by default it calls process_payload for every message.
+
+        :param payloads: list of decoded messages
+        :param channel: the channel instance for the connected queue
+        :param method_frames: list of delivery information of the packets
+        :param header_frames: list of header information of the packets
+        :return: list of (position, exception) tuples for the messages
+                 that failed; they are sent to the error queue
+        """
+        method_frames = method_frames or [None] * len(payloads)
+        header_frames = header_frames or [None] * len(payloads)
+        failures = []
+        for i, payload in enumerate(payloads):
+            try:
+                self.process_payload(payload,
+                                     channel=channel,
+                                     method_frame=method_frames[i],
+                                     header_frame=header_frames[i])
+            except Exception, e:
+                failures.append((i, e))
+        return failures
+
+
+    def retry(self, message, header_frame=None):
+        """
+        Schedules the message for another attempt, if the worker has retry
+        queues and the message did not use them all up. The wait grows
+        exponentially with the attempts; a random tier of the attempt
+        shortens it by up to the jitter, so that retried messages do not
+        come back all at once (see get_retry_queues())
+
+        :param message: the (decoded) message that failed
+        :param header_frame: contains header information of the packet
+        :return: True if the message was scheduled for a retry
+        """
+
+        queues = get_retry_queues(self.params)
+        headers = dict(getattr(header_frame, 'headers', None) or {})
+        attempt = headers.get(RETRY_HEADER, 0)
+        if attempt >= len(queues):
+            return False
+
+        queue, ttl = random.choice(queues[attempt])
+        headers[RETRY_HEADER] = attempt + 1
+
+        self.logger.debug('Retry %s of the message in %s', attempt + 1, queue)
+        self.channel.basic_publish(
+            exchange='',
+            routing_key=queue,
+            body=json.dumps(message),
+            properties=pika.BasicProperties(
+                headers=headers,
+                delivery_mode=getattr(header_frame, 'delivery_mode', None)))
+        return True
+
+
+    def offload(self, message, exception, header_frame=None, retry=True,
+                trace=None):
+        """
+        Sends a message that could not be processed to a retry queue or,
+        when it has no retries left, to the error queue
+
+        :param message: the (decoded) message that failed
+        :param exception: the exception raised while processing it
+        :param header_frame: contains header information of the packet
+        :param retry: False if the message should not be retried
+        :param trace: traceback of the exception, when it is not the one
+                      being handled (e.g. it was raised in another thread)
+        :return: no return
+        """
+        if retry and self.retry(message, header_frame=header_frame):
+            self.results = 'Retrying due to exception: {0}'.format(
+                                    exception.message)
+            self.logger.info('Retrying due to exception: {0}'.format(
+                                    exception.message))
+            return
+
+        self.results = 'Offloading to ErrorWorker due to exception:' \
+                       ' {0}'.format(exception.message)
+
+        self.logger.warning('Offloading to ErrorWorker due to exception: '
+                            '{0} ({1})'.format(exception.message,
+                                               trace or
+                                               traceback.format_exc()))
+
+        self.publish_to_error_queue(json.dumps(
+            {self.__class__.__name__: message}),
+            header_frame=header_frame,
+            exception=exception
+        )
+
+
+    def on_batch_message(self, channel, method_frame, header_frame, body):
+        """
+        Collects messages into a batch; the batch is processed when it has
+        'batch_size' messages or 'batch_timeout' milliseconds after its
+        first message arrived - whichever comes first
+
+        :param channel: the channel instance for the connected queue
+        :param method_frame: contains delivery information of the packet
+        :param header_frame: contains header information of the packet
+        :param body: contains the message inside the packet
+        :return: no return
+        """
+
+        if not self.batch:
+            self.batch_started = time.time()
+        self.batch.append((channel, method_frame, header_frame, body))
+
+        if len(self.batch) >= self.batch_size:
+            self.flush_batch()
+        elif self.batch_timer is None and self.connection:
+            self.batch_timer = self.connection.add_timeout(
+                self.batch_timeout / 1000.0, self.on_batch_timeout)
+
+
+    def on_batch_timeout(self):
+        """Called by the connection when the batch waited long enough"""
+        self.batch_timer = None
+        self.flush_batch()
+
+
+    def flush_batch(self):
+        """
+        Processes the collected batch (you have to provide process_batch
+        or process_payload method); failed messages are sent to the error
+        queue one by one and the whole batch is then acknowledged at once
+
+        :return: no return
+        """
+
+        if self.batch_timer is not None:
+            self.connection.remove_timeout(self.batch_timer)
+            self.batch_timer = None
+
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+
+        if self.passthrough:
+            return self.relay(batch)
+
+        self.logger.debug('Running on batch of %s', len(batch))
+
+        items = []
+        for channel, method_frame, header_frame, body in batch:
+            try:
+                items.append((self.decode(body, header_frame), method_frame,
+                              header_frame))
+            except Exception, e:
+                self.undecodable(body, e, header_frame=header_frame)
+
+        if items:
+            payloads = [x[0] for x in items]
+            start = time.time()
+            try:
+                failures = self.process_batch(
+                    payloads,
+                    channel=self.channel,
+                    method_frames=[x[1] for x in items],
+                    header_frames=[x[2] for x in items])
+            except Exception, e:
+                failures = [(i, e) for i in range(len(items))]
+            self.metrics.processing.observe(time.time() - start)
+            self.metrics.ok.inc(len(items) - len(failures or []))
+            self.metrics.error.inc(len(failures or []))
+
+            for i, e in failures or []:
+                self.offload(payloads[i], e, header_frame=items[i][2])
+
+            if not failures:
+                self.results = None
+
+        # Send delivery acknowledgement for everything up to the last one
+        self.channel.basic_ack(delivery_tag=batch[-1][1].delivery_tag,
+                               multiple=True)
+        if self.batch_started is not None:
+            # the first message of the batch waited the longest
+            self.metrics.ack.observe(time.time() - self.batch_started)
+
+
     def on_message(self, channel, method_frame, header_frame, body):
         """
         Default skeleton for processing data (you have to provide
@@ -198,28 +1045,86 @@ class RabbitMQWorker(object):
         :return: no return
         """
 
-        message = json.loads(body)
+        if self.passthrough:
+            return self.relay([(channel, method_frame, header_frame, body)])
+
+        received = time.time()
+        try:
+            message = self.decode(body, header_frame)
+        except Exception, e:
+            self.undecodable(body, e, header_frame=header_frame)
+            self.channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            if self.draining:
+                self.drained += 1
+                self.check_draining()
+            return
+
+        if self.executor:
+            self.pending += 1
+            self.executor.submit(self.process_in_thread, message, channel,
+                                 method_frame, header_frame, self.generation,
+                                 received)
+            return
+
         try:
             self.logger.debug('Running on message')
             self.results = self.process_payload(message, 
                                                 channel=channel, 
                                                 method_frame=method_frame, 
                                                 header_frame=header_frame)
+            self.metrics.ok.inc()
         except Exception, e:
-            self.results = 'Offloading to ErrorWorker due to exception:' \
-                           ' {0}'.format(e.message)
-
-            self.logger.warning('Offloading to ErrorWorker due to exception: '
-                                '{0} ({1})'.format(e.message,
-                                                   traceback.format_exc()))
-
-            self.publish_to_error_queue(json.dumps(
-                {self.__class__.__name__: message}),
-                header_frame=header_frame
-            )
+            self.metrics.error.inc()
+            self.offload(message, e, header_frame=header_frame)
+        self.metrics.processing.observe(time.time() - received)
 
         # Send delivery acknowledgement
         self.channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+        self.metrics.ack.observe(time.time() - received)
+
+        if self.draining:
+            self.drained += 1
+            self.check_draining()
+
+
+    def relay(self, batch):
+        """
+        Pass-through forwarding: the raw bodies go to the forwarding target
+        together with their original properties (content type, headers...),
+        nothing is decoded or re-encoded. Messages that the target did not
+        take are rejected back to the queue; if the target is unreachable
+        and there is no spool, the exception is raised and nothing is
+        acknowledged.
+
+        :param batch: list of (channel, method_frame, header_frame, body)
+        :return: no return
+        """
+
+        self.logger.debug('Relaying %s messages', len(batch))
+
+        if len(batch) == 1:
+            _, method_frame, header_frame, body = batch[0]
+            self.forward(body, properties=header_frame)
+            self.channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            self.metrics.ok.inc()
+            return
+
+        failures = self.forward_batch([x[3] for x in batch],
+                                      properties=[x[2] for x in batch])
+        self.metrics.ok.inc(len(batch) - len(failures))
+        self.metrics.error.inc(len(failures))
+        if not failures:
+            self.channel.basic_ack(delivery_tag=batch[-1][1].delivery_tag,
+                                   multiple=True)
+            return
+
+        failed = set(x[0] for x in failures)
+        for i, (_, method_frame, _, _) in enumerate(batch):
+            if i in failed:
+                self.channel.basic_nack(delivery_tag=method_frame.delivery_tag,
+                                        requeue=True)
+            else:
+                self.channel.basic_ack(delivery_tag=method_frame.delivery_tag)
 
 
     def run(self):
@@ -229,5 +1134,297 @@ class RabbitMQWorker(object):
         :return: no return
         """
 
+        # SIGUSR1 profiles the worker (when it is a process of its own),
+        # SIGTERM drains it
+        profiling.install(self.__class__.__name__)
+        self.install_drain_handler()
+
+        if self.execution == 'threadpool':
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+
+        reconnect = self.params.get('reconnect', {})
+        attempt = 0
+        down_since = None
+        while True:
+            try:
+                self.connect(self.params['RABBITMQ_URL'])
+                if down_since is not None:
+                    self.downtime += time.time() - down_since
+                    self.logger.info('Reconnected after {0:.1f}s ({1} reconnects,'
+                                     ' {2:.1f}s down in total)'.format(
+                                        time.time() - down_since,
+                                        self.reconnects, self.downtime))
+                    down_since = None
+                attempt = 0
+
+                if self.batch_size:
+                    self.subscribe(self.on_batch_message)
+                else:
+                    self.subscribe(self.on_message)
+                if self.draining:
+                    self.logger.info('Drained')
+                    self.disconnect()
+                return
+            except (pika.exceptions.AMQPConnectionError,
+                    pika.exceptions.AMQPChannelError), e:
+                # a permanent error is left to the TaskMaster (and its
+                # backoff), reconnecting would not help
+                if reconnect is False or not is_transient(e):
+                    raise
+                attempt += 1
+                if reconnect.get('attempts') and attempt > reconnect['attempts']:
+                    self.logger.error('Giving up after {0} reconnects'.format(
+                                            attempt - 1))
+                    raise
+                if down_since is None:
+                    down_since = time.time()
+                self.reconnects += 1
+                self.metrics.reconnects.inc()
+                delay = self.reconnect_delay(attempt, reconnect)
+                self.logger.warning('Connection lost ({0}), reconnecting in '
+                                    '{1:.1f}s'.format(repr(e), delay))
+                self.disconnect()
+                time.sleep(delay)
+
+
+    def install_drain_handler(self):
+        """
+        Makes SIGTERM drain the worker; only a worker in the main thread of
+        its process can have it, the others are drained by drain()
+
+        :return: True if installed
+        """
+        try:
+            signal.signal(signal.SIGTERM, self.drain)
+        except ValueError:
+            return False
+        return True
+
+
+    def reconnect_delay(self, attempt, reconnect=None):
+        """
+        Exponential backoff with full jitter, so that the workers that lost
+        the connection together do not all come back at the same time
+
+        :param attempt: number of the reconnect attempt (from 1)
+        :param reconnect: the 'reconnect' parameter, e.g.
+                          {'delay': 1, 'max_delay': 60, 'attempts': 0}
+        :return: seconds to wait
+        """
+        reconnect = reconnect or {}
+        ceiling = min(reconnect.get('max_delay', 60),
+                      reconnect.get('delay', 1) * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+
+    def disconnect(self):
+        """
+        Drops the connection(s) and everything that belongs to them: the
+        unacknowledged messages will be delivered again by the broker
+
+        :return: no return
+        """
+        for connection in (self.connection, self.fwd_connection):
+            try:
+                if connection is not None and connection.is_open:
+                    connection.close()
+            except Exception:
+                pass
+        self.connection = self.channel = self.tx_channel = None
+        self.fwd_connection = self.fwd_channel = self.fwd_tx_channel = None
+        self.batch = []
+        self.batch_timer = None
+        self.generation += 1
+
+
+class AsyncRabbitMQWorker(RabbitMQWorker):
+    """
+    Worker running on the tornado IOLoop. The process_payload may be
+    a coroutine (decorated with tornado.gen.coroutine) and up to
+    'max_in_flight' messages are processed concurrently; each message is
+    acknowledged (or sent to the error queue) once its coroutine finishes.
+    """
+
+    def __init__(self, params=None):
+        super(AsyncRabbitMQWorker, self).__init__(params)
+        self.max_in_flight = self.params.get('max_in_flight', 10)
+        self.in_flight = 0
+        self.ioloop = None
+        self._declare = []
+
+    def connect(self, url, confirm_delivery=False):
+        """
+        Opens the connection on a new IOLoop; the channel is set up (and
+        the consuming started) by callbacks once the IOLoop runs
+
+        :param url: URI of the RabbitMQ instance
+        :param confirm_delivery: not supported by the asynchronous worker
+        :return: no return
+        """
+
+        if confirm_delivery:
+            self.logger.warning('Delivery confirmation is not supported by '
+                                'the asynchronous worker')
+        if self.params.get('forwarding'):
+            raise Exception('Forwarding is not supported by the asynchronous worker')
+
+        try:
+            self.ioloop = ioloop.IOLoop()
+            self.connection = TornadoConnection(
+                pika.URLParameters(url),
+                on_open_callback=self.on_connection_open,
+                on_open_error_callback=self.on_connection_error,
+                stop_ioloop_on_close=True,
+                custom_ioloop=self.ioloop)
+            return True
+        except:
+            self.logger.error(sys.exc_info())
+            raise Exception(sys.exc_info())
+
+    def on_connection_open(self, connection):
+        """Called by pika when the connection is ready"""
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_error(self, connection, error=None):
+        """Called by pika when the connection cannot be opened"""
+        self.logger.error('Cannot connect: {0}'.format(error))
+        self.ioloop.stop()
+
+    def on_channel_open(self, channel):
+        """Sets the prefetch and checks the queues exist"""
+        self.channel = channel
+        self._declare = [self.params[x] for x in ('publish', 'subscribe')
+                         if self.params.get(x)]
+        channel.basic_qos(self.on_queue_declared,
+                          prefetch_count=self.max_in_flight)
+
+    def on_queue_declared(self, frame=None):
+        """Declares the next queue, starts consuming when all are there"""
+        if self._declare:
+            self.channel.queue_declare(self.on_queue_declared,
+                                       queue=self._declare.pop(0),
+                                       passive=True)
+        else:
+            self.subscribe(self.on_message)
+
+    def subscribe(self, callback, **kwargs):
+        """
+        Starts consuming from the queue; the messages are delivered by the
+        IOLoop which is started by run()
+
+        :param callback: the function called by the worker when it consumes
+        :param kwargs: extra keyword arguments
+        :return: no return
+        """
+
+        if self.params.get('subscribe'):
+            self.logger.debug('Subscribing to: {0}'.format(self.params['subscribe']))
+            self.consumer_tag = self.channel.basic_consume(
+                callback, queue=self.params['subscribe'], **kwargs)
+
+    def drain(self, os_signal=None, frame=None):
+        """
+        Stops consuming and closes the connection (which ends run()) once
+        the messages in flight are finished; safe to call from a signal
+        handler or from another thread
+
+        :return: no return
+        """
+        self.draining = True
+        if self.ioloop is None:
+            return
+        if os_signal is not None:
+            self.ioloop.add_callback_from_signal(self.on_drain)
+        else:
+            self.ioloop.add_callback(self.on_drain)
+
+    def on_drain(self):
+        """Cancels the consumer, then waits for the messages in flight"""
+        if self.consumer_tag is not None and self.channel is not None:
+            self.logger.info('Draining: consuming stopped, {0} messages in '
+                             'flight'.format(self.in_flight))
+            self.channel.basic_cancel(consumer_tag=self.consumer_tag)
+            self.consumer_tag = None
+        if self.in_flight:
+            self.ioloop.call_later(DRAIN_CHECK_INTERVAL, self.on_drain)
+        elif self.connection is not None and self.connection.is_open:
+            self.logger.info('Drained')
+            self.connection.close()
+
+    def on_message(self, channel, method_frame, header_frame, body):
+        """
+        Starts processing of the message and returns immediately; the
+        message is acknowledged when the processing finishes
+
+        :param channel: the channel instance for the connected queue
+        :param method_frame: contains delivery information of the packet
+        :param header_frame: contains header information of the packet
+        :param body: contains the message inside the packet
+        :return: tornado Future of the processing
+        """
+
+        received = time.time()
+        try:
+            message = self.decode(body, header_frame)
+        except Exception, e:
+            self.undecodable(body, e, header_frame=header_frame)
+            self.channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+            if self.draining:
+                self.drained += 1
+            future = Future()
+            future.set_result(None)
+            return future
+        self.in_flight += 1
+        self.logger.debug('Running on message (%s in flight)', self.in_flight)
+        try:
+            future = self.process_payload(message,
+                                          channel=channel,
+                                          method_frame=method_frame,
+                                          header_frame=header_frame)
+        except Exception, e:
+            future = Future()
+            future.set_exc_info(sys.exc_info())
+
+        if not is_future(future):
+            result, future = future, Future()
+            future.set_result(result)
+
+        self.ioloop.add_future(future, lambda f: self.on_payload_done(
+                                    f, message, method_frame, header_frame,
+                                    received))
+        return future
+
+    def on_payload_done(self, future, message, method_frame, header_frame,
+                        received=None):
+        """Offloads failed messages and acknowledges the delivery"""
+        self.in_flight -= 1
+        received = received or time.time()
+        self.metrics.processing.observe(time.time() - received)
+        if future.exception() is not None:
+            self.metrics.error.inc()
+            trace = ''.join(traceback.format_exception(*future.exc_info())) \
+                if future.exc_info() else None
+            self.offload(message, future.exception(), header_frame=header_frame,
+                         trace=trace)
+        else:
+            self.metrics.ok.inc()
+            self.results = future.result()
+
+        # Send delivery acknowledgement
+        self.channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+        self.metrics.ack.observe(time.time() - received)
+        if self.draining:
+            self.drained += 1
+
+    def run(self):
+        """
+        Connects the worker to the RabbitMQ instance and runs the IOLoop
+        until the connection is closed
+        :return: no return
+        """
+
+        profiling.install(self.__class__.__name__)
+        self.install_drain_handler()
         self.connect(self.params['RABBITMQ_URL'])
-        self.subscribe(self.on_message)
\ No newline at end of file
+        if not self.params.get('TEST_RUN', False):
+            self.ioloop.start()
@@ -0,0 +1,457 @@
+"""
+In-memory stand-in for RabbitMQ: a broker that lives inside the process
+and a MemoryConnection implementing the part of pika's
+BlockingConnection/BlockingChannel the project uses - exchanges (direct,
+fanout, topic) and bindings, queues, publish (with confirms and
+transactions), basic_consume, basic_get, ack/nack/reject, prefetch, purge,
+per-queue and per-message TTL and dead-lettering.
+
+Anything connected to a memory:// url (workers, the TaskMaster, MiniRabbit)
+uses it, so the functional tests and benchmarks run without RabbitMQ,
+e.g. RABBITMQ_URL = 'memory://' in local_config.py. The workers have to
+run as threads of the same process (the TaskMaster starts them so).
+"""
+
+from .emulation import EmulatedChannel, EmulatedConnection
+import collections
+import copy
+import itertools
+import pika
+import threading
+import time
+
+
+MEMORY_URL = 'memory://'
+
+
+def is_memory(url):
+    """
+    :param url: URI of the broker
+    :return: True if the url is served by the in-memory broker
+    """
+    return bool(url) and url.startswith(MEMORY_URL)
+
+
+def topic_matches(pattern, routing_key):
+    """
+    AMQP topic matching: '*' is exactly one word, '#' zero or more words
+
+    :param pattern: binding key, e.g. ads.*.error or ads.#
+    :param routing_key: routing key of the message
+    :return: bool
+    """
+    def match(p, k):
+        if not p:
+            return not k
+        if p[0] == '#':
+            return any(match(p[1:], k[i:]) for i in range(len(k) + 1))
+        if not k:
+            return False
+        return (p[0] == '*' or p[0] == k[0]) and match(p[1:], k[1:])
+    return match(pattern.split('.'), routing_key.split('.'))
+
+
+class Message(object):
+
+    def __init__(self, exchange, routing_key, body, properties, expires=None):
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.body = body
+        self.properties = properties
+        self.expires = expires
+        self.redelivered = False
+
+
+class MemoryQueue(object):
+
+    def __init__(self, name, durable=False, arguments=None):
+        self.name = name
+        self.durable = durable
+        self.arguments = arguments or {}
+        self.messages = collections.deque()
+        self.consumers = []
+
+    def put(self, message, now=None):
+        ttl = self.arguments.get('x-message-ttl')
+        expiration = getattr(message.properties, 'expiration', None)
+        if expiration is not None:
+            ttl = min(int(expiration), ttl) if ttl is not None \
+                else int(expiration)
+        if ttl is not None:
+            message.expires = (now or time.time()) + ttl / 1000.0
+        self.messages.append(message)
+
+
+class Broker(object):
+    """
+    The exchanges, queues and bindings shared by all the memory connections
+    of the process. Everything happens under one lock; connections waiting
+    for messages are woken up through its condition.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition(threading.RLock())
+        self.reset()
+
+    def reset(self):
+        """Drops all the exchanges, queues and messages"""
+        with self.condition:
+            # exchange name -> (type, list of (queue, binding key))
+            self.exchanges = {'': ('direct', []), 'amq.topic': ('topic', [])}
+            self.queues = {}
+            self.counter = itertools.count(1)
+
+    def route(self, exchange, routing_key):
+        """
+        :return: list of queue names the message goes to
+        """
+        if not exchange:
+            return [routing_key] if routing_key in self.queues else []
+        if exchange not in self.exchanges:
+            return []
+        kind, bindings = self.exchanges[exchange]
+        names = []
+        for queue, key in bindings:
+            if kind == 'fanout' or (kind == 'topic' and
+                                    topic_matches(key, routing_key)) or \
+                    (kind != 'topic' and key == routing_key):
+                if queue not in names:
+                    names.append(queue)
+        return names
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """
+        :return: number of queues the message was routed to
+        """
+        with self.condition:
+            names = self.route(exchange or '', routing_key)
+            for name in names:
+                self.queues[name].put(Message(exchange or '', routing_key, body,
+                                              properties))
+            if names:
+                self.condition.notify_all()
+            return len(names)
+
+    def dead_letter(self, queue, message):
+        """Sends an expired or rejected message where the queue says"""
+        exchange = queue.arguments.get('x-dead-letter-exchange')
+        if exchange is None:
+            return
+        properties = message.properties
+        if properties is not None and properties.expiration is not None:
+            properties = copy.copy(properties)
+            properties.expiration = None
+        self.publish(exchange,
+                     queue.arguments.get('x-dead-letter-routing-key',
+                                         message.routing_key),
+                     message.body, properties)
+
+    def expire(self, now=None):
+        """
+        Dead-letters the expired messages from the heads of the queues
+
+        :return: when the next message expires (or None)
+        """
+        now = now or time.time()
+        upcoming = None
+        with self.condition:
+            for queue in self.queues.values():
+                while queue.messages and queue.messages[0].expires is not None \
+                        and queue.messages[0].expires <= now:
+                    self.dead_letter(queue, queue.messages.popleft())
+                if queue.messages and queue.messages[0].expires is not None:
+                    upcoming = min(upcoming or queue.messages[0].expires,
+                                   queue.messages[0].expires)
+        return upcoming
+
+
+broker = Broker()
+
+
+def reset():
+    """Empties the in-memory broker"""
+    broker.reset()
+
+
+def closes_channel(method):
+    """Errors close the channel, as they do on a real broker"""
+    def wrapper(self, *args, **kwargs):
+        if not self.is_open:
+            raise pika.exceptions.ChannelClosed(504, 'CHANNEL_ERROR - closed')
+        try:
+            return method(self, *args, **kwargs)
+        except pika.exceptions.ChannelClosed:
+            self.close()
+            raise
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class MemoryChannel(EmulatedChannel):
+    """
+    Channel of the in-memory broker, see pika.BlockingChannel
+    """
+
+    def __init__(self, connection, channel_number):
+        super(MemoryChannel, self).__init__(connection, channel_number)
+        self.consumers = {}
+        self.unacked = collections.OrderedDict()
+        self.pending = []
+
+    def get_queue(self, name):
+        if name not in broker.queues:
+            raise pika.exceptions.ChannelClosed(
+                404, "NOT_FOUND - no queue '{0}'".format(name))
+        return broker.queues[name]
+
+    @closes_channel
+    def exchange_declare(self, exchange=None, exchange_type='direct',
+                         passive=False, durable=False, auto_delete=False,
+                         internal=False, arguments=None, **kwargs):
+        exchange_type = kwargs.get('type', exchange_type)
+        with broker.condition:
+            if exchange not in broker.exchanges:
+                if passive:
+                    raise pika.exceptions.ChannelClosed(
+                        404, "NOT_FOUND - no exchange '{0}'".format(exchange))
+                broker.exchanges[exchange] = (exchange_type, [])
+        return self.method(pika.spec.Exchange.DeclareOk())
+
+    @closes_channel
+    def exchange_delete(self, exchange=None, if_unused=False):
+        with broker.condition:
+            if if_unused and broker.exchanges.get(exchange, (None, []))[1]:
+                raise pika.exceptions.ChannelClosed(
+                    406, "PRECONDITION_FAILED - exchange '{0}' in use".format(
+                        exchange))
+            broker.exchanges.pop(exchange, None)
+        return self.method(pika.spec.Exchange.DeleteOk())
+
+    @closes_channel
+    def queue_declare(self, queue='', passive=False, durable=False,
+                      exclusive=False, auto_delete=False, arguments=None):
+        with broker.condition:
+            if not queue:
+                queue = 'amq.gen-{0}'.format(next(broker.counter))
+            if queue not in broker.queues:
+                if passive:
+                    self.get_queue(queue)
+                broker.queues[queue] = MemoryQueue(queue, durable, arguments)
+            q = broker.queues[queue]
+            return self.method(pika.spec.Queue.DeclareOk(
+                queue, len(q.messages), len(q.consumers)))
+
+    @closes_channel
+    def queue_delete(self, queue='', if_unused=False, if_empty=False):
+        with broker.condition:
+            q = self.get_queue(queue)
+            del broker.queues[queue]
+            for _, bindings in broker.exchanges.values():
+                bindings[:] = [x for x in bindings if x[0] != queue]
+            return self.method(pika.spec.Queue.DeleteOk(len(q.messages)))
+
+    @closes_channel
+    def queue_purge(self, queue=''):
+        with broker.condition:
+            q = self.get_queue(queue)
+            count = len(q.messages)
+            q.messages.clear()
+            return self.method(pika.spec.Queue.PurgeOk(count))
+
+    @closes_channel
+    def queue_bind(self, queue, exchange, routing_key=None, arguments=None):
+        with broker.condition:
+            self.get_queue(queue)
+            if exchange not in broker.exchanges:
+                raise pika.exceptions.ChannelClosed(
+                    404, "NOT_FOUND - no exchange '{0}'".format(exchange))
+            binding = (queue, routing_key if routing_key is not None else queue)
+            bindings = broker.exchanges[exchange][1]
+            if binding not in bindings:
+                bindings.append(binding)
+        return self.method(pika.spec.Queue.BindOk())
+
+    @closes_channel
+    def queue_unbind(self, queue='', exchange=None, routing_key=None,
+                     arguments=None):
+        with broker.condition:
+            bindings = broker.exchanges.get(exchange, (None, []))[1]
+            binding = (queue, routing_key if routing_key is not None else queue)
+            if binding in bindings:
+                bindings.remove(binding)
+        return self.method(pika.spec.Queue.UnbindOk())
+
+    def tx_commit(self):
+        pending, self.pending = self.pending, []
+        for args in pending:
+            broker.publish(*args)
+        return self.method(pika.spec.Tx.CommitOk())
+
+    def tx_rollback(self):
+        self.pending = []
+        return self.method(pika.spec.Tx.RollbackOk())
+
+    @closes_channel
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      mandatory=False, immediate=False):
+        if exchange and exchange not in broker.exchanges:
+            raise pika.exceptions.ChannelClosed(
+                404, "NOT_FOUND - no exchange '{0}'".format(exchange))
+        body = self.encode_body(body)
+        if self.transactional:
+            self.pending.append((exchange, routing_key, body, properties))
+            return True
+        routed = broker.publish(exchange, routing_key, body, properties)
+        return not (self.confirm and mandatory and not routed)
+
+    @closes_channel
+    def basic_consume(self, consumer_callback, queue, no_ack=False,
+                      exclusive=False, consumer_tag=None, arguments=None):
+        with broker.condition:
+            q = self.get_queue(queue)
+            consumer_tag = consumer_tag or 'ctag{0}.{1}'.format(
+                self.channel_number, next(broker.counter))
+            self.consumers[consumer_tag] = (q, consumer_callback, no_ack)
+            q.consumers.append(consumer_tag)
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag):
+        with broker.condition:
+            q, _, _ = self.consumers.pop(consumer_tag, (None, None, None))
+            if q is not None and consumer_tag in q.consumers:
+                q.consumers.remove(consumer_tag)
+
+    def take(self, q, no_ack):
+        """Takes the first message of the queue (under the broker lock)"""
+        message = q.messages.popleft()
+        self.delivery_tag += 1
+        if not no_ack:
+            self.unacked[self.delivery_tag] = (q, message)
+        return self.delivery_tag, message
+
+    @closes_channel
+    def basic_get(self, queue=None, no_ack=False):
+        broker.expire()
+        with broker.condition:
+            q = self.get_queue(queue)
+            if not q.messages:
+                return None, None, None
+            tag, message = self.take(q, no_ack)
+            method = pika.spec.Basic.GetOk(tag, message.redelivered,
+                                           message.exchange,
+                                           message.routing_key,
+                                           len(q.messages))
+        return method, message.properties or pika.BasicProperties(), \
+            message.body
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        with broker.condition:
+            for tag in self.tags(delivery_tag, multiple):
+                self.unacked.pop(tag, None)
+
+    def basic_nack(self, delivery_tag=None, multiple=False, requeue=True):
+        with broker.condition:
+            tags = self.tags(delivery_tag, multiple)
+            for tag in reversed(tags):
+                if tag not in self.unacked:
+                    continue
+                q, message = self.unacked.pop(tag)
+                if requeue and q.name in broker.queues:
+                    message.redelivered = True
+                    q.messages.appendleft(message)
+                elif not requeue:
+                    broker.dead_letter(q, message)
+            broker.condition.notify_all()
+
+    def tags(self, delivery_tag, multiple):
+        if multiple:
+            return [x for x in self.unacked if x <= (delivery_tag or
+                                                     self.delivery_tag)]
+        return [delivery_tag]
+
+    def ready(self):
+        """
+        :return: True if a consumer has a message waiting (and the
+                 prefetch count allows to deliver it)
+        """
+        if not self.is_open or (self.prefetch_count and
+                                len(self.unacked) >= self.prefetch_count):
+            return False
+        return any(q.messages for q, _, _ in self.consumers.values())
+
+    def deliver(self):
+        """
+        Hands the waiting messages to the consumers, as long as the
+        prefetch count allows
+
+        :return: number of delivered messages
+        """
+        delivered = 0
+        for consumer_tag, (q, callback, no_ack) in self.consumers.items():
+            while self.is_open and consumer_tag in self.consumers:
+                with broker.condition:
+                    if not q.messages or (self.prefetch_count and
+                                          len(self.unacked) >= self.prefetch_count):
+                        break
+                    tag, message = self.take(q, no_ack)
+                self.dispatch(callback, tag, message.exchange,
+                              message.routing_key, message.properties,
+                              message.body, consumer_tag, message.redelivered)
+                delivered += 1
+        return delivered
+
+    def start_consuming(self):
+        while self.consumers and self.is_open:
+            self.connection.process_data_events(time_limit=None)
+
+    def stop_consuming(self, consumer_tag=None):
+        for tag in list(self.consumers):
+            self.basic_cancel(tag)
+
+    def close(self):
+        """Unacknowledged messages go back to their queues"""
+        if not self.is_open:
+            return
+        self.stop_consuming()
+        self.basic_nack(multiple=True, requeue=True)
+        self.is_open = False
+
+
+class MemoryConnection(EmulatedConnection):
+    """
+    Connection to the in-memory broker, see pika.BlockingConnection
+    """
+
+    channel_class = MemoryChannel
+
+    def __init__(self, url=MEMORY_URL):
+        super(MemoryConnection, self).__init__(url)
+
+    def process_data_events(self, time_limit=0):
+        """
+        Delivers messages, runs the timers and expires messages for time_limit
+        seconds; None means until something happened
+
+        :param time_limit: how long to wait (seconds)
+        :return: no return
+        """
+        deadline = None if time_limit is None else time.time() + time_limit
+        while self.is_open:
+            upcoming = broker.expire()
+            events = self.run_timers()
+            for channel in list(self.channels):
+                if channel.is_open:
+                    events += channel.deliver()
+
+            now = time.time()
+            if (deadline is None and events) or \
+                    (deadline is not None and now >= deadline):
+                return
+
+            wake = [x[0] for x in self.timers.values()]
+            wake += [x for x in (deadline, upcoming) if x is not None]
+            with broker.condition:
+                if not any(channel.ready() for channel in self.channels):
+                    broker.condition.wait(
+                        max(0, min(wake) - now) if wake else 1)
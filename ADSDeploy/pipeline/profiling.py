@@ -0,0 +1,235 @@
+"""
+Profiler that can be switched on in a running worker: on SIGUSR1 a thread
+looks at the stacks of all the threads of the process every few
+milliseconds, for a limited time, and writes how often every stack was seen
+into <directory>/<name>.<pid>.prof - one 'frame;frame;...;frame count' line
+per stack, the collapsed format that flamegraph.pl reads.
+
+Sampling (rather than cProfile, which only sees the thread that enabled it)
+covers the thread pool and the IOLoop as well, and costs the worker nothing
+until the signal comes. The TaskMaster passes the signal on to the worker
+processes; merge() sums up their profiles.
+"""
+
+import glob
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import defaultdict
+
+
+PROFILE_SIGNAL = signal.SIGUSR1
+
+LOG_DIR = os.path.join(os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..', '..')), 'logs')
+PROFILE_DIR = os.path.join(LOG_DIR, 'profiles')
+PIDFILE = os.path.join(LOG_DIR, 'pipeline.pid')
+
+# inherited by the worker processes, see configure()
+settings = {'directory': PROFILE_DIR, 'seconds': 30, 'interval': 0.005}
+
+logger = logging.getLogger(__name__)
+
+
+def configure(directory=None, seconds=None, interval=None):
+    """
+    Changes the defaults of the profilers installed from now on (also in
+    the processes forked from now on)
+
+    :param directory: where the profiles are written
+    :param seconds: how long a profile runs
+    :param interval: seconds between two samples
+    :return: no return
+    """
+    for key, value in (('directory', directory), ('seconds', seconds),
+                       ('interval', interval)):
+        if value is not None:
+            settings[key] = value
+
+
+def collapse(frame):
+    """
+    :param frame: the innermost frame of a stack
+    :return: 'file:function;...;file:function', the outermost first
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append('{0}:{1}'.format(code.co_filename, code.co_name))
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class Profiler(object):
+    """
+    Samples the stacks of all the threads (except its own) for <seconds>
+    and writes them into a file named after the worker and the process
+    """
+
+    def __init__(self, name, directory=None, seconds=None, interval=None):
+        self.name = name
+        self.directory = directory or settings['directory']
+        self.seconds = seconds or settings['seconds']
+        self.interval = interval or settings['interval']
+        self.counts = defaultdict(int)
+        self.thread = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, '{0}.{1}.prof'.format(
+                                self.name, os.getpid()))
+
+    def start(self):
+        """
+        Starts profiling, unless a profile is already being taken
+
+        :return: True if it started
+        """
+        if self.running:
+            return False
+        self.counts = defaultdict(int)
+        self.thread = threading.Thread(target=self.run,
+                                       name='profiler-{0}'.format(self.name))
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+    def sample(self):
+        """
+        Counts the current stack of every thread
+
+        :return: no return
+        """
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident != me:
+                self.counts[collapse(frame)] += 1
+
+    def run(self):
+        """
+        Samples until the time is up, then writes the profile
+
+        :return: no return
+        """
+        logger.info('Profiling {0} (pid {1}) for {2}s'.format(
+                        self.name, os.getpid(), self.seconds))
+        deadline = time.time() + self.seconds
+        while time.time() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+        logger.info('Profile written to {0}'.format(self.write()))
+
+    def write(self):
+        """
+        :return: path of the profile
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        write_collapsed(self.counts, self.path)
+        return self.path
+
+
+def install(name, forward=None):
+    """
+    Makes PROFILE_SIGNAL start a profile of this process. Signal handlers
+    belong to the main thread of a process, a worker running in a thread
+    is profiled by the profiler of its process.
+
+    :param name: name of the profile, e.g. the worker class
+    :param forward: function returning the pids the signal is passed on to
+    :return: the Profiler, None if not called from the main thread
+    """
+    profiler = Profiler(name)
+    pid = os.getpid()
+
+    def handler(signum, frame):
+        profiler.start()
+        # a forked child may run this handler until it installs its own
+        if forward is not None and os.getpid() == pid:
+            for child in forward():
+                try:
+                    os.kill(child, signum)
+                except OSError:
+                    pass
+
+    try:
+        signal.signal(PROFILE_SIGNAL, handler)
+    except ValueError:
+        return None
+    return profiler
+
+
+def write_collapsed(counts, path):
+    """
+    Writes {stack: count} in the collapsed format, the most frequent first
+
+    :return: no return
+    """
+    with open(path, 'w') as f:
+        for stack, count in sorted(counts.items(), key=lambda x: -x[1]):
+            f.write('{0} {1}\n'.format(stack, count))
+
+
+def read_collapsed(path):
+    """
+    :return: {stack: count}
+    """
+    counts = defaultdict(int)
+    with open(path) as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                counts[stack] += int(count)
+    return counts
+
+
+def collect(directory=None, since=0):
+    """
+    :param directory: where the profiles are
+    :param since: only the profiles written after this time
+    :return: list of paths
+    """
+    pattern = os.path.join(directory or settings['directory'], '*.*.prof')
+    return sorted(x for x in glob.glob(pattern)
+                  if os.path.getmtime(x) >= since)
+
+
+def merge(paths):
+    """
+    Sums up the profiles
+
+    :param paths: list of profiles
+    :return: {stack: count}
+    """
+    counts = defaultdict(int)
+    for path in paths:
+        for stack, count in read_collapsed(path).iteritems():
+            counts[stack] += count
+    return counts
+
+
+def summary(counts, top=20):
+    """
+    Where the time goes: 'self' counts the samples in which a function was
+    running, 'total' those in which it was on the stack
+
+    :param counts: {stack: count}
+    :param top: number of functions
+    :return: list of (function, self, total), the most expensive first
+    """
+    own = defaultdict(int)
+    total = defaultdict(int)
+    for stack, count in counts.iteritems():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            total[frame] += count
+    ranked = sorted(total, key=lambda x: (-own[x], -total[x]))
+    return [(x, own[x], total[x]) for x in ranked[:top]]
@@ -8,12 +8,18 @@ Pipeline to extract full text documents. It carries out the following:
 """
 
 
-from ADSDeploy import app
-from ADSDeploy.pipeline import generic
-from ADSDeploy.utils import setup_logging
+from ADSDeploy import app, metrics
+from ADSDeploy.pipeline import generic, memory, profiling, transports
+from ADSDeploy.utils import setup_logging, configure_logging
 from copy import deepcopy
+import errno
+import fcntl
+import importlib
+import math
 import multiprocessing
 import os
+import random
+import select
 import signal
 import sys
 import threading
@@ -23,6 +29,104 @@ import time
 logger = setup_logging(os.path.abspath(os.path.join(__file__, '..')), __name__)
 
 
+# worker classes by their names in the WORKERS config, see register()
+registry = {}
+
+
+def register(name=None):
+    """
+    Class decorator that makes a worker class known under <name> (its
+    class name by default), wherever it is defined
+
+    :param name: name to use in the WORKERS config
+    :return: the decorator
+    """
+    def decorator(cls):
+        registry[name or cls.__name__] = cls
+        return cls
+    return decorator
+
+
+def get_worker_class(name):
+    """
+    Finds the worker class from its name in the WORKERS config; the name
+    is a registered name, 'module.Class' (a module of ADSDeploy.pipeline)
+    or a full dotted path. The class is remembered in the registry, the
+    module is imported only once.
+
+    :param name: name of the worker class, e.g. errors.ErrorHandler
+    :return: the worker class
+    """
+
+    if name in registry:
+        return registry[name]
+
+    if '.' not in name:
+        cls = getattr(generic, name)
+    else:
+        module, cls = name.rsplit('.', 1)
+        try:
+            module = importlib.import_module('ADSDeploy.pipeline.{0}'.format(module))
+        except ImportError:
+            module = importlib.import_module(module)
+        cls = getattr(module, cls)
+    registry[name] = cls
+    return cls
+
+
+def after_fork():
+    """
+    Runs in a freshly forked worker process: re-creates what must not be
+    shared with the master (the database connections, the random state -
+    the workers would otherwise all pick the same reconnect delays) and
+    drops the signal handlers of the master, a SIGTERM that comes before
+    the worker installs its own must not run TaskMaster.quit()
+
+    :return: no return
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    random.seed()
+    app.after_fork()
+
+
+def run_worker(cls, params, name=None, report=None):
+    """
+    Target of a worker process: the process is a fork of the master, with
+    the modules imported and the config loaded; only the worker itself is
+    made here
+
+    :param cls: worker class
+    :param params: parameters of the worker
+    :param name: name of the worker in the WORKERS config
+    :param report: file descriptor where a drained worker reports how many
+                   messages it finished, see report_drained()
+    :return: no return
+    """
+    after_fork()
+    worker = cls(params)
+    worker.run()
+    report_drained(report, name, worker)
+
+
+def report_drained(report, name, worker):
+    """
+    Tells the TaskMaster how many messages the worker finished after it
+    was asked to stop; a line this short is written atomically, without
+    any lock a killed worker could leave behind
+
+    :param report: write end of the TaskMaster's pipe (or None)
+    :param name: name of the worker in the WORKERS config
+    :param worker: the worker that returned from run()
+    :return: no return
+    """
+    if report is not None and getattr(worker, 'draining', False):
+        try:
+            os.write(report, '{0} {1}\n'.format(name, worker.drained))
+        except OSError:
+            pass
+
+
 class Singleton(object):
     """
     Singleton type class. Collates a list of the class instances.
@@ -37,13 +141,38 @@ class Singleton(object):
         return cls._instances[cls]
 
 
+# how the TaskMaster restarts a worker that crashed within 'min_uptime'
+# seconds of its start, see TaskMaster.worker_exited()
+RESTART_BACKOFF = {'delay': 1, 'max_delay': 60, 'min_uptime': 10}
+
+# how the TaskMaster sizes the workers that have a 'max_concurrency', see
+# TaskMaster.autoscale(): every 'interval' seconds it looks at the depth of
+# their queues; with more than 'up_depth' messages per worker it starts
+# enough workers for 'up_depth' each, with fewer than 'down_depth' (and a
+# queue that is not growing) it drains 'step' of them. Scaling up again is
+# allowed after 'up_cooldown', down after 'down_cooldown' seconds
+AUTOSCALE = {'interval': 30, 'up_depth': 100, 'down_depth': 10,
+             'up_cooldown': 60, 'down_cooldown': 300, 'step': 1}
+
+
+def new_stats():
+    """
+    :return: the supervision statistics of a worker class
+    """
+    return {'restarts': 0, 'failures': 0, 'next_start': 0, 'dead_since': [],
+            'last_latency': None, 'drained': 0, 'last_scaled': 0,
+            'depth': None}
+
+
 class TaskMaster(Singleton):
     """
     Class that starts, stops, and controls the workers that connect to the
     RabbitMQ instance running
     """
 
-    def __init__(self, rabbitmq_url, exchange, rabbitmq_routes, workers):
+    def __init__(self, rabbitmq_url, exchange, rabbitmq_routes, workers,
+                 backoff=None, drain_timeout=30, ttl_jitter=0.1,
+                 autoscale=None):
         """
         Initialisation function (constructor) of the class
 
@@ -51,6 +180,14 @@ class TaskMaster(Singleton):
         :param exchange: the name of the main exchange
         :param rabbitmq_routes: list of routes that should exist
         :param workers: list of workers that should be started
+        :param backoff: how a crashing worker is restarted, e.g.
+                        {'delay': 1, 'max_delay': 60, 'min_uptime': 10}
+        :param drain_timeout: seconds a stopped worker has to finish its
+                              messages before it is killed
+        :param ttl_jitter: the time to live of every worker is longer or
+                           shorter by up to this fraction
+        :param autoscale: how the workers with a 'max_concurrency' are
+                          scaled, see AUTOSCALE
         :return: no return
         """
         self.rabbitmq_url = rabbitmq_url
@@ -58,6 +195,23 @@ class TaskMaster(Singleton):
         self.rabbitmq_routes = deepcopy(rabbitmq_routes)
         self.workers = deepcopy(workers)
         self.running = False
+        self.backoff = dict(RESTART_BACKOFF, **(backoff or {}))
+        self.drain_timeout = drain_timeout
+        self.ttl_jitter = ttl_jitter
+        self.stats = dict((worker, new_stats()) for worker in self.workers)
+        # written to when a worker exits, see watch()
+        self.wakeup = None
+        # the drained workers report to it, see report_drained()
+        self.reports = None
+        self.autoscaling = dict(AUTOSCALE, **(autoscale or {}))
+        self.next_autoscale = 0
+        # connection the queue depths are read from, see queue_depth()
+        self.monitor = None
+        for params in self.workers.values():
+            if params.get('max_concurrency'):
+                params['concurrency'] = self.bounded(
+                    params, params.get('concurrency',
+                                       params.get('min_concurrency', 1)))
 
     def quit(self, os_signal, frame):
         """
@@ -85,13 +239,33 @@ class TaskMaster(Singleton):
     def initialize_rabbitmq(self):
         """
         Sets up the correct routes, exchanges, and bindings on the RabbitMQ
-        instance
+        instance; the queues of workers with 'transport': 'local' are
+        created in the local transport instead (before the workers start,
+        so that the worker processes inherit them)
 
         :return: no return
         """
 
+        local = dict((name, params) for name, params in self.workers.items()
+                     if params.get('transport') == 'local')
+        remote = dict((name, params) for name, params in self.workers.items()
+                      if name not in local)
+
+        self.declare_queues(self.rabbitmq_url, remote)
+        if local:
+            self.declare_queues(transports.LOCAL_URL, local)
+
+    def declare_queues(self, url, workers):
+        """
+        Declares the exchange, the routes and the queues of the workers
+
+        :param url: URI of the RabbitMQ instance (or local://)
+        :param workers: dictionary of workers (name: params)
+        :return: no return
+        """
+
         w = generic.RabbitMQWorker()
-        w.connect(self.rabbitmq_url)
+        w.connect(url)
         
         # make sure the exchange is there
         w.channel.exchange_declare(
@@ -119,7 +293,7 @@ class TaskMaster(Singleton):
                     exchange=self.exchange, 
                     routing_key=qvals['routing_key'] or qname)
             
-        for worker in self.workers.values():
+        for worker in workers.values():
             if worker.get('subscribe', None):
                 qname = worker['subscribe']
                 if qname not in queues:
@@ -138,6 +312,22 @@ class TaskMaster(Singleton):
                     exchange=self.exchange, 
                     routing_key=qname)
                 
+                # delayed retries are dead-lettered back to the queue
+                for retry_queue, ttl in sorted(set(
+                        tier for tiers in generic.get_retry_queues(worker)
+                        for tier in tiers)):
+                    w.channel.queue_declare(
+                            queue=retry_queue,
+                            durable=queues[qname],
+                            passive=False,
+                            exclusive=False,
+                            auto_delete=False,
+                            arguments={
+                                'x-message-ttl': ttl,
+                                'x-dead-letter-exchange': self.exchange,
+                                'x-dead-letter-routing-key': qname,
+                            })
+
             if worker.get('publish', None):
                 qname = worker['publish']
                 if qname not in queues:
@@ -162,41 +352,205 @@ class TaskMaster(Singleton):
     def poll_loop(self, poll_interval=60, ttl=7200,
                   extra_params=False):
         """
-        Starts all of the workers connecting and consuming to the queue. It then
-        continually polls the workers to ensure that the correct number exists,
-        in case one has died.
+        Starts all of the workers connecting and consuming to the queue. It
+        then waits for a worker to exit (or for the next worker to reach its
+        time to live) and starts its replacement straight away; a worker that
+        keeps crashing is restarted with an increasing delay.
 
-        :param poll_interval: how often to poll
+        :param poll_interval: the longest wait between two checks
         :param ttl: time to live, how long before it tries to restart workers
         :param extra_params: other parameters
         :return: no return
         """
 
+        self.watch()
         while self.running:
 
-            time.sleep(poll_interval)
-            for worker, params in self.workers.iteritems():
-                for active in params['active']:
-                    if not active['proc'].is_alive():
+            self.wait(self.next_check(poll_interval, ttl))
+            self.reap_workers(ttl)
+            self.autoscale()
+            self.start_workers(verbose=False, extra_params=extra_params)
 
-                        logger.debug('{0} is not alive, restarting: {1}'.format(
+    def watch(self):
+        """
+        Makes the exit of a worker wake up the loop: a worker process ends
+        with SIGCHLD, a worker thread writes into the pipe itself. (The
+        processes are not waited for here, is_alive() does that.)
+
+        :return: no return
+        """
+        if self.wakeup is None:
+            self.wakeup = os.pipe()
+            for fd in self.wakeup:
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, self.on_worker_exit)
+        # other system calls of this process are resumed, not interrupted
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def on_worker_exit(self, os_signal=None, frame=None):
+        """
+        Wakes up the loop
+
+        :return: no return
+        """
+        if self.wakeup is not None:
+            try:
+                os.write(self.wakeup[1], 'x')
+            except OSError:
+                pass  # the pipe is full, the loop is being woken up anyway
+
+    def wait(self, timeout):
+        """
+        Waits until a worker exits or <timeout> seconds pass
+
+        :return: no return
+        """
+        try:
+            ready = select.select([self.wakeup[0]], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = [self.wakeup[0]]
+        if ready:
+            try:
+                while os.read(self.wakeup[0], 4096):
+                    pass
+            except OSError:
+                pass
+
+    def next_check(self, poll_interval, ttl=0):
+        """
+        :return: seconds until a worker reaches its time to live, a
+                 delayed restart or the autoscaler is due (at most
+                 <poll_interval>)
+        """
+        now = time.time()
+        due = [now + poll_interval]
+        if self.autoscaled():
+            due.append(self.next_autoscale)
+        for worker, params in self.workers.iteritems():
+            if self.stats[worker]['dead_since']:
+                due.append(self.stats[worker]['next_start'])
+            for active in params.get('active', []):
+                if active.get('abandoned'):
+                    continue  # its exit wakes up the loop
+                if active.get('draining'):
+                    due.append(active['draining'])
+                elif ttl:
+                    due.append(self.expires(active, ttl))
+        return max(0, min(due) - now)
+
+    def expires(self, active, ttl):
+        """
+        :return: when the worker reaches its (jittered) time to live
+        """
+        return active['start'] + ttl * active.get('ttl_factor', 1)
+
+    def worker_exited(self, worker, active):
+        """
+        Books a dead worker: the replacement of one that died young is
+        delayed by delay * 2**(n - 1) seconds (at most max_delay) after the
+        n-th crash in a row; the first one is replaced immediately
+
+        :param worker: name of the worker class
+        :param active: the entry of the worker in its 'active' list
+        :return: no return
+        """
+        stats = self.stats[worker]
+        now = time.time()
+        if now - active['start'] < self.backoff['min_uptime']:
+            stats['failures'] += 1
+        else:
+            stats['failures'] = 0
+        delay = 0
+        if stats['failures'] > 1:
+            delay = min(self.backoff['max_delay'],
+                        self.backoff['delay'] * 2 ** (stats['failures'] - 2))
+            logger.warning('{0} keeps crashing ({1} times in a row), '
+                           'restarting in {2}s'.format(worker,
+                                                       stats['failures'],
+                                                       delay))
+        stats['next_start'] = max(stats['next_start'], now + delay)
+        stats['dead_since'].append(now)
+
+    def reap_workers(self, ttl=0):
+        """
+        Forgets the workers that died and stops those that lived longer
+        than <ttl>; start_workers() replaces them. A thread that does not
+        drain in time cannot be killed: it stays in 'active', abandoned,
+        until it exits
+
+        :param ttl: time to live in seconds, 0 = forever
+        :return: no return
+        """
+        self.read_reports()
+        for worker, params in self.workers.iteritems():
+            for active in list(params.get('active', [])):
+                if not active['proc'].is_alive() or active.get('exited'):
+
+                    active['proc'].join()
+                    params['active'].remove(active)
+                    if active.get('draining'):
+                        logger.debug('{0} drained: {1}'.format(
                             active['proc'], worker))
-                        if hasattr(active['proc'], 'terminate'):
-                            active['proc'].terminate()
-                        active['proc'].join()
-                        if not active['proc'].is_alive():
-                            params['active'].remove(active)
+                    else:
+                        logger.debug('{0} is not alive, restarting: {1}'
+                                     .format(active['proc'], worker))
+                        self.worker_exited(worker, active)
+                    continue
+                if active.get('draining'):
+                    if active.get('abandoned'):
+                        continue
+                    if time.time() <= active['draining']:
                         continue
-                    if ttl:
-                        if time.time()-active['start'] > ttl:
-                            logger.debug('time to live reached')
-                            if hasattr(active['proc'], 'terminate'):
-                                active['proc'].terminate()
-                            active['proc'].join()
-                            active['proc'].is_alive()
-                            params['active'].remove(active)
+                    if 'worker' in active:
+                        logger.warning('{0} did not drain in time, it counts '
+                                       'against the concurrency until it '
+                                       'exits: {1}'.format(active['proc'],
+                                                           worker))
+                        active['abandoned'] = True
+                        continue
+                    logger.warning('{0} did not drain in time, killing: '
+                                   '{1}'.format(active['proc'], worker))
+                    self.kill_worker(active)
+                    params['active'].remove(active)
+                    continue
+                if ttl and time.time() > self.expires(active, ttl):
+                    logger.debug('time to live reached, draining {0}: '
+                                 '{1}'.format(active['proc'], worker))
+                    self.drain_worker(active)
+
+    def drain_worker(self, active, timeout=None):
+        """
+        Asks a worker to finish its messages and exit (a process gets
+        SIGTERM); it no longer counts as running, start_workers() starts
+        its replacement straight away
 
-            self.start_workers(verbose=False, extra_params=extra_params)
+        :param active: the entry of the worker in its 'active' list
+        :param timeout: seconds it has before it is killed
+        :return: no return
+        """
+        active['draining'] = time.time() + (timeout or self.drain_timeout)
+        if 'worker' in active:
+            active['worker'].drain()
+        elif active['proc'].is_alive():
+            active['proc'].terminate()
+
+    def kill_worker(self, active):
+        """
+        Kills a worker process (a thread cannot be killed, it is left to
+        finish on its own)
+
+        :param active: the entry of the worker in its 'active' list
+        :return: no return
+        """
+        if hasattr(active['proc'], 'pid') and active['proc'].is_alive():
+            try:
+                os.kill(active['proc'].pid, signal.SIGKILL)
+            except OSError:
+                pass
+            active['proc'].join()
 
     def start_workers(self, verbose=True, extra_params=False):
         """
@@ -212,6 +566,8 @@ class TaskMaster(Singleton):
             logger.debug('Starting worker: {0}'.format(worker))
             params['active'] = params.get('active', [])
             params['RABBITMQ_URL'] = self.rabbitmq_url
+            if params.get('transport') == 'local':
+                params['RABBITMQ_URL'] = transports.LOCAL_URL
             params['exchange'] = self.exchange
             
             if isinstance(extra_params, dict):
@@ -222,14 +578,33 @@ class TaskMaster(Singleton):
                     params[par] = extra_params[par]
             
             conc = params.get('concurrency', 1)
-            while len(params['active']) < conc:
-                w = eval('{0}'.format(worker))(params)
-                
-                # decide if we want to run it multiprocessing
-                if conc > 1:
-                    process = multiprocessing.Process(target=w.run)
+            # imported once, here, not in every worker process
+            cls = get_worker_class(worker)
+            stats = self.stats.setdefault(worker, new_stats())
+            # the draining workers are on their way out, the abandoned
+            # threads may never be
+            missing = conc - len([x for x in params['active']
+                                  if not x.get('draining') or
+                                  x.get('abandoned')])
+            if missing > 0 and stats['next_start'] > time.time():
+                continue  # crash looping, wait for the backoff
+            for i in range(missing):
+                active = {'start': time.time(),
+                          'ttl_factor': random.uniform(1 - self.ttl_jitter,
+                                                       1 + self.ttl_jitter)}
+                # decide if we want to run it multiprocessing (the in-memory
+                # broker is only seen by threads of this process); a process
+                # is forked from this one and makes its worker itself
+                if max(conc, params.get('max_concurrency', 1)) > 1 and \
+                        not memory.is_memory(params['RABBITMQ_URL']):
+                    process = multiprocessing.Process(
+                        target=run_worker,
+                        args=(cls, params, worker, self.report_fd()))
                 else:
-                    process = threading.Thread(target=w.run, args=())
+                    active['worker'] = cls(params)
+                    process = threading.Thread(
+                        target=self.run_thread,
+                        args=(worker, active['worker'], active))
                 
                 process.daemon = True
                 process.start()
@@ -237,24 +612,270 @@ class TaskMaster(Singleton):
                 if verbose:
                     logger.debug('Started {0}-{1}'.format(worker, process.name))
 
-                params['active'].append({
-                    'proc': process,
-                    'start': time.time(),
-                })
+                active['proc'] = process
+                params['active'].append(active)
+
+                if stats['dead_since']:
+                    latency = time.time() - stats['dead_since'].pop(0)
+                    stats['restarts'] += 1
+                    stats['last_latency'] = latency
+                    metrics.RESTARTS.labels(worker).inc()
+                    metrics.RESTART_LATENCY.labels(worker).observe(latency)
+                    logger.info('Restarted {0} in {1:.3f}s ({2} restarts)'
+                                .format(worker, latency, stats['restarts']))
 
             logger.debug('Successfully started: {0}'.format(
                 len(params['active'])))
 
         self.running = True
 
-    def stop_workers(self):
+    def run_thread(self, name, worker, active):
         """
-        Stops the workers. Currently it does nothing as closing the main process
-        should gracefully clean up each daemon process.
+        Runs a worker in a thread and wakes up the loop when it is done
 
+        :param name: name of the worker in the WORKERS config
+        :param worker: the worker
+        :param active: the entry of the worker in its 'active' list
         :return: no return
         """
-        pass
+        try:
+            worker.run()
+            report_drained(self.report_fd(), name, worker)
+        finally:
+            active['exited'] = True
+            self.on_worker_exit()
+
+    def report_fd(self):
+        """
+        :return: the write end of the pipe the drained workers report to
+        """
+        if self.reports is None:
+            self.reports = os.pipe()
+            fcntl.fcntl(self.reports[0], fcntl.F_SETFL,
+                        fcntl.fcntl(self.reports[0], fcntl.F_GETFL) |
+                        os.O_NONBLOCK)
+        return self.reports[1]
+
+    def read_reports(self):
+        """
+        Adds up what the drained workers reported
+
+        :return: number of messages they finished while draining
+        """
+        if self.reports is None:
+            return 0
+        data = ''
+        try:
+            while True:
+                chunk = os.read(self.reports[0], 4096)
+                if not chunk:
+                    break
+                data += chunk
+        except OSError:
+            pass
+        drained = 0
+        for line in data.splitlines():
+            name, count = line.rsplit(' ', 1)
+            self.stats.setdefault(name, new_stats())['drained'] += int(count)
+            drained += int(count)
+        return drained
+
+    def child_pids(self):
+        """
+        :return: pids of the workers running as processes
+        """
+        return [active['proc'].pid for params in self.workers.values()
+                for active in params.get('active', [])
+                if hasattr(active['proc'], 'pid')]
+
+    def autoscaled(self):
+        """
+        :return: names of the workers that have a 'max_concurrency'
+        """
+        return [worker for worker, params in self.workers.iteritems()
+                if params.get('max_concurrency')]
+
+    def bounded(self, params, concurrency):
+        """
+        :return: <concurrency> within the 'min_concurrency' (default 1)
+                 and 'max_concurrency' of the worker
+        """
+        return max(params.get('min_concurrency', 1),
+                   min(params['max_concurrency'], concurrency))
+
+    def queue_depth(self, params):
+        """
+        Reads the queue of a worker, as MiniRabbit.message_count() does
+
+        :param params: parameters of the worker
+        :return: (messages, consumers), None if the queue cannot be read
+        """
+        url = params.get('RABBITMQ_URL', self.rabbitmq_url)
+        if transports.is_local(url):
+            return None  # the local queues are in the worker processes
+        try:
+            if self.monitor is None or not self.monitor.connection.is_open:
+                self.monitor = generic.RabbitMQWorker()
+                self.monitor.connect(url)
+            method = self.monitor.channel.queue_declare(
+                queue=params['subscribe'], passive=True).method
+        except Exception as err:
+            logger.warning('Cannot read the queue {0}: {1}'.format(
+                                params.get('subscribe'), err))
+            self.monitor = None
+            return None
+        return method.message_count, method.consumer_count
+
+    def scale(self, worker, params, depth, consumers, now=None):
+        """
+        Decides how many workers the queue needs. Between 'down_depth' and
+        'up_depth' messages per worker nothing changes (so that a worker
+        that was just started or stopped does not flip the decision), and
+        after a change the next one waits for its cooldown.
+
+        :param worker: name of the worker class
+        :param params: parameters of the worker
+        :param depth: messages in its queue
+        :param consumers: consumers of its queue
+        :param now: time of the decision
+        :return: (concurrency, reason)
+        """
+        settings = self.autoscaling
+        stats = self.stats[worker]
+        now = now or time.time()
+        conc = params['concurrency']
+        per_worker = depth / float(max(conc, 1))
+        # messages per second the queue grows (or shrinks) by: the workers
+        # are busy while it grows, idle while it is empty
+        growth = 0
+        if stats['depth'] is not None and now > stats['depth'][1]:
+            growth = (depth - stats['depth'][0]) / (now - stats['depth'][1])
+        stats['depth'] = (depth, now)
+        since = now - stats['last_scaled']
+
+        wanted, cooldown = conc, 0
+        if per_worker > settings['up_depth'] and growth >= 0:
+            wanted = max(conc + settings['step'],
+                         int(math.ceil(depth / float(settings['up_depth']))))
+            cooldown = settings['up_cooldown']
+        elif per_worker < settings['down_depth'] and growth <= 0:
+            wanted = conc - settings['step']
+            cooldown = settings['down_cooldown']
+        wanted = self.bounded(params, wanted)
+
+        if wanted == conc:
+            reason = 'steady'
+        elif since < cooldown:
+            wanted, reason = conc, 'cooldown ({0:.0f}s left)'.format(
+                                        cooldown - since)
+        else:
+            reason = 'scale up' if wanted > conc else 'scale down'
+
+        log = logger.info if wanted != conc else logger.debug
+        log('Autoscaling {0}: {1} -> {2} ({3}); queue {4}: {5} messages '
+            '({6:.1f} per worker, {7:+.1f}/s), {8} consumers, limits '
+            '{9}-{10}'.format(worker, conc, wanted, reason,
+                              params['subscribe'], depth, per_worker, growth,
+                              consumers, params.get('min_concurrency', 1),
+                              params['max_concurrency']))
+        return wanted, reason
+
+    def autoscale(self):
+        """
+        Resizes the workers that have a 'max_concurrency' to the depth of
+        their queues (every 'interval' seconds); start_workers() starts the
+        new ones, the surplus ones are drained
+
+        :return: no return
+        """
+        now = time.time()
+        if now < self.next_autoscale:
+            return
+        self.next_autoscale = now + self.autoscaling['interval']
+        for worker in self.autoscaled():
+            params = self.workers[worker]
+            queue = self.queue_depth(params)
+            if queue is None:
+                continue
+            wanted, reason = self.scale(worker, params, queue[0], queue[1],
+                                        now)
+            if wanted == params['concurrency']:
+                continue
+            self.stats[worker]['last_scaled'] = now
+            params['concurrency'] = wanted
+            # the youngest go first, the others are warm
+            running = [x for x in params.get('active', [])
+                       if not x.get('draining')]
+            for active in sorted(running, key=lambda x: -x['start'])[
+                    :max(0, len(running) - wanted)]:
+                self.drain_worker(active)
+
+    def stop_workers(self, timeout=None):
+        """
+        Stops all the workers: every one of them is asked to drain (finish
+        and acknowledge the message it is processing, close its connection
+        and exit); the processes still running after <timeout> seconds are
+        killed, the threads are left behind (they die with this process)
+
+        :param timeout: seconds the workers have, DRAIN_TIMEOUT by default
+        :return: dict with the number of stopped, killed and abandoned
+                 workers, the messages drained and the seconds it took
+        """
+        self.running = False
+        if self.monitor is not None:
+            try:
+                self.monitor.connection.close()
+            except Exception:
+                pass
+            self.monitor = None
+        start = time.time()
+        timeout = self.drain_timeout if timeout is None else timeout
+        deadline = start + timeout
+        drained = self.read_reports()  # of the workers recycled before
+
+        workers = [(params['active'], active)
+                   for params in self.workers.values()
+                   for active in params.get('active', [])]
+        for _, active in workers:
+            if not active.get('draining'):
+                self.drain_worker(active, timeout)
+        logger.info('Stopping {0} workers (at most {1}s)'.format(
+                        len(workers), timeout))
+
+        def alive():
+            return [x for x in workers
+                    if x[1]['proc'].is_alive() and not x[1].get('exited')]
+
+        while alive() and time.time() < deadline:
+            if self.wakeup is not None:
+                self.wait(min(0.1, max(0, deadline - time.time())))
+            else:
+                time.sleep(0.01)
+
+        killed = abandoned = 0
+        for active_list, active in alive():
+            if hasattr(active['proc'], 'pid'):
+                logger.warning('{0} did not stop in time, killing it'.format(
+                                    active['proc']))
+                self.kill_worker(active)
+                killed += 1
+            else:
+                logger.warning('{0} did not stop in time, leaving it'.format(
+                                    active['proc']))
+                abandoned += 1
+        for active_list, active in workers:
+            active['proc'].join(0)
+            if active in active_list:
+                active_list.remove(active)
+
+        report = {'workers': len(workers), 'killed': killed,
+                  'abandoned': abandoned,
+                  'drained': self.read_reports() - drained,
+                  'seconds': time.time() - start}
+        logger.info('Stopped {workers} workers in {seconds:.2f}s, {drained} '
+                    'messages drained, {killed} killed, {abandoned} left '
+                    'behind'.format(**report))
+        return report
 
 
 def start_pipeline(params_dictionary=False, application=None):
@@ -268,11 +889,38 @@ def start_pipeline(params_dictionary=False, application=None):
     """
     
     app = application or app
-    
+    # the workers (e.g. the ErrorHandler) use the session of the app
+    app.init_app()
+
+    # before the workers are made, they get their loggers from it
+    configure_logging(app.config.get('LOGGING_MODE', 'file'),
+                      app.config.get('LOGGING_SAMPLING', 1),
+                      app.config.get('LOGGING_QUEUE_SIZE', 10000))
+
+    # the workers write their metrics into METRICS_DIR, this process
+    # serves the sum of them on METRICS_PORT
+    if app.config.get('METRICS_DIR'):
+        metrics.enable_multiprocess(app.config['METRICS_DIR'])
+    if app.config.get('METRICS_PORT'):
+        metrics.start_http_server(app.config['METRICS_PORT'])
+
     task_master = TaskMaster(app.config.get('RABBITMQ_URL'),
                     app.config.get('EXCHANGE'),
                     app.config.get('QUEUES', None),
-                    app.config.get('WORKERS'))
+                    app.config.get('WORKERS'),
+                    app.config.get('RESTART_BACKOFF'),
+                    app.config.get('DRAIN_TIMEOUT', 30),
+                    app.config.get('WORKER_TTL_JITTER', 0.1),
+                    app.config.get('AUTOSCALE'))
+
+    # SIGUSR1 to this process profiles it (and the workers running in its
+    # threads) and every worker process, see run.py --profile
+    profiling.configure(app.config.get('PROFILE_DIR'),
+                        app.config.get('PROFILE_SECONDS'))
+    profiling.install('TaskMaster', forward=task_master.child_pids)
+    pidfile = app.config.get('PIDFILE') or profiling.PIDFILE
+    with open(pidfile, 'w') as f:
+        f.write(str(os.getpid()))
 
     task_master.initialize_rabbitmq()
     task_master.start_workers(extra_params=params_dictionary)
@@ -282,7 +930,8 @@ def start_pipeline(params_dictionary=False, application=None):
 
     # Start the main process in a loop
     task_master.poll_loop(extra_params=params_dictionary, 
-                          poll_interval=app.config.get('POLL_INTERVAL', 15))
+                          poll_interval=app.config.get('POLL_INTERVAL', 15),
+                          ttl=app.config.get('WORKER_TTL', 7200))
 
 
 def main():
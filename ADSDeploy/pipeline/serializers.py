@@ -0,0 +1,141 @@
+"""
+Registry of message serializers (by content type) and compressors (by
+content encoding). Publishers stamp content_type/content_encoding into the
+message properties, consumers decode by them; a message without them is
+plain JSON (that is what all the older workers send).
+
+application/json is always written by the standard json module. ujson is
+faster but not a drop-in replacement (by default it rounds floats, escapes
+'/' and cannot write integers beyond 64 bits), so it is a content type of
+its own, application/x-ujson, that a worker has to ask for; the messages
+are still JSON, any consumer can read them. msgpack and lz4 are available
+when they are installed.
+"""
+
+import json
+import zlib
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+JSON = 'application/json'
+UJSON = 'application/x-ujson'
+MSGPACK = 'application/x-msgpack'
+
+SERIALIZERS = {}
+COMPRESSORS = {}
+
+
+def register_serializer(content_type, dumps, loads):
+    """
+    Makes a serializer available to the workers
+
+    :param content_type: the content type, e.g. application/json
+    :param dumps: function(message) -> str
+    :param loads: function(str) -> message
+    :return: no return
+    """
+    SERIALIZERS[content_type] = (dumps, loads)
+
+
+def register_compressor(content_encoding, compress, decompress):
+    """
+    Makes a compression available to the workers
+
+    :param content_encoding: name of the compression, e.g. zlib
+    :param compress: function(str) -> str
+    :param decompress: function(str) -> str
+    :return: no return
+    """
+    COMPRESSORS[content_encoding] = (compress, decompress)
+
+
+def encode(message, content_type=JSON, compression=None, threshold=1024):
+    """
+    Serializes the message, compressing it if it is big enough
+
+    :param message: the message (dict, list...)
+    :param content_type: which serializer to use
+    :param compression: which compression to use (or None)
+    :param threshold: only bodies of at least this many bytes are compressed
+    :return: (body, content_type, content_encoding or None)
+    """
+    if content_type not in SERIALIZERS:
+        raise Exception('Unknown content type: {0}'.format(content_type))
+    body = SERIALIZERS[content_type][0](message)
+
+    if compression and len(body) >= threshold:
+        if compression not in COMPRESSORS:
+            raise Exception('Unknown compression: {0}'.format(compression))
+        return COMPRESSORS[compression][0](body), content_type, compression
+    return body, content_type, None
+
+
+def decode(body, content_type=None, content_encoding=None):
+    """
+    Deserializes the message according to its properties
+
+    :param body: the message body
+    :param content_type: content type from the message properties
+    :param content_encoding: content encoding from the message properties
+    :return: the message
+    """
+    if content_encoding and content_encoding in COMPRESSORS:
+        body = COMPRESSORS[content_encoding][1](body)
+    elif content_encoding and content_encoding not in ('utf-8', 'utf8'):
+        raise Exception('Unknown content encoding: {0}'.format(content_encoding))
+
+    return SERIALIZERS.get(content_type or JSON, SERIALIZERS[JSON])[1](body)
+
+
+def ujson_dumps(message):
+    """
+    :return: the message in JSON, as json.dumps would write it (except for
+             the whitespace); json.dumps writes what ujson cannot
+    """
+    try:
+        return ujson.dumps(message, double_precision=15,
+                           escape_forward_slashes=False)
+    except OverflowError:
+        return json.dumps(message)
+
+
+def ujson_loads(body):
+    """
+    :return: the message, read by json.loads if ujson cannot
+    """
+    try:
+        return ujson.loads(body, precise_float=True)
+    except (OverflowError, ValueError):
+        return json.loads(body)
+
+
+register_serializer(JSON, json.dumps, json.loads)
+
+if ujson is not None:
+    register_serializer(UJSON, ujson_dumps, ujson_loads)
+else:
+    register_serializer(UJSON, json.dumps, json.loads)
+
+if msgpack is not None:
+    register_serializer(MSGPACK,
+                        lambda x: msgpack.packb(x, use_bin_type=True),
+                        lambda x: msgpack.unpackb(x, raw=False))
+
+register_compressor('zlib', zlib.compress, zlib.decompress)
+
+if lz4 is not None:
+    register_compressor('lz4', lz4.frame.compress, lz4.frame.decompress)
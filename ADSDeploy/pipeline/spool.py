@@ -0,0 +1,315 @@
+"""
+Store-and-forward spool: an append-only, segmented log on disk where the
+workers keep outgoing messages while RabbitMQ (or the forwarding target)
+is unreachable. A SpoolDrainer publishes them, in order, once the broker
+is back.
+"""
+
+from .. import utils
+import fcntl
+import json
+import os
+import pika
+import struct
+import threading
+import time
+
+
+# lengths of exchange, routing key, properties and body of a record
+RECORD_HEADER = struct.Struct('>HHII')
+
+PROPERTIES = ('content_type', 'content_encoding', 'headers', 'delivery_mode',
+              'expiration')
+
+
+def dump_properties(properties):
+    """
+    Serializes the (interesting part of) message properties
+
+    :param properties: pika.BasicProperties or None
+    :return: str
+    """
+    if properties is None:
+        return ''
+    return json.dumps(dict((k, getattr(properties, k)) for k in PROPERTIES
+                           if getattr(properties, k, None) is not None))
+
+
+def load_properties(data):
+    """
+    :param data: str from dump_properties()
+    :return: pika.BasicProperties or None
+    """
+    if not data:
+        return None
+    return pika.BasicProperties(**dict((str(k), v) for k, v in
+                                       json.loads(data).items()))
+
+
+class Spool(object):
+    """
+    Append-only log of messages split into segment files of (about)
+    segment_size bytes. Writes are fsync'ed every fsync_every records (and
+    by flush()); the read position is kept in a cursor file, fully read
+    segments are deleted. Delivery is at-least-once: after a crash the
+    records read since the last cursor update are read again.
+
+    Every process writes into its own subdirectory of <directory>, see
+    claim_directory().
+    """
+
+    def __init__(self, directory, segment_size=16777216, fsync_every=100):
+        self.directory, self.dir_lock = claim_directory(directory)
+        self.segment_size = segment_size
+        self.fsync_every = fsync_every
+        self.lock = threading.RLock()
+        self.writer = None
+        self.unsynced = 0
+        self.count = 0
+
+        # count what previous runs left behind
+        segment, offset = self.read_cursor()
+        for name in self.segments():
+            for _ in self.records(name, offset if name == segment else 0):
+                self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def segments(self):
+        """
+        :return: sorted list of segment file names
+        """
+        return sorted(x for x in os.listdir(self.directory)
+                      if x.endswith('.spool'))
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_cursor(self):
+        """
+        :return: (segment name, offset) of the next record to read
+        """
+        try:
+            with open(self.path('cursor')) as f:
+                segment, offset = f.read().split()
+                return segment, int(offset)
+        except (IOError, ValueError):
+            return None, 0
+
+    def write_cursor(self, segment, offset):
+        tmp = self.path('cursor.tmp')
+        with open(tmp, 'w') as f:
+            f.write('{0} {1}'.format(segment, offset))
+        os.rename(tmp, self.path('cursor'))
+
+    def append(self, exchange, routing_key, body, properties=None):
+        """
+        Adds a message at the end of the spool
+
+        :param exchange: exchange of the message
+        :param routing_key: routing key of the message
+        :param body: the (serialized) message
+        :param properties: pika.BasicProperties of the message
+        :return: no return
+        """
+        exchange = (exchange or '').encode('utf8')
+        routing_key = (routing_key or '').encode('utf8')
+        if isinstance(body, unicode):
+            body = body.encode('utf8')
+        props = dump_properties(properties)
+
+        with self.lock:
+            if self.writer is None or self.writer.tell() >= self.segment_size:
+                self.rotate()
+            self.writer.write(RECORD_HEADER.pack(len(exchange), len(routing_key),
+                                                 len(props), len(body)))
+            self.writer.write(exchange + routing_key + props + body)
+            self.count += 1
+            self.unsynced += 1
+            if self.unsynced >= self.fsync_every:
+                self.flush()
+
+    def rotate(self):
+        """Starts a new segment"""
+        self.close()
+        existing = self.segments()
+        number = int(existing[-1].split('.')[0]) + 1 if existing else 0
+        self.writer = open(self.path('{0:012d}.spool'.format(number)), 'ab')
+
+    def flush(self):
+        """Writes the buffered records to the disk"""
+        with self.lock:
+            if self.writer is not None and self.unsynced:
+                self.writer.flush()
+                os.fsync(self.writer.fileno())
+            self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.flush()
+                self.writer.close()
+                self.writer = None
+
+    def records(self, name, offset=0):
+        """
+        Reads the records of a segment
+
+        :param name: segment file name
+        :param offset: where to start
+        :return: generator of (offset after the record, (exchange,
+                 routing_key, body, properties))
+        """
+        with open(self.path(name), 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                lengths = RECORD_HEADER.unpack(header)
+                data = f.read(sum(lengths))
+                if len(data) < sum(lengths):
+                    return  # incomplete write
+                parts, start = [], 0
+                for length in lengths:
+                    parts.append(data[start:start + length])
+                    start += length
+                exchange, routing_key, props, body = parts
+                yield f.tell(), (exchange, routing_key, body,
+                                 load_properties(props))
+
+    def drain(self, publish, batch_size=100):
+        """
+        Publishes the spooled messages in order; stops at the first message
+        that cannot be published (it will be the first one next time).
+        Messages can be appended meanwhile, the lock is not held while
+        publishing.
+
+        :param publish: function(exchange, routing_key, body, properties)
+        :param batch_size: how often the read position is saved
+        :return: number of published messages
+        """
+        published = 0
+        segment, offset = self.read_cursor()
+        for name in self.segments():
+            if name != segment:
+                offset = 0
+
+            # a segment that is no longer written to can be read to its end
+            # and deleted; the current one is read as far as it was flushed
+            with self.lock:
+                finished = self.writer is None or \
+                    os.path.basename(self.writer.name) != name
+                if not finished:
+                    self.flush()
+
+            try:
+                n = 0
+                for next_offset, record in self.records(name, offset):
+                    publish(*record)
+                    offset = next_offset
+                    published += 1
+                    n += 1
+                    with self.lock:
+                        self.count -= 1
+                    if n % batch_size == 0:
+                        self.write_cursor(name, offset)
+            finally:
+                self.write_cursor(name, offset)
+
+            if finished:
+                os.remove(self.path(name))
+                self.write_cursor('', 0)
+        return published
+
+
+class SpoolDrainer(threading.Thread):
+    """
+    Background thread that waits for the broker to be reachable and then
+    publishes the spool through its own connection, opened by <connect>
+    (the workers give it their open_connection(), so that local:// and
+    memory:// urls work too; pika.BlockingConnection by default)
+    """
+
+    def __init__(self, spool, url, confirm_delivery=False, interval=1.0,
+                 connect=None):
+        super(SpoolDrainer, self).__init__()
+        self.daemon = True
+        self.spool = spool
+        self.url = url
+        self.connect = connect or \
+            (lambda url: pika.BlockingConnection(pika.URLParameters(url)))
+        self.confirm_delivery = confirm_delivery
+        self.interval = interval
+        self.running = True
+        self.connection = None
+        self.channel = None
+        self.logger = utils.setup_logging(__file__, self.__class__.__name__)
+
+    def publish(self, exchange, routing_key, body, properties):
+        if self.channel is None:
+            self.connection = self.connect(self.url)
+            self.channel = self.connection.channel()
+            if self.confirm_delivery:
+                self.channel.confirm_delivery()
+        if not self.channel.basic_publish(exchange=exchange,
+                                          routing_key=routing_key,
+                                          body=body,
+                                          properties=properties):
+            raise Exception('Message was not confirmed')
+
+    def drain(self):
+        """
+        Publishes what is in the spool
+
+        :return: number of published messages
+        """
+        if not len(self.spool):
+            return 0
+        try:
+            n = self.spool.drain(self.publish)
+            self.logger.info('Drained {0} messages from the spool'.format(n))
+            return n
+        except Exception, e:
+            self.logger.warning('Cannot drain the spool ({0} messages): '
+                                '{1}'.format(len(self.spool), e))
+            self.channel = None
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            return 0
+
+    def run(self):
+        while self.running:
+            self.drain()
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+
+
+def claim_directory(base):
+    """
+    Finds a spool directory under <base> that no other process uses (and
+    locks it for the lifetime of the process); directories left behind by
+    dead workers are re-used, so their messages get published too
+
+    :param base: directory for the spools of one kind of worker
+    :return: (path, open lock file)
+    """
+    if not os.path.exists(base):
+        os.makedirs(base)
+    n = 0
+    while True:
+        path = os.path.join(base, str(n))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        lock = open(os.path.join(path, 'lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return path, lock
+        except IOError:
+            lock.close()
+            n += 1
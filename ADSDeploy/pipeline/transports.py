@@ -0,0 +1,206 @@
+"""
+Local transport: workers on the same host pass messages to each other
+through multiprocessing queues (pipes) instead of a round trip through
+RabbitMQ. A worker connected to a local:// url gets a LocalConnection,
+which implements the part of pika's BlockingConnection/BlockingChannel
+that the workers use (publish, consume, ack, timers), so the worker code
+is the same for both transports; AMQP stays the default.
+
+The queues live in this module and are inherited by the worker processes,
+so they have to be declared (the TaskMaster does it) before the workers
+are started. Routing is by queue name or by the routing key a queue is
+bound to (no wildcards); unroutable messages are dropped, as they are by
+an AMQP exchange. Messages that were received but not acknowledged go back
+to the queue when the connection is closed - messages still in the pipes
+are lost when the whole pipeline stops. Delayed retry queues hand the
+retry straight back to the worker's queue (there is no TTL).
+"""
+
+from .. import utils
+from . import spool
+from .emulation import EmulatedChannel, EmulatedConnection
+import Queue
+import multiprocessing
+import pika
+import time
+
+
+LOCAL_URL = 'local://'
+
+# queue name -> multiprocessing.Queue; routing key -> queue name
+QUEUES = {}
+BINDINGS = {}
+
+logger = utils.setup_logging(__file__, __name__)
+
+
+def is_local(url):
+    """
+    :param url: URI of the broker
+    :return: True if the url is served by the local transport
+    """
+    return bool(url) and url.startswith(LOCAL_URL)
+
+
+def declare(queue, arguments=None):
+    """
+    Creates the local queue (if it does not exist yet); a queue that
+    dead-letters somewhere is the same as the queue it dead-letters to
+
+    :param queue: name of the queue
+    :param arguments: AMQP queue arguments
+    :return: multiprocessing.Queue
+    """
+    if queue not in QUEUES:
+        target = (arguments or {}).get('x-dead-letter-routing-key')
+        QUEUES[queue] = declare(target) if target else multiprocessing.Queue()
+    return QUEUES[queue]
+
+
+def bind(queue, routing_key):
+    BINDINGS[routing_key] = queue
+
+
+def route(routing_key):
+    """
+    :param routing_key: routing key of a message
+    :return: the multiprocessing.Queue it goes to, or None
+    """
+    return QUEUES.get(BINDINGS.get(routing_key, routing_key))
+
+
+def reset():
+    """Forgets all the local queues"""
+    QUEUES.clear()
+    BINDINGS.clear()
+
+
+class LocalChannel(EmulatedChannel):
+    """
+    Channel of the local transport, see pika.BlockingChannel; it has no
+    prefetch, confirms or transactions (every message is in the queue as
+    soon as it is published)
+    """
+
+    def __init__(self, connection, channel_number):
+        super(LocalChannel, self).__init__(connection, channel_number)
+        self.consumers = []
+        self.consuming = False
+        self.unacked = {}
+
+    def exchange_declare(self, *args, **kwargs):
+        pass
+
+    def queue_declare(self, queue, passive=False, arguments=None, **kwargs):
+        if passive and queue not in QUEUES:
+            raise pika.exceptions.ChannelClosed(
+                404, "NOT_FOUND - no queue '{0}'".format(queue))
+        declare(queue, arguments)
+
+    def queue_bind(self, queue, exchange=None, routing_key=None, **kwargs):
+        bind(queue, routing_key or queue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None,
+                      **kwargs):
+        queue = route(routing_key)
+        if queue is None:
+            logger.warning('Dropping unroutable message: {0}'.format(
+                                routing_key))
+            return False
+        queue.put((exchange or '', routing_key, self.encode_body(body),
+                   spool.dump_properties(properties)))
+        return True
+
+    def basic_consume(self, consumer_callback, queue, **kwargs):
+        self.queue_declare(queue, passive=True)
+        self.consumers.append((QUEUES[queue], consumer_callback))
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        if multiple:
+            for tag in [x for x in self.unacked if x <= delivery_tag]:
+                del self.unacked[tag]
+        else:
+            self.unacked.pop(delivery_tag, None)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        tags = [x for x in self.unacked if x <= delivery_tag] if multiple \
+            else [delivery_tag]
+        for tag in sorted(tags):
+            if tag not in self.unacked:
+                continue
+            queue, record = self.unacked.pop(tag)
+            if requeue:
+                queue.put(record)
+
+    def deliver(self, timeout=0):
+        """
+        Hands the waiting messages to the consumers
+
+        :param timeout: how long to wait for a message (seconds)
+        :return: number of delivered messages
+        """
+        delivered = 0
+        for queue, callback in self.consumers:
+            try:
+                if timeout > 0:
+                    record = queue.get(timeout=timeout)
+                else:
+                    record = queue.get_nowait()
+            except Queue.Empty:
+                continue
+            exchange, routing_key, body, props = record
+            self.delivery_tag += 1
+            self.unacked[self.delivery_tag] = (queue, record)
+            self.dispatch(callback, self.delivery_tag, exchange, routing_key,
+                          spool.load_properties(props), body)
+            delivered += 1
+        return delivered
+
+    def start_consuming(self):
+        self.consuming = True
+        while self.consuming and self.connection.is_open:
+            self.connection.process_data_events(time_limit=1)
+
+    def stop_consuming(self):
+        self.consuming = False
+
+    def close(self):
+        """Puts the unacknowledged messages back to their queues"""
+        self.basic_nack(delivery_tag=self.delivery_tag, multiple=True)
+        self.is_open = False
+
+
+class LocalConnection(EmulatedConnection):
+    """
+    Connection of the local transport, see pika.BlockingConnection
+    """
+
+    channel_class = LocalChannel
+
+    def __init__(self, url=LOCAL_URL):
+        super(LocalConnection, self).__init__(url)
+
+    def process_data_events(self, time_limit=0):
+        """
+        Delivers messages and runs the timers for (about) time_limit
+        seconds
+
+        :param time_limit: how long to wait for messages
+        :return: no return
+        """
+        deadline = time.time() + (time_limit or 0)
+        while True:
+            self.run_timers()
+            wait = deadline - time.time()
+            if self.timers:
+                wait = min(wait, min(x[0] for x in self.timers.values()) -
+                           time.time())
+            consumers = [x for x in self.channels if x.consumers]
+            if consumers:
+                for channel in consumers:
+                    channel.deliver(min(wait, 0.1) / len(consumers))
+            elif wait > 0:
+                time.sleep(min(wait, 0.1))
+            if time.time() >= deadline:
+                self.run_timers()
+                return
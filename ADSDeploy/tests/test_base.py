@@ -13,7 +13,7 @@ import json
 import pika
 from ADSDeploy import utils, app
 from ..pipeline import pstart
-from ADSDeploy.pipeline import generic
+from ADSDeploy.pipeline import generic, memory
 
 
 
@@ -43,6 +43,9 @@ class TestFunctional(TestUnit):
     Generic test class. Used as the primary class that implements a standard
     integration test. Also contains a range of helper functions, and the correct
     tearDown method when interacting with RabbitMQ.
+
+    With TEST_RABBITMQ_URL = 'memory://' in the config (or RABBITMQ_URL) the
+    tests run against the in-memory broker instead of a live RabbitMQ.
     """
 
     def setUp(self):
@@ -55,6 +58,9 @@ class TestFunctional(TestUnit):
         """
         
         super(TestFunctional, self).setUp()
+
+        if self.app.config.get('TEST_RABBITMQ_URL'):
+            self.app.config['RABBITMQ_URL'] = self.app.config['TEST_RABBITMQ_URL']
         
         # Queues and routes are switched on so that they can allow workers
         # to connect
@@ -111,7 +117,10 @@ class TestFunctional(TestUnit):
         :return: no return
         """
 
-        self.purge_all_queues()
+        if memory.is_memory(self.app.config.get('RABBITMQ_URL')):
+            memory.reset()
+        else:
+            self.purge_all_queues()
         self.TM.stop_workers()
         self.TM = None
         
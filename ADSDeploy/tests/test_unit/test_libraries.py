@@ -15,13 +15,22 @@ import json
 import re
 import os
 import math
+import multiprocessing
 import httpretty
 import mock
+import pika
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import weakref
 from io import BytesIO
 
 from ADSDeploy.tests import test_base
 from ADSDeploy import app, utils
 from ADSDeploy.models import Base, KeyValue
+from ADSDeploy.pipeline import profiling, serializers, spool
 
 class TestLibraries(test_base.TestUnit):
     """
@@ -61,6 +70,59 @@ class TestLibraries(test_base.TestUnit):
         self.assertEqual(d3.isoformat(), '2009-09-03T20:56:35.450686+00:00')
 
 
+    def test_logging_queue(self):
+        """In the queue mode one writer writes the records of all processes"""
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        self.addCleanup(utils.configure_logging)
+        self.addCleanup(utils.log_names.discard, 'QueueTest')
+
+        with mock.patch.object(utils, 'log_file',
+                               lambda name: os.path.join(d, name + '.log')):
+            logger = utils.setup_logging(__file__, 'QueueTest', 'DEBUG')
+            replaced = weakref.ref(logger.handlers[0])
+            utils.configure_logging('queue', sampling=3)
+            # nothing left for logging.shutdown() to close a second time
+            self.assertIsNone(replaced())
+            self.assertIsInstance(logger.handlers[0], utils.QueueHandler)
+            handler = logger.handlers[0]
+            utils.configure_logging('queue', sampling=3)
+            self.assertEqual(logger.handlers, [handler])
+
+            for i in range(7):
+                logger.debug('message %s', i)
+            logger.info('info %s', {'not': 'sampled'})
+            child = multiprocessing.Process(
+                        target=lambda: logger.warning('from %s', 'child'))
+            child.start()
+            child.join()
+            utils.configure_logging('file')
+            self.assertEqual(len(logger.handlers), 1)
+            self.assertIsInstance(logger.handlers[0],
+                                  utils.ConcurrentRotatingFileHandler)
+            self.assertNotIn(handler, logger.handlers)
+
+        with open(os.path.join(d, 'QueueTest.log')) as f:
+            lines = [x.split('\t')[-1].strip() for x in f]
+        self.assertEqual(sorted(lines), sorted(['message 0', 'message 3',
+                                                'message 6',
+                                                "info {'not': 'sampled'}",
+                                                'from child']))
+
+    def test_after_fork(self):
+        """The child gets its own session, the parent's is not touched"""
+        parent = app.session()
+        connection = parent.connection()
+        with mock.patch.object(parent, 'close') as close, \
+                mock.patch.object(connection, 'close') as closed:
+            app.after_fork()
+        self.assertFalse(close.called)
+        self.assertFalse(closed.called)
+        self.assertIsNot(app.session(), parent)
+        self.assertIs(app.inherited[-2], parent)
+        self.assertIsNot(app.session().connection().connection,
+                         connection.connection)
+
     def test_models(self):
         """Check serialization into JSON"""
         
@@ -68,5 +130,129 @@ class TestLibraries(test_base.TestUnit):
         self.assertDictEqual(kv.toJSON(),
              {'key': 'foo', 'value': 'bar'})
         
+    def test_spool(self):
+        """Spooled messages come back in order, across segments and runs"""
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+
+        s = spool.Spool(d, segment_size=100, fsync_every=3)
+        for i in range(10):
+            s.append('ex', 'route', json.dumps({'i': i}),
+                     pika.BasicProperties(headers={'n': i}, delivery_mode=2))
+        self.assertEqual(len(s), 10)
+        self.assertGreater(len(s.segments()), 1)
+
+        # a second process gets its own directory
+        other = spool.Spool(d)
+        self.assertNotEqual(other.directory, s.directory)
+
+        published = []
+        def publish(exchange, routing_key, body, properties):
+            if len(published) == 4:
+                raise Exception('broker gone')
+            published.append((exchange, routing_key, json.loads(body)['i'],
+                              properties.headers['n']))
+
+        self.assertRaises(Exception, s.drain, publish)
+        self.assertEqual(published, [('ex', 'route', i, i) for i in range(4)])
+        self.assertEqual(len(s), 6)
+
+        # the spool is re-opened (e.g. by a restarted worker)
+        s.close()
+        s.dir_lock.close()
+        s = spool.Spool(d)
+        self.assertEqual(len(s), 6)
+        s.append('ex', 'route', json.dumps({'i': 10}),
+                 pika.BasicProperties(headers={'n': 10}))
+        published.append(None)
+        self.assertEqual(s.drain(lambda *args: published.append(
+            json.loads(args[2])['i'])), 7)
+        self.assertEqual(published[5:], range(4, 11))
+        self.assertEqual(len(s), 0)
+        self.assertEqual(len(s.segments()), 1)
+        self.assertEqual(s.drain(publish), 0)
+
+    def test_serializers(self):
+        """Messages are decoded by their content type and encoding"""
+        msg = {u'foo': u'bar', u'baz': [1, 2]}
+
+        body, ct, ce = serializers.encode(msg)
+        self.assertEqual((ct, ce), ('application/json', None))
+        self.assertEqual(serializers.decode(body, ct, ce), msg)
+
+        # older workers send plain JSON without any properties
+        self.assertEqual(serializers.decode(json.dumps(msg)), msg)
+        self.assertEqual(serializers.decode(json.dumps(msg), None, 'utf-8'), msg)
+
+        # only big enough messages are compressed
+        body, ct, ce = serializers.encode(msg, compression='zlib', threshold=5)
+        self.assertEqual(ce, 'zlib')
+        self.assertEqual(serializers.decode(body, ct, ce), msg)
+        body, ct, ce = serializers.encode(msg, compression='zlib',
+                                          threshold=1024)
+        self.assertIsNone(ce)
+
+        if serializers.msgpack is not None:
+            body, ct, ce = serializers.encode(msg, content_type=serializers.MSGPACK)
+            self.assertEqual(serializers.decode(body, ct, ce), msg)
+
+        # ujson only when asked for, and without losing anything
+        exact = {u'url': u'http://x/y', u'f': 1234.56789012345}
+        body, ct, ce = serializers.encode(exact)
+        self.assertEqual(body, json.dumps(exact))
+        for exact in (exact, {u'big': 2 ** 70}):
+            body, ct, ce = serializers.encode(exact,
+                                              content_type=serializers.UJSON)
+            self.assertEqual(json.loads(body), exact)
+            self.assertEqual(serializers.decode(body, ct, ce), exact)
+            self.assertNotIn('\\/', body)
+        body, ct, ce = serializers.encode(msg, content_type=serializers.UJSON)
+        self.assertEqual(serializers.decode(body, ct, ce), msg)
+
+        self.assertRaises(Exception, serializers.encode, msg, 'text/foo')
+        self.assertRaises(Exception, serializers.decode, body, ct, 'foo')
+
+    def test_profiling(self):
+        """The signal starts a profile of every thread; profiles merge"""
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        stop = threading.Event()
+
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(100))
+
+        thread = threading.Thread(target=busy_loop)
+        thread.start()
+        self.addCleanup(signal.signal, profiling.PROFILE_SIGNAL,
+                        signal.getsignal(profiling.PROFILE_SIGNAL))
+        forwarded = []
+        profiler = profiling.install('Busy', forward=lambda: forwarded)
+        profiler.directory, profiler.seconds = d, 0.2
+        try:
+            os.kill(os.getpid(), profiling.PROFILE_SIGNAL)
+            time.sleep(0.05)
+            self.assertTrue(profiler.running)
+            profiler.thread.join()
+        finally:
+            stop.set()
+            thread.join()
+
+        paths = profiling.collect(d)
+        self.assertEqual(paths, [profiler.path])
+        counts = profiling.merge(paths + paths)
+        self.assertEqual(sum(counts.values()), 2 * sum(profiler.counts.values()))
+        functions = [x[0].split(':')[-1] for x in profiling.summary(counts)]
+        self.assertIn('busy_loop', functions)
+
+        # not in the main thread there is no signal handler
+        result = []
+        t = threading.Thread(target=lambda: result.append(
+                                profiling.install('Thread')))
+        t.start()
+        t.join()
+        self.assertEqual(result, [None])
+
+
 if __name__ == '__main__':
     unittest.main()
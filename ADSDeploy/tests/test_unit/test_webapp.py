@@ -12,7 +12,8 @@ from ADSDeploy.webapp import app
 from ADSDeploy.webapp.models import db, Packet
 from ADSDeploy.webapp.views import GithubListener
 from stub_data.stub_webapp import github_payload, payload_tag
-from ADSDeploy.webapp.utils import get_boto_session
+from ADSDeploy.webapp.utils import get_boto_session, Deduplicator, \
+    DatabaseStore
 from ADSDeploy.webapp.exceptions import NoSignatureInfo, InvalidSignature
 from flask.ext.testing import TestCase
 
@@ -58,6 +59,31 @@ class TestUtilities(unittest.TestCase):
         )
 
 
+    @mock.patch('ADSDeploy.webapp.utils.time')
+    def test_deduplicator(self, mocked_time):
+        """
+        Keys are remembered for ttl seconds, and at most size of them
+        """
+        mocked_time.time.return_value = 100
+        d = Deduplicator(size=2, ttl=10)
+
+        self.assertFalse(d.seen('a', None))
+        self.assertTrue(d.seen('a'))
+        self.assertTrue(d.seen('x', 'a'))
+
+        mocked_time.time.return_value = 111
+        self.assertFalse(d.seen('a'))
+
+        d.seen('b')
+        d.seen('c')
+        self.assertNotIn('a', d.entries)
+        self.assertFalse(d.seen('a'))
+
+        d.forget('a')
+        self.assertFalse(d.seen('a'))
+        self.assertEqual(d.stats(), {'hits': 2, 'misses': 6, 'size': 2})
+
+
 class TestStaticMethodUtilities(TestCase):
     """
     Test standalone staticmethods
@@ -219,3 +245,20 @@ class TestStaticMethodUtilities(TestCase):
                 p.get(key, None),
                 msg='key "{}" not found in call {}'.format(key, p)
             )
+
+    def test_deduplicator_database_store(self):
+        """
+        Keys recorded by one worker are seen by the others
+        """
+        worker_1 = Deduplicator(store=DatabaseStore())
+        worker_2 = Deduplicator(store=DatabaseStore())
+
+        self.assertFalse(worker_1.seen('delivery:1', 'commit:1'))
+        self.assertTrue(worker_2.seen('delivery:2', 'commit:1'))
+        # the new delivery id was not recorded by the duplicate
+        self.assertFalse(worker_2.seen('delivery:2'))
+
+        worker_1.forget('delivery:1', 'commit:1')
+        worker_3 = Deduplicator(store=DatabaseStore())
+        self.assertFalse(worker_3.seen('commit:1'))
+
@@ -4,8 +4,13 @@ Test webservices
 
 import json
 import mock
+import pika
+import threading
 
 from ADSDeploy.webapp import app
+from ADSDeploy.pipeline import memory
+from ADSDeploy.webapp.views import MiniRabbit, rabbit_pool, IngestBuffer, \
+    deduplicator
 from flask import url_for
 from flask.ext.testing import TestCase
 from stub_data.stub_webapp import github_payload
@@ -38,6 +43,19 @@ class TestEndpoints(TestCase):
         self.assertStatus(r, 400)  # No signature given
 
 
+    def test_metrics_endpoint(self):
+        """
+        The requests are counted and exposed in the Prometheus format
+        """
+        self.client.post(url_for('githublistener'))
+
+        r = self.client.get(url_for('metricsview'))
+
+        self.assertStatus(r, 200)
+        self.assertIn('text/plain', r.headers['Content-Type'])
+        self.assertIn('adsdeploy_http_requests_total{endpoint="githublistener"'
+                      ',status="400"}', r.data)
+
     @mock.patch('ADSDeploy.webapp.views.GithubListener.push_rabbitmq')
     @mock.patch('ADSDeploy.webapp.views.GithubListener.verify_github_signature')
     def test_githublistener_forwards_message(self, mocked_gh, mocked_rabbit):
@@ -94,3 +112,171 @@ class TestEndpoints(TestCase):
         mocked_gh.push_rabbitmq.assert_has_calls(
             [mock.call(payload)]
         )
+
+    def test_minirabbit_memory_broker(self):
+        """
+        MiniRabbit works against the in-memory broker
+        """
+        self.addCleanup(memory.reset)
+        with MiniRabbit(memory.MEMORY_URL) as w:
+            w.make_queue('test')
+            w.publish(json.dumps({'commit': '23d3f'}), 'test', 'test')
+            self.assertEqual(w.message_count('test'), 1)
+            self.assertEqual(w.get_packet('test'), {'commit': '23d3f'})
+            w.publish_batch([('test', 'test', '1'), ('test', 'test', '2')])
+            self.assertEqual(w.message_count('test'), 2)
+            w.clear_queue('test')
+            self.assertEqual(w.message_count('test'), 0)
+            w.delete_queue('test')
+        self.assertFalse(w.is_open)
+
+    @mock.patch('ADSDeploy.webapp.views.pika')
+    def test_rabbitmq_connections_are_pooled(self, mocked_pika):
+        """
+        Tests that consecutive requests re-use the same RabbitMQ connection,
+        and that a broken or inherited connection is replaced
+        """
+
+        class FakeConnection(object):
+            handshakes = 0
+
+            def __init__(self, parameters):
+                FakeConnection.handshakes += 1
+                self.is_open = True
+                self.published = []
+
+            def channel(self):
+                channel = mock.Mock(is_open=True)
+                channel.basic_publish.side_effect = \
+                    lambda *args: self.published.append(args)
+                return channel
+
+            def process_data_events(self, time_limit=0):
+                if self.dropped:
+                    self.is_open = False
+                    raise pika.exceptions.ConnectionClosed()
+
+            def close(self):
+                self.is_open = False
+
+        FakeConnection.dropped = False
+        mocked_pika.BlockingConnection = FakeConnection
+        mocked_pika.exceptions = pika.exceptions
+        rabbit_pool.reset()
+
+        url = url_for('rabbitmqlistener')
+        payload = {'exchange': 'test', 'route': 'test', 'commit': '23d3f'}
+
+        for i in range(5):
+            r = self.client.post(url, data=json.dumps(payload))
+            self.assertStatus(r, 200)
+        self.assertEqual(FakeConnection.handshakes, 1)
+
+        # the broker went away: the next request reconnects
+        rabbit_pool.idle[0].connection.is_open = False
+        self.client.post(url, data=json.dumps(payload))
+        self.assertEqual(FakeConnection.handshakes, 2)
+
+        # the broker dropped the idle connection: it is not used
+        rabbit_pool.idle[0].connection.dropped = True
+        r = self.client.post(url, data=json.dumps(payload))
+        self.assertStatus(r, 200)
+        self.assertEqual(FakeConnection.handshakes, 3)
+
+        # dropped, but it looked fine: the message goes through a new one
+        rabbit = rabbit_pool.idle[0]
+        rabbit.channel.basic_publish.side_effect = \
+            pika.exceptions.ConnectionClosed()
+        r = self.client.post(url, data=json.dumps(payload))
+        self.assertStatus(r, 200)
+        self.assertEqual(FakeConnection.handshakes, 4)
+        self.assertNotIn(rabbit, rabbit_pool.idle)
+
+        # a forked worker does not use the parent's connections
+        rabbit_pool.pid = -1
+        self.client.post(url, data=json.dumps(payload))
+        self.assertEqual(FakeConnection.handshakes, 5)
+        self.assertEqual(len(rabbit_pool.idle), 1)
+        rabbit_pool.reset()
+
+    def test_buffered_ingest(self):
+        """
+        Tests that in the buffered mode the endpoint answers 202, publishes
+        in batches in the background and answers 503 when the buffer is full
+        """
+
+        self.app.config['INGEST_MODE'] = 'buffered'
+        buf = IngestBuffer(size=3, batch_size=10, interval=0.01)
+        url = url_for('rabbitmqlistener')
+        payload = {'exchange': 'test', 'route': 'test', 'commit': '23d3f'}
+
+        pool = w = mock.MagicMock()
+        # the broker is "slow": the first batch blocks the flusher
+        event = threading.Event()
+        w.publish_batch.side_effect = lambda batch: event.wait()
+
+        with mock.patch('ADSDeploy.webapp.views.ingest_buffer', buf), \
+                mock.patch('ADSDeploy.webapp.views.rabbit_pool', pool):
+
+            statuses = []
+            for i in range(6):
+                r = self.client.post(url, data=json.dumps(payload))
+                statuses.append(r.status_code)
+            self.assertEqual(statuses[0], 202)
+            self.assertIn(503, statuses)
+            self.assertEqual(r.headers['Retry-After'], '1')
+
+            event.set()
+            self.assertEqual(buf.drain(timeout=5), 0)
+
+        published = sum(len(c[0][0]) for c in w.publish_batch.call_args_list)
+        self.assertEqual(published, statuses.count(202))
+        self.assertEqual(buf.published, published)
+        self.assertEqual(w.publish_batch.call_args[0][0][0],
+                         ('test', 'test', json.dumps({'commit': '23d3f'})))
+
+        # after the drain nothing is accepted
+        with mock.patch('ADSDeploy.webapp.views.ingest_buffer', buf):
+            r = self.client.post(url, data=json.dumps(payload))
+        self.assertStatus(r, 503)
+
+    @mock.patch('ADSDeploy.webapp.views.GithubListener.push_rabbitmq')
+    @mock.patch('ADSDeploy.webapp.views.GithubListener.verify_github_signature')
+    def test_githublistener_drops_redeliveries(self, mocked_gh, mocked_rabbit):
+        """
+        Test that a redelivered webhook is acknowledged but not published
+        """
+
+        mocked_gh.return_value = True
+        deduplicator.clear()
+        url = url_for('githublistener')
+        headers = {'X-GitHub-Delivery': '72d3162e-cc78-11e3-81ab-4c9367dc0958'}
+
+        r = self.client.post(url, data=github_payload, headers=headers)
+        self.assertStatus(r, 200)
+        self.assertNotIn('duplicate', r.json)
+
+        r = self.client.post(url, data=github_payload, headers=headers)
+        self.assertStatus(r, 200)
+        self.assertTrue(r.json['duplicate'])
+
+        # same commit, new delivery id
+        r = self.client.post(url, data=github_payload,
+                             headers={'X-GitHub-Delivery': 'other'})
+        self.assertTrue(r.json['duplicate'])
+
+        self.assertEqual(mocked_rabbit.call_count, 1)
+        self.assertEqual(deduplicator.stats()['hits'], 2)
+        self.assertEqual(deduplicator.stats()['misses'], 1)
+
+        # a failed publish does not block the redelivery
+        deduplicator.clear()
+        mocked_rabbit.side_effect = Exception('broker down')
+        r = self.client.post(url, data=github_payload, headers=headers)
+        self.assertStatus(r, 500)
+        mocked_rabbit.side_effect = None
+        r = self.client.post(url, data=github_payload, headers=headers)
+        self.assertNotIn('duplicate', r.json)
+        self.assertEqual(mocked_rabbit.call_count, 3)
+        deduplicator.clear()
+
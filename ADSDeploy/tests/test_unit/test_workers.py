@@ -7,20 +7,34 @@ are tested in this suite. There is no communication.
 """
 
 
+import base64
 import json
 import re
+import signal
+import threading
+import time
 import httpretty
 import mock
+import multiprocessing
 import os
+import pika
+import shutil
+import tempfile
 import unittest
 import datetime
 from dateutil import parser
 from mock import patch
 
-from ADSDeploy import app
+from ADSDeploy import app, utils
+from prometheus_client import REGISTRY
 from ADSDeploy.tests import test_base
-from ADSDeploy.models import Base
+from ADSDeploy.models import Base, FailedMessage
+from ADSDeploy.pipeline import errors
 from ADSDeploy.pipeline.example import ExampleWorker
+from ADSDeploy.pipeline.generic import RabbitMQWorker, AsyncRabbitMQWorker
+from ADSDeploy.pipeline import generic, memory, pstart, spool, transports
+from tornado import gen, ioloop
+from concurrent.futures import ThreadPoolExecutor
 
 class TestWorkers(test_base.TestUnit):
     """
@@ -47,9 +61,1155 @@ class TestWorkers(test_base.TestUnit):
         worker = ExampleWorker()
         worker.process_payload({u'foo': u'bar', u'baz': [1,2]})
         worker.publish.assert_called_with({u'foo': u'bar', u'baz': [1,2]})
+
+    def test_publish_batch(self):
+        """Messages are committed once per window on a tx channel"""
+        worker = RabbitMQWorker(params={'publish': 'foo', 'exchange': 'bar'})
+        worker.connection = mock.Mock()
+        worker.channel = mock.Mock()
+        worker.confirm_delivery = True
+        tx = worker.connection.channel.return_value
+
+        failures = worker.publish_batch([{'a': i} for i in range(5)], window=2)
+
+        self.assertEqual(failures, [])
+        tx.tx_select.assert_called_once_with()
+        self.assertEqual(tx.basic_publish.call_count, 5)
+        self.assertEqual(tx.tx_commit.call_count, 3)
+        self.assertFalse(worker.channel.basic_publish.called)
+        kwargs = tx.basic_publish.call_args[1]
+        self.assertEqual((kwargs['exchange'], kwargs['routing_key']),
+                         ('bar', 'foo'))
+        self.assertEqual(json.loads(kwargs['body']), {'a': 4})
+        self.assertEqual(kwargs['properties'].content_type, 'application/json')
+
+    def test_metrics(self):
+        """Consumed and published messages are counted per worker and queue"""
+
+        class MetricsWorker(RabbitMQWorker):
+            def process_payload(self, msg, **kwargs):
+                if msg.get('fail'):
+                    raise Exception('failed')
+                self.publish(msg)
+
+        def sample(name, **labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        worker = MetricsWorker(params={'subscribe': 'in', 'publish': 'out',
+                                       'exchange': 'bar'})
+        worker.channel = mock.Mock()
+        worker.offload = mock.Mock()
+        labels = {'worker': 'MetricsWorker', 'queue': 'in'}
+        before = (sample('adsdeploy_messages_total', outcome='ok', **labels),
+                  sample('adsdeploy_messages_total', outcome='error', **labels),
+                  sample('adsdeploy_processing_seconds_count', **labels),
+                  sample('adsdeploy_published_total', worker='MetricsWorker',
+                         queue='out', kind='publish'))
+
+        method_frame = mock.Mock(delivery_tag=1)
+        worker.on_message(worker.channel, method_frame, None,
+                          json.dumps({'a': 1}))
+        worker.on_message(worker.channel, method_frame, None,
+                          json.dumps({'fail': True}))
+
+        after = (sample('adsdeploy_messages_total', outcome='ok', **labels),
+                 sample('adsdeploy_messages_total', outcome='error', **labels),
+                 sample('adsdeploy_processing_seconds_count', **labels),
+                 sample('adsdeploy_published_total', worker='MetricsWorker',
+                        queue='out', kind='publish'))
+        self.assertEqual([a - b for a, b in zip(after, before)], [1, 1, 2, 1])
+
+    def test_content_type(self):
+        """Published messages carry their content type and encoding"""
+        worker = RabbitMQWorker(params={'publish': 'foo', 'exchange': 'bar',
+                                        'compression': 'zlib',
+                                        'compression_threshold': 10})
+        worker.channel = mock.Mock()
+        worker.publish({'a': 'x' * 20})
+        kwargs = worker.channel.basic_publish.call_args[1]
+        self.assertEqual(kwargs['properties'].content_type, 'application/json')
+        self.assertEqual(kwargs['properties'].content_encoding, 'zlib')
+        self.assertEqual(worker.decode(kwargs['body'], kwargs['properties']),
+                         {'a': 'x' * 20})
+
+        worker.process_payload = mock.Mock()
+        worker.on_message(worker.channel, mock.Mock(delivery_tag=1),
+                          kwargs['properties'], kwargs['body'])
+        worker.process_payload.assert_called_with({'a': 'x' * 20},
+            channel=worker.channel, method_frame=mock.ANY,
+            header_frame=kwargs['properties'])
+
+        # the properties of the caller are not changed
+        properties = pika.BasicProperties(headers={'h': 1})
+        worker.publish({'a': 'x' * 20}, properties=properties)
+        self.assertIsNone(properties.content_encoding)
+        sent = worker.channel.basic_publish.call_args[1]['properties']
+        self.assertEqual((sent.headers, sent.content_encoding),
+                         ({'h': 1}, 'zlib'))
+
+    def test_publish_batch_failures(self):
+        """Per-message failures are reported with their position"""
+        worker = RabbitMQWorker(params={'publish': 'foo', 'exchange': 'bar'})
+        worker.connection = mock.Mock()
+        worker.channel = mock.Mock()
+        worker.confirm_delivery = True
+        tx = worker.connection.channel.return_value
+        tx.tx_commit.side_effect = [None, Exception('nope'), None]
+        tx.basic_publish.side_effect = [None, None, Exception('closed'),
+                                        None, None]
+
+        failures = worker.publish_batch(['0', '1', '2', '3', '4'], window=2)
+        self.assertEqual([x[0] for x in failures], [2, 3, 4])
+        # the broken channel is closed, the next batch opens a new one
+        tx.close.assert_called_once_with()
+        self.assertIsNone(worker.tx_channel)
+        tx.tx_commit.side_effect = tx.basic_publish.side_effect = None
+        self.assertEqual(worker.publish_batch(['5']), [])
+        self.assertEqual(tx.tx_select.call_count, 2)
+
+        # without confirms the batch goes straight to the main channel
+        worker.confirm_delivery = False
+        worker.channel.basic_publish.side_effect = [None, Exception('closed')]
+        failures = worker.publish_batch(['0', '1'])
+        self.assertEqual([x[0] for x in failures], [1])
+
+    def test_forward_batch(self):
+        """Forwarding uses the forwarding connection"""
+        worker = RabbitMQWorker(params={'exchange': 'bar'})
+        self.assertRaises(Exception, worker.forward_batch, ['0'], topic='x')
+
+        worker.fwd_connection = mock.Mock()
+        worker.fwd_channel = mock.Mock()
+        worker.fwd_exchange = 'remote'
+        worker.fwd_topic = 'baz'
+        worker.fwd_confirm_delivery = True
+        tx = worker.fwd_connection.channel.return_value
+
+        self.assertEqual(worker.forward_batch(['0', '1', '2']), [])
+        self.assertEqual(tx.tx_commit.call_count, 1)
+        tx.basic_publish.assert_called_with(exchange='remote', routing_key='baz',
+                                            body='2', properties=None)
+
+    def test_passthrough(self):
+        """Relays forward the raw body and properties without decoding"""
+        worker = RabbitMQWorker(params={
+            'batch_size': 3,
+            'forwarding': {'exchange': 'remote', 'publish': 'baz',
+                           'passthrough': True}})
+        worker.channel = mock.Mock()
+        worker.fwd_channel = mock.Mock()
+        worker.fwd_exchange = 'remote'
+        worker.fwd_topic = 'baz'
+        worker.decode = mock.Mock()
+        worker.process_payload = mock.Mock()
+
+        props = pika.BasicProperties(content_type='application/x-msgpack',
+                                     headers={'a': 1})
+        worker.on_message(None, mock.Mock(delivery_tag=1), props, '\x81\xa1a')
+        worker.fwd_channel.basic_publish.assert_called_with(
+            exchange='remote', routing_key='baz', body='\x81\xa1a',
+            properties=props)
+        worker.channel.basic_ack.assert_called_with(delivery_tag=1)
+
+        # a batch goes at once; what the target refused goes back to the queue
+        worker.fwd_channel.basic_publish.side_effect = [None, Exception('x'),
+                                                        None]
+        for i in range(2, 5):
+            worker.on_batch_message(None, mock.Mock(delivery_tag=i), props,
+                                    'not json {0}'.format(i))
+        worker.channel.basic_nack.assert_called_once_with(delivery_tag=3,
+                                                          requeue=True)
+        self.assertEqual(worker.channel.basic_ack.call_count, 3)
+        self.assertFalse(worker.decode.called)
+        self.assertFalse(worker.process_payload.called)
+
+    def test_batch_consume(self):
+        """Batches are processed together and acked with multiple=True"""
+        class BatchWorker(RabbitMQWorker):
+            def process_batch(self, payloads, **kwargs):
+                self.seen = payloads
+                return [(1, Exception('bad'))]
+
+        worker = BatchWorker(params={'batch_size': 3, 'batch_timeout': 50,
+                                     'exchange': 'bar', 'error': 'err'})
+        worker.connection = mock.Mock()
+        worker.channel = mock.Mock()
+        frames = [mock.Mock(delivery_tag=i) for i in range(1, 4)]
+
+        worker.on_batch_message(None, frames[0], None, json.dumps({'a': 1}))
+        worker.connection.add_timeout.assert_called_once_with(
+            0.05, worker.on_batch_timeout)
+        worker.on_batch_message(None, frames[1], None, json.dumps({'a': 2}))
+        self.assertFalse(worker.channel.basic_ack.called)
+        worker.on_batch_message(None, frames[2], None, 'not json')
+
+        self.assertEqual(worker.seen, [{'a': 1}, {'a': 2}])
+        worker.channel.basic_ack.assert_called_once_with(delivery_tag=3,
+                                                         multiple=True)
+        self.assertTrue(worker.connection.remove_timeout.called)
+        self.assertEqual(worker.batch, [])
+
+        # the undecodable and the failed message went to the error queue
+        bodies = [c[1]['body'] for c in worker.channel.basic_publish.call_args_list]
+        self.assertEqual([json.loads(b) for b in bodies],
+                         [{'BatchWorker': {'undecodable': 'bm90IGpzb24=',
+                                           'content_type': None,
+                                           'content_encoding': None}},
+                          {'BatchWorker': {'a': 2}}])
+
+    def test_undecodable(self):
+        """Bodies that cannot be decoded go to the error queue and are acked"""
+        body = '\x78\x9c\xff\xfe not zlib'
+        header_frame = pika.BasicProperties(content_type='application/json',
+                                            content_encoding='zlib')
+        message = {'undecodable': base64.b64encode(body),
+                   'content_type': 'application/json',
+                   'content_encoding': 'zlib'}
+
+        def errors(worker):
+            return [json.loads(c[1]['body']) for c in
+                    worker.channel.basic_publish.call_args_list]
+
+        worker = RabbitMQWorker(params={'batch_size': 2, 'exchange': 'bar',
+                                        'error': 'err'})
+        worker.connection = mock.Mock()
+        worker.channel = mock.Mock()
+        worker.process_payload = mock.Mock()
+        worker.on_batch_message(None, mock.Mock(delivery_tag=1), header_frame,
+                                body)
+        worker.on_batch_message(None, mock.Mock(delivery_tag=2), None, '{}')
+        worker.channel.basic_ack.assert_called_once_with(delivery_tag=2,
+                                                         multiple=True)
+        self.assertEqual(errors(worker), [{'RabbitMQWorker': message}])
+
+        worker = RabbitMQWorker(params={'exchange': 'bar', 'error': 'err'})
+        worker.channel = mock.Mock()
+        worker.process_payload = mock.Mock()
+        worker.on_message(None, mock.Mock(delivery_tag=3), header_frame, body)
+        self.assertFalse(worker.process_payload.called)
+        worker.channel.basic_ack.assert_called_once_with(delivery_tag=3)
+        self.assertEqual(errors(worker), [{'RabbitMQWorker': message}])
+
+        worker = AsyncRabbitMQWorker(params={'exchange': 'bar',
+                                             'error': 'err'})
+        worker.channel = mock.Mock()
+        worker.process_payload = mock.Mock()
+        future = worker.on_message(None, mock.Mock(delivery_tag=4),
+                                   header_frame, body)
+        self.assertIsNone(future.result())
+        self.assertFalse(worker.process_payload.called)
+        self.assertEqual(worker.in_flight, 0)
+        worker.channel.basic_ack.assert_called_once_with(delivery_tag=4)
+        self.assertEqual(errors(worker), [{'AsyncRabbitMQWorker': message}])
+
+    def test_batch_timeout(self):
+        """An incomplete batch is flushed by the timer"""
+        worker = RabbitMQWorker(params={'batch_size': 10})
+        worker.connection = mock.Mock()
+        worker.channel = mock.Mock()
+        worker.process_payload = mock.Mock()
+        worker.on_batch_message(None, mock.Mock(delivery_tag=7), None, '{}')
+        worker.on_batch_timeout()
+        worker.process_payload.assert_called_once_with(
+            {}, channel=worker.channel, method_frame=mock.ANY,
+            header_frame=None)
+        worker.channel.basic_ack.assert_called_once_with(delivery_tag=7,
+                                                         multiple=True)
+        self.assertFalse(worker.connection.remove_timeout.called)
+
+    def test_async_worker(self):
+        """Messages are processed concurrently and acked when done"""
+        class SlowWorker(AsyncRabbitMQWorker):
+            peak = 0
+            @gen.coroutine
+            def process_payload(self, msg, **kwargs):
+                SlowWorker.peak = max(SlowWorker.peak, self.in_flight)
+                yield gen.sleep(0.01)
+                if msg.get('fail'):
+                    raise Exception('failed')
+
+        worker = SlowWorker(params={'exchange': 'bar', 'error': 'err'})
+        worker.ioloop = ioloop.IOLoop()
+        worker.channel = mock.Mock()
+
+        @gen.coroutine
+        def consume():
+            futures = [worker.on_message(None, mock.Mock(delivery_tag=i), None,
+                                         json.dumps({'fail': i == 2}))
+                       for i in range(1, 4)]
+            for f in futures:
+                try:
+                    yield f
+                except Exception:
+                    pass
+            yield gen.moment
+
+        worker.ioloop.run_sync(consume)
+
+        self.assertEqual(SlowWorker.peak, 3)
+        self.assertEqual(worker.in_flight, 0)
+        self.assertEqual(sorted(c[1]['delivery_tag'] for c in
+                                worker.channel.basic_ack.call_args_list),
+                         [1, 2, 3])
+        body = worker.channel.basic_publish.call_args[1]['body']
+        self.assertEqual(json.loads(body), {'SlowWorker': {'fail': True}})
+
+    def test_async_worker_plain_payload(self):
+        """A plain (non-coroutine) process_payload works too"""
+        worker = AsyncRabbitMQWorker(params={'max_in_flight': 4})
+        worker.ioloop = ioloop.IOLoop()
+        worker.channel = mock.Mock()
+        worker.process_payload = mock.Mock(return_value='ok')
+
+        worker.ioloop.run_sync(lambda: worker.on_message(
+                                None, mock.Mock(delivery_tag=5), None, '{}'))
+        worker.ioloop.run_sync(lambda: gen.moment)
+        worker.channel.basic_ack.assert_called_once_with(delivery_tag=5)
+        self.assertEqual(worker.results, 'ok')
+
+        worker.on_channel_open(worker.channel)
+        worker.channel.basic_qos.assert_called_once_with(
+            worker.on_queue_declared, prefetch_count=4)
+
+    def test_threadpool_worker(self):
+        """Payloads run in the pool, acks are sent by the connection thread"""
+        worker = RabbitMQWorker(params={'execution': 'threadpool', 'threads': 4,
+                                        'subscribe': 'foo', 'exchange': 'bar',
+                                        'error': 'err'})
+        def process_payload(msg, **kwargs):
+            worker.publish(msg, topic='out')
+            if msg['a'] == 2:
+                raise Exception('x')
+
+        worker.process_payload = process_payload
+        worker.connection = mock.Mock()
+        worker.channel = mock.Mock()
+        worker.executor = ThreadPoolExecutor(max_workers=4)
+
+        worker.on_message(None, mock.Mock(delivery_tag=1), None, '{"a": 1}')
+        worker.on_message(None, mock.Mock(delivery_tag=2), None, '{"a": 2}')
+        worker.executor.shutdown(wait=True)
+
+        # nothing is sent from the pool threads
+        self.assertFalse(worker.channel.basic_ack.called)
+        self.assertFalse(worker.channel.basic_publish.called)
+
+        def poll(time_limit):
+            worker.consuming = False
+        worker.connection.process_data_events.side_effect = poll
+        worker.logger = mock.Mock()
+        worker.consume_threaded()
+
+        self.assertEqual(sorted(c[1]['delivery_tag'] for c in
+                                worker.channel.basic_ack.call_args_list),
+                         [1, 2])
+        # the published messages, then the failed one to the error queue
+        published = [c[1]['routing_key'] for c in
+                     worker.channel.basic_publish.call_args_list]
+        self.assertEqual(sorted(published), ['err', 'out', 'out'])
+        # with the traceback of the pool thread
+        offloaded = [c[0][0] for c in worker.logger.warning.call_args_list
+                     if c[0][0].startswith('Offloading')]
+        self.assertIn('in process_payload', offloaded[0])
+
+    @patch('ADSDeploy.pipeline.generic.pika')
+    def test_threadpool_prefetch(self, pika):
+        """Prefetch follows the size of the pool"""
+        worker = RabbitMQWorker(params={'execution': 'threadpool', 'threads': 8})
+        worker.connect('amqp://')
+        channel = pika.BlockingConnection.return_value.channel.return_value
+        channel.basic_qos.assert_called_once_with(prefetch_count=8)
+
+        # unless it is configured
+        worker = RabbitMQWorker(params={'execution': 'threadpool', 'threads': 8,
+                                        'prefetch': 32})
+        worker.connect('amqp://')
+        channel.basic_qos.assert_called_with(prefetch_count=32)
+
+    @patch('ADSDeploy.pipeline.generic.random.choice', side_effect=lambda x: x[1])
+    def test_retry(self, *args):
+        """Failed messages are retried with backoff, then go to errors"""
+        worker = RabbitMQWorker(params={
+            'subscribe': 'foo', 'exchange': 'bar', 'error': 'err',
+            'retry': {'attempts': 2, 'delay': 1000, 'jitter': 0.2}})
+        worker.channel = mock.Mock()
+        worker.process_payload = mock.Mock(side_effect=Exception('502'))
+
+        worker.on_message(None, mock.Mock(delivery_tag=1), None, '{"a": 1}')
+        kwargs = worker.channel.basic_publish.call_args[1]
+        self.assertEqual(kwargs['exchange'], '')
+        # the jitter picks one of the tiers, the queue has the TTL
+        self.assertEqual(kwargs['routing_key'], 'foo.retry.900')
+        self.assertEqual(kwargs['properties'].headers, {'x-retry-attempt': 1})
+        self.assertIsNone(kwargs['properties'].expiration)
+
+        header = mock.Mock(headers={'x-retry-attempt': 1, 'other': 'x'},
+                           delivery_mode=2)
+        worker.on_message(None, mock.Mock(delivery_tag=2), header, '{"a": 1}')
+        kwargs = worker.channel.basic_publish.call_args[1]
+        self.assertEqual(kwargs['routing_key'], 'foo.retry.1800')
+        self.assertEqual(kwargs['properties'].headers,
+                         {'x-retry-attempt': 2, 'other': 'x'})
+        self.assertEqual(kwargs['properties'].delivery_mode, 2)
+
+        header.headers['x-retry-attempt'] = 2
+        worker.on_message(None, mock.Mock(delivery_tag=3), header, '{"a": 1}')
+        kwargs = worker.channel.basic_publish.call_args[1]
+        self.assertEqual(kwargs['routing_key'], 'err')
+        self.assertEqual(json.loads(kwargs['body']), {'RabbitMQWorker': {'a': 1}})
+        self.assertEqual(worker.channel.basic_ack.call_count, 3)
+
+    @patch('ADSDeploy.pipeline.generic.RabbitMQWorker')
+    def test_retry_topology(self, mocked_worker):
+        """The TaskMaster declares the retry queues"""
+        params = {'subscribe': 'foo', 'durable': True,
+                  'retry': {'attempts': 2, 'delay': 500, 'multiplier': 3,
+                            'jitter': 0.2, 'tiers': 3}}
+        self.assertEqual(generic.get_retry_queues(params), [
+            [('foo.retry.400', 400), ('foo.retry.450', 450),
+             ('foo.retry.500', 500)],
+            [('foo.retry.1200', 1200), ('foo.retry.1350', 1350),
+             ('foo.retry.1500', 1500)]])
+
+        tm = pstart.TaskMaster('amqp://', 'ex', {}, {'Foo': params})
+        tm.initialize_rabbitmq()
+        channel = mocked_worker.return_value.channel
+        channel.queue_declare.assert_any_call(
+            queue='foo.retry.1350', durable=True, passive=False,
+            exclusive=False, auto_delete=False,
+            arguments={'x-message-ttl': 1350,
+                       'x-dead-letter-exchange': 'ex',
+                       'x-dead-letter-routing-key': 'foo'})
+        self.assertEqual(channel.queue_declare.call_count, 7)
+
+    def test_local_transport(self):
+        """Local workers pass messages through pipes, without the broker"""
+        self.addCleanup(transports.reset)
+
+        class Stage(RabbitMQWorker):
+            def process_payload(self, msg, **kwargs):
+                self.publish({'n': msg['n'] + 1})
+
+        tm = pstart.TaskMaster('amqp://localhost', 'ex', {}, {})
+        tm.declare_queues(transports.LOCAL_URL, {
+            'Stage': {'subscribe': 'in', 'publish': 'mid',
+                      'retry': {'attempts': 1, 'delay': 500}},
+            'Sink': {'subscribe': 'mid'}})
+
+        first = Stage(params={'subscribe': 'in', 'publish': 'mid',
+                              'exchange': 'ex', 'TEST_RUN': True})
+        first.connect(transports.LOCAL_URL)
+        first.subscribe(first.on_message)
+        sink = RabbitMQWorker(params={'subscribe': 'mid', 'TEST_RUN': True})
+        sink.connect(transports.LOCAL_URL)
+        received = []
+        sink.process_payload = lambda msg, **kwargs: received.append(msg)
+        sink.subscribe(sink.on_message)
+
+        for n in range(3):
+            first.channel.basic_publish(exchange='ex', routing_key='in',
+                                        body=json.dumps({'n': n}))
+        # the retry queue leads straight back to the worker's queue
+        first.channel.basic_publish(exchange='', routing_key='in.retry.500',
+                                    body=json.dumps({'n': 3}))
+        first.connection.process_data_events(time_limit=0.5)
+        sink.connection.process_data_events(time_limit=0.5)
+        self.assertEqual(sorted(x['n'] for x in received), [1, 2, 3, 4])
+
+        # unacknowledged messages come back when the connection is closed
+        connection = transports.LocalConnection()
+        channel = connection.channel()
+        channel.basic_consume(lambda *args: None, queue='mid')
+        first.publish({'n': 5})
+        connection.process_data_events(time_limit=0.5)
+        self.assertEqual(len(channel.unacked), 1)
+        connection.close()
+        sink.connection.process_data_events(time_limit=0.5)
+        self.assertEqual(received[-1], {'n': 5})
+        self.assertRaises(pika.exceptions.ChannelClosed,
+                          first.channel.queue_declare, 'nope', passive=True)
+
+    def test_memory_broker(self):
+        """The in-memory broker routes, acks, expires and dead-letters"""
+        self.addCleanup(memory.reset)
+        connection = memory.MemoryConnection()
+        channel = connection.channel()
+        channel.exchange_declare(exchange='ex', type='topic')
+        for queue, key in (('all', 'ads.#'), ('errors', 'ads.*.error')):
+            channel.queue_declare(queue=queue)
+            channel.queue_bind(queue=queue, exchange='ex', routing_key=key)
+
+        channel.basic_publish('ex', 'ads.deploy.error', 'e')
+        channel.basic_publish('ex', 'ads', 'a')
+        channel.basic_publish('ex', 'other', 'x')
+        self.assertEqual(channel.queue_declare('all', passive=True)
+                         .method.message_count, 2)
+        self.assertEqual(channel.basic_get('errors', no_ack=True)[2], 'e')
+        self.assertEqual(channel.basic_get('errors'), (None, None, None))
+
+        # rejected messages come back, redelivered
+        method, _, body = channel.basic_get('all')
+        channel.basic_nack(delivery_tag=method.delivery_tag)
+        method, _, body = channel.basic_get('all')
+        self.assertEqual((body, method.redelivered), ('e', True))
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        self.assertEqual(channel.queue_purge('all').method.message_count, 1)
+
+        # delayed retry: expires in the retry queue, goes back to 'all'
+        channel.queue_declare(queue='retry', arguments={
+            'x-message-ttl': 50, 'x-dead-letter-exchange': 'ex',
+            'x-dead-letter-routing-key': 'ads.retry'})
+        channel.basic_publish('', 'retry', 'r')
+        received = []
+        channel.basic_qos(prefetch_count=1)
+        channel.basic_consume(lambda ch, method, props, body:
+                              received.append(body), queue='all')
+        connection.process_data_events(time_limit=0.02)
+        self.assertEqual(received, [])
+        connection.process_data_events(time_limit=0.2)
+        self.assertEqual(received, ['r'])
+
+        # tx publishes wait for the commit; errors close the channel
+        tx = connection.channel()
+        tx.tx_select()
+        tx.basic_publish('ex', 'ads.x', 'tx')
+        self.assertEqual(channel.queue_declare('all').method.message_count, 0)
+        tx.tx_commit()
+        self.assertEqual(channel.queue_declare('all').method.message_count, 1)
+        self.assertRaises(pika.exceptions.ChannelClosed,
+                          tx.queue_declare, 'nope', passive=True)
+        self.assertFalse(tx.is_open)
+
+        # unacked messages are requeued when the connection goes away
+        connection.close()
+        self.assertEqual(memory.MemoryConnection().channel().queue_declare(
+            'all', passive=True).method.message_count, 2)
+
+    def test_drain(self):
+        """A drained worker finishes its messages, the rest stay queued"""
+        self.addCleanup(memory.reset)
+        channel = memory.MemoryConnection().channel()
+        channel.queue_declare(queue='in')
+
+        for execution in ('inline', 'threadpool'):
+            processed = []
+
+            class SlowWorker(RabbitMQWorker):
+                def process_payload(self, msg, **kwargs):
+                    processed.append(msg['i'])
+                    if len(processed) == 2:
+                        self.drain()
+                    time.sleep(0.05)
+
+            for i in range(30):
+                channel.basic_publish('', 'in', json.dumps({'i': i}))
+            worker = SlowWorker({'subscribe': 'in', 'execution': execution,
+                                 'threads': 2,
+                                 'RABBITMQ_URL': memory.MEMORY_URL})
+            thread = threading.Thread(target=worker.run)
+            thread.start()
+            thread.join(5)
+
+            self.assertFalse(thread.is_alive())
+            remaining = channel.queue_purge('in').method.message_count
+            # nothing was lost and nothing was processed twice
+            self.assertLess(len(processed), 30)
+            self.assertEqual(sorted(processed), range(len(processed)))
+            self.assertEqual(len(processed) + remaining, 30)
+
+    def test_error_handler(self):
+        """Failed messages are stored in bulk and can be replayed"""
+        worker = ExampleWorker(params={'subscribe': 'example', 'exchange': 'ex',
+                                       'error': 'errors'})
+        worker.channel = mock.Mock()
+        worker.on_message(None, mock.Mock(delivery_tag=1), None, '{"bad": 1}')
+        properties = worker.channel.basic_publish.call_args[1]['properties']
+        body = worker.channel.basic_publish.call_args[1]['body']
+        self.assertEqual(properties.headers['x-source-queue'], 'example')
+        self.assertIn('missing foo', properties.headers['x-exception'])
+
+        handler = errors.ErrorHandler(params={'subscribe': 'errors'})
+        self.assertEqual(handler.batch_size, 100)
+        handler.channel = mock.Mock()
+        handler.connection = mock.Mock()
+        handler.on_batch_message(None, mock.Mock(delivery_tag=1), properties, body)
+        handler.on_batch_message(None, mock.Mock(delivery_tag=2), None,
+                                 json.dumps({'Other': 'x'}))
+        handler.flush_batch()
+        handler.channel.basic_ack.assert_called_once_with(delivery_tag=2,
+                                                          multiple=True)
+        # nothing was sent back to the error queue
+        self.assertFalse(handler.channel.basic_publish.called)
+
+        with app.session_scope() as session:
+            records = [r.toJSON() for r in session.query(FailedMessage).all()]
+        self.assertEqual([(r['worker'], r['queue'], json.loads(r['payload']))
+                          for r in records],
+                         [('ExampleWorker', 'example', {'bad': 1}),
+                          ('Other', None, 'x')])
+
+        with patch('ADSDeploy.pipeline.generic.RabbitMQWorker') as publisher:
+            publish_batch = publisher.return_value.publish_batch
+            publish_batch.return_value = []
+            self.assertEqual(errors.replay(rate=1000), (1, 0))
+            self.assertEqual(errors.replay(rate=1000), (0, 0))
+        publish_batch.assert_called_once_with([json.dumps({'bad': 1})],
+                                              topic='example', window=100)
+
+    def test_error_handler_failure(self):
+        """A failed insert leaves the batch unacknowledged"""
+        handler = errors.ErrorHandler()
+        handler.channel = mock.Mock()
+        handler.connection = mock.Mock()
+        handler.on_batch_message(None, mock.Mock(delivery_tag=1), None, '{}')
+        with patch('ADSDeploy.app.session_scope', side_effect=Exception('db')):
+            self.assertRaises(Exception, handler.flush_batch)
+        self.assertFalse(handler.channel.basic_ack.called)
+        self.assertFalse(handler.channel.basic_publish.called)
+
+        # the session can be passed in instead of the app's
+        factory = mock.Mock()
+        errors.ErrorHandler(session=factory).process_batch([{'W': 1}])
+        self.assertEqual(len(factory.return_value.bulk_save_objects
+                             .call_args[0][0]), 1)
+        factory.return_value.commit.assert_called_once_with()
+
+    def test_error_handler_threadpool(self):
+        """The ErrorHandler runs in the thread pool too"""
+        factory = mock.Mock()
+        handler = errors.ErrorHandler(params={'batch_size': 0,
+                                              'execution': 'threadpool'},
+                                      session=factory)
+        handler.connection = mock.Mock()
+        handler.channel = mock.Mock()
+        handler.executor = ThreadPoolExecutor(max_workers=2)
+        handler.logger = mock.Mock()
+
+        def poll(time_limit):
+            handler.consuming = False
+        handler.connection.process_data_events.side_effect = poll
+
+        handler.on_message(None, mock.Mock(delivery_tag=1), None,
+                           json.dumps({'W': 1}))
+        handler.executor.shutdown(wait=True)
+        handler.consume_threaded()
+        handler.channel.basic_ack.assert_called_once_with(delivery_tag=1)
+        self.assertEqual(len(factory.return_value.bulk_save_objects
+                             .call_args[0][0]), 1)
+
+        # a failed insert is raised with the traceback of the pool thread,
+        # and the message is not acknowledged
+        handler.executor = ThreadPoolExecutor(max_workers=2)
+        factory.return_value.bulk_save_objects.side_effect = Exception('db')
+        handler.on_message(None, mock.Mock(delivery_tag=2), None,
+                           json.dumps({'W': 2}))
+        handler.executor.shutdown(wait=True)
+        self.assertRaisesRegexp(Exception, 'db', handler.consume_threaded)
+        handler.channel.basic_ack.assert_called_once_with(delivery_tag=1)
+        self.assertIn('in process_batch',
+                      handler.logger.error.call_args[0][0])
+
+    @patch('ADSDeploy.pipeline.generic.spool')
+    def test_spooling(self, mocked_spool):
+        """Messages go to the spool while the broker is unreachable"""
+        worker = RabbitMQWorker(params={'publish': 'foo', 'exchange': 'bar',
+                                        'spool': '/tmp/spool'})
+        worker.channel = mock.Mock()
+        worker.spool = mock.MagicMock()
+        worker.spool.__len__.return_value = 0
+
+        worker.publish({'a': 1})
+        self.assertFalse(worker.spool.append.called)
+
+        worker.channel.basic_publish.side_effect = \
+            pika.exceptions.ConnectionClosed()
+        worker.publish({'a': 2})
+        args = worker.spool.append.call_args[0]
+        self.assertEqual(args[:2], ('bar', 'foo'))
+        self.assertEqual(json.loads(args[2]), {'a': 2})
+
+        # once something is spooled, the order is kept
+        worker.spool.__len__.return_value = 1
+        worker.channel.basic_publish.reset_mock()
+        worker.publish({'a': 3})
+        self.assertFalse(worker.channel.basic_publish.called)
+        self.assertEqual(json.loads(worker.spool.append.call_args[0][2]),
+                         {'a': 3})
+
+    def test_spool_drainer(self):
+        """The spool drains through the transports of the workers"""
+        self.addCleanup(memory.reset)
+        d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, d)
+        channel = memory.MemoryConnection().channel()
+        channel.queue_declare(queue='spooled')
+
+        s = spool.Spool(d)
+        self.addCleanup(s.dir_lock.close)
+        self.addCleanup(s.close)
+        s.append('', 'spooled', '{"a": 1}', pika.BasicProperties())
+        drainer = spool.SpoolDrainer(s, memory.MEMORY_URL,
+                                     connect=RabbitMQWorker().open_connection)
+        self.assertEqual(drainer.drain(), 1)
+        self.assertEqual(channel.basic_get('spooled', no_ack=True)[2],
+                         '{"a": 1}')
+
+    @patch('ADSDeploy.pipeline.generic.spool')
+    @patch('ADSDeploy.pipeline.generic.pika')
+    def test_spooling_forward(self, mocked_pika, mocked_spool):
+        """An unreachable forwarding target does not stop the worker"""
+        mocked_pika.exceptions = pika.exceptions
+        connections = [mock.Mock(), pika.exceptions.AMQPConnectionError('down')]
+        mocked_pika.BlockingConnection.side_effect = connections
+        worker = RabbitMQWorker(params={
+            'spool': '/tmp/spool',
+            'forwarding': {'url': 'amqp://remote', 'exchange': 'remote',
+                           'publish': 'baz'}})
+
+        worker.connect('amqp://local')
+        self.assertIsNone(worker.fwd_channel)
+        self.assertEqual(mocked_spool.SpoolDrainer.call_count, 2)
+        mocked_spool.SpoolDrainer.assert_called_with(
+            worker.fwd_spool, 'amqp://remote', confirm_delivery=False,
+            connect=worker.open_connection)
+
+        worker.fwd_spool.__len__.return_value = 0
+        worker.forward({'a': 1})
+        args = worker.fwd_spool.append.call_args[0]
+        self.assertEqual(args[:2], ('remote', 'baz'))
+        self.assertEqual(json.loads(args[2]), {'a': 1})
+
+    @patch('ADSDeploy.pipeline.generic.time')
+    @patch('ADSDeploy.pipeline.generic.random.uniform', side_effect=lambda a, b: b)
+    def test_reconnect(self, mocked_uniform, mocked_time):
+        """The worker reconnects with backoff when the broker goes away"""
+        # run() installs the signal handlers of a worker process
+        for sig in (signal.SIGTERM, signal.SIGUSR1):
+            self.addCleanup(signal.signal, sig, signal.getsignal(sig))
+
+        class FakeConnection(object):
+            # what happens to the consecutive connections
+            schedule = ['drop', 'refuse', 'refuse', 'drop', 'ok']
+            opened = []
+
+            def __init__(self, parameters):
+                self.outcome = FakeConnection.schedule.pop(0)
+                if self.outcome == 'refuse':
+                    raise pika.exceptions.AMQPConnectionError('refused')
+                FakeConnection.opened.append(self)
+                self.is_open = True
+                self.chan = mock.Mock()
+                self.chan.start_consuming.side_effect = self.consume
+
+            def consume(self):
+                if self.outcome == 'drop':
+                    self.is_open = False
+                    raise pika.exceptions.ConnectionClosed(320, 'forced')
+
+            def channel(self):
+                return self.chan
+
+            def add_timeout(self, deadline, callback_method):
+                pass
+
+            def close(self):
+                self.is_open = False
+
+        clock = [0]
+        def sleep(seconds):
+            clock[0] += seconds
+        mocked_time.sleep.side_effect = sleep
+        mocked_time.time.side_effect = lambda: clock[0]
+
+        worker = RabbitMQWorker(params={'subscribe': 'foo',
+                                        'RABBITMQ_URL': 'amqp://localhost',
+                                        'reconnect': {'delay': 1, 'max_delay': 3}})
+        with patch('ADSDeploy.pipeline.generic.pika.BlockingConnection',
+                   FakeConnection):
+            worker.run()
+
+        self.assertEqual(len(FakeConnection.opened), 3)
+        self.assertEqual(worker.reconnects, 4)
+        # 1 + 2 (refused twice) + 3 (capped), then 1 after the second drop
+        self.assertEqual([c[0][0] for c in mocked_time.sleep.call_args_list],
+                         [1, 2, 3, 1])
+        self.assertEqual(worker.downtime, 7)
+        for c in FakeConnection.opened:
+            c.chan.queue_declare.assert_called_once_with(queue='foo', passive=True)
+            self.assertEqual(c.chan.basic_consume.call_count, 1)
+        self.assertEqual(worker.generation, 4)
+
+    @patch('ADSDeploy.pipeline.generic.pika.BlockingConnection',
+           side_effect=pika.exceptions.AMQPConnectionError('refused'))
+    @patch('ADSDeploy.pipeline.generic.time')
+    def test_reconnect_gives_up(self, mocked_time, connection):
+        """Reconnecting can be limited or switched off"""
+        # run() installs the signal handlers of a worker process
+        for sig in (signal.SIGTERM, signal.SIGUSR1):
+            self.addCleanup(signal.signal, sig, signal.getsignal(sig))
+        worker = RabbitMQWorker(params={'RABBITMQ_URL': 'amqp://localhost',
+                                        'reconnect': {'attempts': 2}})
+        self.assertRaises(pika.exceptions.AMQPConnectionError, worker.run)
+        self.assertEqual(worker.reconnects, 2)
+
+        worker = RabbitMQWorker(params={'RABBITMQ_URL': 'amqp://localhost',
+                                        'reconnect': False})
+        self.assertRaises(pika.exceptions.AMQPConnectionError, worker.run)
+        self.assertEqual(worker.reconnects, 0)
+
+        # a missing queue does not come back by reconnecting
+        worker = RabbitMQWorker(params={'RABBITMQ_URL': memory.MEMORY_URL,
+                                        'subscribe': 'missing'})
+        self.assertRaises(pika.exceptions.ChannelClosed, worker.run)
+        self.assertEqual(worker.reconnects, 0)
+        self.assertTrue(generic.is_transient(
+            pika.exceptions.ChannelClosed(320, 'CONNECTION_FORCED')))
+        self.assertFalse(generic.is_transient(
+            pika.exceptions.ChannelClosed(403, 'ACCESS_REFUSED')))
+
+        # neither do bad credentials, even with the default attempts
+        connection.side_effect = \
+            pika.exceptions.ProbableAuthenticationError('bad password')
+        worker = RabbitMQWorker(params={'RABBITMQ_URL': 'amqp://localhost'})
+        self.assertRaises(pika.exceptions.ProbableAuthenticationError,
+                          worker.run)
+        self.assertEqual(worker.reconnects, 0)
+        self.assertFalse(generic.is_transient(
+            pika.exceptions.ProbableAccessDeniedError('bad vhost')))
+        self.assertFalse(generic.is_transient(
+            pika.exceptions.IncompatibleProtocolError()))
+        self.assertTrue(generic.is_transient(
+            pika.exceptions.AMQPConnectionError('refused')))
+
+    def test_get_worker_class(self):
+        """Workers are found by their name in the config"""
+        self.assertIs(pstart.get_worker_class('example.ExampleWorker'),
+                      ExampleWorker)
+        self.assertIs(pstart.get_worker_class('AsyncRabbitMQWorker'),
+                      AsyncRabbitMQWorker)
+        self.assertIs(pstart.get_worker_class(
+            'ADSDeploy.pipeline.generic.RabbitMQWorker'), RabbitMQWorker)
+
+    def test_prefork(self):
+        """Worker processes are forked from the master and made there"""
+        started = multiprocessing.Queue()
+        pool = app.session.bind.pool
+
+        @pstart.register('forked')
+        class ForkedWorker(RabbitMQWorker):
+            def run(self):
+                started.put((os.getpid(), app.session.bind.pool is pool,
+                             self.params['subscribe'],
+                             signal.getsignal(signal.SIGTERM)))
+
+        self.addCleanup(pstart.registry.pop, 'forked')
+        # installed by start_pipeline(), not for the workers
+        self.addCleanup(signal.signal, signal.SIGTERM,
+                        signal.signal(signal.SIGTERM, lambda *args: None))
+        self.assertIs(pstart.get_worker_class('forked'), ForkedWorker)
+
+        task_master = pstart.TaskMaster('amqp://localhost', 'test', {}, {
+            'forked': {'subscribe': 'in', 'concurrency': 2}},
+            backoff={'min_uptime': 0})
+        task_master.start_workers(verbose=False)
+        results = [started.get(timeout=5) for i in range(2)]
+
+        self.assertEqual(len(set(x[0] for x in results)), 2)
+        self.assertNotIn(os.getpid(), [x[0] for x in results])
+        # the database connections and the signal handlers of the master
+        # are not shared
+        self.assertEqual([x[1:] for x in results],
+                         [(False, 'in', signal.SIG_DFL)] * 2)
+
+        # the workers that are gone are replaced
+        for active in task_master.workers['forked']['active']:
+            active['proc'].join(5)
+        task_master.reap_workers()
+        self.assertEqual(task_master.workers['forked']['active'], [])
+        task_master.start_workers(verbose=False)
+        self.assertEqual(len(set(started.get(timeout=5)[0]
+                                 for i in range(2))), 2)
+        for active in task_master.workers['forked']['active']:
+            active['proc'].join(5)
+
+    def test_recycling(self):
+        """Expired workers are replaced first, then drained (or killed)"""
+
+        @pstart.register('recycled')
+        class RecycledWorker(RabbitMQWorker):
+            def run(self):
+                while not self.draining:
+                    time.sleep(0.01)
+
+        @pstart.register('stubborn')
+        class StubbornWorker(RabbitMQWorker):
+            def run(self):
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                time.sleep(60)
+
+        self.addCleanup(pstart.registry.pop, 'recycled')
+        self.addCleanup(pstart.registry.pop, 'stubborn')
+        task_master = pstart.TaskMaster('amqp://localhost', 'test', {}, {
+            'recycled': {'subscribe': 'in'},
+            'stubborn': {'subscribe': 'in', 'concurrency': 2}},
+            drain_timeout=0.5, ttl_jitter=0.2)
+        task_master.start_workers(verbose=False)
+        recycled = task_master.workers['recycled']['active']
+        stubborn = task_master.workers['stubborn']['active']
+        old = recycled[0]
+        self.assertTrue(0.8 <= old['ttl_factor'] <= 1.2)
+        time.sleep(0.2)
+
+        task_master.reap_workers(ttl=0.1)
+        task_master.start_workers(verbose=False)
+        # the replacements run before the old workers are gone
+        self.assertEqual(len(recycled), 2)
+        self.assertEqual(len(stubborn), 4)
+        self.assertTrue(old['draining'])
+        old['proc'].join(1)
+        task_master.reap_workers(ttl=60)
+        self.assertEqual(len(recycled), 1)
+        self.assertIsNot(recycled[0], old)
+        self.assertEqual(task_master.stats['recycled']['failures'], 0)
+
+        # the stubborn ones ignore SIGTERM and are killed after the timeout
+        self.assertEqual(len(stubborn), 4)
+        self.assertAlmostEqual(task_master.next_check(60), 0.5, delta=0.1)
+        time.sleep(0.6)
+        task_master.reap_workers(ttl=60)
+        self.assertEqual(len(stubborn), 2)
+        self.assertEqual(task_master.stats['stubborn']['restarts'], 0)
+
+        for params in task_master.workers.values():
+            for active in params['active']:
+                task_master.drain_worker(active)
+                task_master.kill_worker(active)
+                active['proc'].join(1)
+
+    def test_abandoned_thread(self):
+        """A thread that does not drain counts until it exits"""
+        stuck = threading.Event()
+
+        @pstart.register('stuck')
+        class StuckWorker(RabbitMQWorker):
+            def run(self):
+                stuck.wait(5)
+
+        self.addCleanup(pstart.registry.pop, 'stuck')
+        self.addCleanup(stuck.set)
+        task_master = pstart.TaskMaster('amqp://localhost', 'test', {}, {
+            'stuck': {'subscribe': 'in'}}, drain_timeout=0.1)
+        task_master.start_workers(verbose=False)
+        stuck_workers = task_master.workers['stuck']['active']
+        first = stuck_workers[0]
+        task_master.drain_worker(first)
+        task_master.start_workers(verbose=False)
+        second = stuck_workers[1]
+        task_master.drain_worker(second)
+        time.sleep(0.2)
+
+        task_master.reap_workers(ttl=60)
+        task_master.start_workers(verbose=False)
+        # they cannot be killed: no more threads are started meanwhile
+        self.assertEqual(stuck_workers, [first, second])
+        self.assertTrue(first['abandoned'] and second['abandoned'])
+        self.assertGreater(task_master.next_check(60), 1)
+
+        stuck.set()
+        first['proc'].join(1)
+        second['proc'].join(1)
+        task_master.reap_workers(ttl=60)
+        task_master.start_workers(verbose=False)
+        self.assertEqual(len(stuck_workers), 1)
+        self.assertNotIn(stuck_workers[0], [first, second])
+        stuck_workers[0]['proc'].join(1)
+
+    def test_stop_workers(self):
+        """On shutdown the workers drain and report what they finished"""
+
+        @pstart.register('draining')
+        class DrainingWorker(RabbitMQWorker):
+            def run(self):
+                self.install_drain_handler()
+                while not self.draining:
+                    time.sleep(0.01)
+                self.drained = 3
+
+        @pstart.register('stubborn')
+        class StubbornWorker(RabbitMQWorker):
+            def run(self):
+                signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                time.sleep(60)
+
+        self.addCleanup(pstart.registry.pop, 'draining')
+        self.addCleanup(pstart.registry.pop, 'stubborn')
+        task_master = pstart.TaskMaster('amqp://localhost', 'test', {}, {
+            'draining': {'subscribe': 'in', 'concurrency': 2},
+            'stubborn': {'subscribe': 'in', 'concurrency': 2}},
+            drain_timeout=0.5)
+        task_master.start_workers(verbose=False)
+        procs = [active['proc'] for params in task_master.workers.values()
+                 for active in params['active']]
+        time.sleep(0.2)
+
+        report = task_master.stop_workers()
+        self.assertFalse(task_master.running)
+        self.assertEqual(report['workers'], 4)
+        self.assertEqual(report['drained'], 6)
+        self.assertEqual(report['killed'], 2)
+        self.assertEqual(report['abandoned'], 0)
+        self.assertAlmostEqual(report['seconds'], 0.5, delta=0.3)
+        self.assertEqual(task_master.stats['draining']['drained'], 6)
+        for proc in procs:
+            proc.join(1)
+            self.assertFalse(proc.is_alive())
+        self.assertEqual([params['active']
+                          for params in task_master.workers.values()],
+                         [[], []])
+
+    def test_autoscaling(self):
+        """The number of workers follows the depth of their queue"""
+        self.addCleanup(memory.reset)
+        channel = memory.MemoryConnection().channel()
+        channel.queue_declare(queue='in')
+
+        @pstart.register('scaled')
+        class ScaledWorker(RabbitMQWorker):
+            def run(self):
+                while not self.draining:
+                    time.sleep(0.01)
+
+        self.addCleanup(pstart.registry.pop, 'scaled')
+        task_master = pstart.TaskMaster(memory.MEMORY_URL, 'test', {}, {
+            'scaled': {'subscribe': 'in', 'min_concurrency': 1,
+                       'max_concurrency': 3}},
+            autoscale={'interval': 0, 'up_depth': 10, 'down_depth': 2,
+                       'up_cooldown': 0, 'down_cooldown': 60})
+        self.addCleanup(task_master.stop_workers, 1)
+        active = task_master.workers['scaled'].setdefault('active', [])
+        task_master.start_workers(verbose=False)
+        self.assertEqual(len(active), 1)
+
+        # a backlog gets as many workers as it needs, within the limits
+        for i in range(25):
+            channel.basic_publish('', 'in', json.dumps({'i': i}))
+        with mock.patch.object(pstart.logger, 'info') as info:
+            task_master.autoscale()
+        self.assertIn('1 -> 3 (scale up); queue in: 25 messages',
+                      info.call_args[0][0])
+        task_master.start_workers(verbose=False)
+        self.assertEqual(len(active), 3)
+        for i in range(100):
+            channel.basic_publish('', 'in', json.dumps({'i': i}))
+        task_master.autoscale()
+        self.assertEqual(task_master.workers['scaled']['concurrency'], 3)
+
+        # between the thresholds nothing changes, then the cooldown holds
+        channel.queue_purge('in')
+        for i in range(10):
+            channel.basic_publish('', 'in', json.dumps({'i': i}))
+        self.assertEqual(task_master.scale('scaled', task_master.workers[
+            'scaled'], 10, 3), (3, 'steady'))
+        channel.queue_purge('in')
+        task_master.autoscale()
+        self.assertEqual(task_master.workers['scaled']['concurrency'], 3)
+
+        # an empty queue is scaled down a step at a time, the youngest first
+        task_master.stats['scaled']['last_scaled'] -= 61
+        youngest = max(active, key=lambda x: x['start'])
+        task_master.autoscale()
+        self.assertEqual(task_master.workers['scaled']['concurrency'], 2)
+        self.assertTrue(youngest['draining'])
+        youngest['proc'].join(1)
+        task_master.reap_workers()
+        task_master.start_workers(verbose=False)
+        self.assertEqual(len(active), 2)
+        self.assertNotIn(youngest, active)
+
+    def test_supervision(self):
+        """A worker that exits is replaced at once, a crash loop backs off"""
+        runs = []
+
+        @pstart.register('crashing')
+        class CrashingWorker(RabbitMQWorker):
+            def run(self):
+                runs.append(time.time())
+                raise Exception('crashed')
+
+        self.addCleanup(pstart.registry.pop, 'crashing')
+        self.addCleanup(signal.signal, signal.SIGCHLD,
+                        signal.getsignal(signal.SIGCHLD))
+        task_master = pstart.TaskMaster('amqp://localhost', 'test', {}, {
+            'crashing': {'subscribe': 'in'}},
+            backoff={'delay': 0.2, 'max_delay': 1, 'min_uptime': 10})
+        task_master.watch()
+        start = time.time()
+        task_master.start_workers(verbose=False)
+
+        # woken up by the exit, not by the poll interval
+        task_master.wait(5)
+        self.assertLess(time.time() - start, 1)
+        task_master.reap_workers()
+        task_master.start_workers(verbose=False)
+        stats = task_master.stats['crashing']
+        self.assertEqual(stats['restarts'], 1)
+        self.assertLess(stats['last_latency'], 1)
+
+        # the second crash in a row waits 0.2s
+        task_master.wait(5)
+        task_master.reap_workers()
+        self.assertAlmostEqual(task_master.next_check(60), 0.2, delta=0.1)
+        task_master.start_workers(verbose=False)
+        self.assertEqual(task_master.workers['crashing']['active'], [])
+        task_master.wait(task_master.next_check(60))
+        task_master.start_workers(verbose=False)
+        task_master.workers['crashing']['active'][0]['proc'].join()
+
+        self.assertEqual(len(runs), 3)
+        self.assertGreaterEqual(runs[2] - runs[1], 0.2)
+        self.assertEqual(stats['restarts'], 2)
+        self.assertEqual(REGISTRY.get_sample_value(
+            'adsdeploy_worker_restarts_total', {'worker': 'crashing'}), 2)
     
     
 
+class TestMemoryPipeline(test_base.TestFunctional):
+    """
+    The functional test base running against the in-memory broker
+    """
+
+    def setUp(self):
+        config = utils.load_config()
+        config['TEST_RABBITMQ_URL'] = memory.MEMORY_URL
+        with patch('ADSDeploy.tests.test_base.utils.load_config',
+                   return_value=config):
+            super(TestMemoryPipeline, self).setUp()
+
+    def test_pipeline(self):
+        """Messages go through the workers without RabbitMQ"""
+        params = {'subscribe': 'example', 'publish': 'example.out',
+                  'exchange': self.TM.exchange, 'error': 'ads.deploy.error',
+                  'TEST_RUN': True}
+        self.TM.workers['example.ExampleWorker'] = params
+        self.TM.initialize_rabbitmq()
+
+        worker = ExampleWorker(params)
+        worker.connect(self.app.config['RABBITMQ_URL'])
+        worker.subscribe(worker.on_message)
+
+        self.publish_worker.exchange = self.TM.exchange
+        self.publish_worker.publish({'foo': 'bar'}, topic='example')
+        self.publish_worker.publish({'bad': 1}, topic='example')
+        worker.connection.process_data_events(time_limit=0.1)
+
+        channel = self.publish_worker.channel
+        self.assertEqual(json.loads(channel.basic_get('example.out')[2]),
+                         {'foo': 'bar'})
+        method, properties, body = channel.basic_get('ads.deploy.error')
+        self.assertEqual(json.loads(body), {'ExampleWorker': {'bad': 1}})
+        self.assertEqual(properties.headers['x-source-queue'], 'example')
+
+
 if __name__ == '__main__':
     unittest.main()        
         
\ No newline at end of file
@@ -6,9 +6,14 @@ project, and so do not belong to anything specific.
 
 
 import os
+import atexit
 import logging
 import imp
+import multiprocessing
 import sys
+import threading
+import Queue
+from collections import defaultdict
 from dateutil import parser, tz
 from datetime import datetime
 
@@ -87,6 +92,44 @@ def load_module(filename):
     from_object(d, res)
     return res
 
+LOG_FORMAT = '%(levelname)s\t%(process)d [%(asctime)s]:\t%(message)s'
+LOG_DATEFMT = '%m/%d/%Y %H:%M:%S'
+
+# how the loggers of setup_logging() write, see configure_logging()
+log_settings = {'queue': None, 'writer': None, 'sampling': 1}
+
+# names of the loggers made by setup_logging()
+log_names = set()
+
+
+def log_file(name_):
+    """
+    :param name_: name of the logger
+    :return: path of its log file (in logs/)
+    """
+    fn_path = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')), 'logs')
+    if not os.path.exists(fn_path):
+        os.makedirs(fn_path)
+    return os.path.join(fn_path, '{0}.log'.format(name_))
+
+
+def file_handler(name_):
+    """
+    :param name_: name of the logger
+    :return: handler writing into the rotating log file of the logger
+    """
+    # debug=True makes a reference cycle: the replaced handlers would stay
+    # around (closed) until logging.shutdown() closes them again
+    rfh = ConcurrentRotatingFileHandler(filename=log_file(name_),
+                                        maxBytes=2097152,
+                                        backupCount=5,
+                                        mode='a',
+                                        encoding='UTF-8',
+                                        debug=False)  # 2MB file
+    rfh.setFormatter(logging.Formatter(fmt=LOG_FORMAT, datefmt=LOG_DATEFMT))
+    return rfh
+
+
 def setup_logging(file_, name_, level='WARN'):
     """
     Sets up generic logging to file with rotating files on disk
@@ -99,27 +142,163 @@ def setup_logging(file_, name_, level='WARN'):
 
     level = getattr(logging, level)
 
-    logfmt = '%(levelname)s\t%(process)d [%(asctime)s]:\t%(message)s'
-    datefmt = '%m/%d/%Y %H:%M:%S'
-    formatter = logging.Formatter(fmt=logfmt, datefmt=datefmt)
     logging_instance = logging.getLogger(name_)
-    fn_path = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')), 'logs')
-    if not os.path.exists(fn_path):
-        os.makedirs(fn_path)
-    fn = os.path.join(fn_path, '{0}.log'.format(name_))
-    rfh = ConcurrentRotatingFileHandler(filename=fn,
-                                        maxBytes=2097152,
-                                        backupCount=5,
-                                        mode='a',
-                                        encoding='UTF-8')  # 2MB file
-    rfh.setFormatter(formatter)
-    logging_instance.handlers = []
-    logging_instance.addHandler(rfh)
+    log_names.add(name_)
+    attach_handlers(logging_instance)
     logging_instance.setLevel(level)
 
     return logging_instance
 
 
+def attach_handlers(logging_instance):
+    """
+    Gives the logger the handler (and the filter) of the current logging
+    mode; the handlers of another mode are removed from the logger before
+    they are closed, so that logging.shutdown() does not close them again
+
+    :param logging_instance: logger made by setup_logging()
+    :return: no return
+    """
+    queue = log_settings['queue']
+    if queue is not None:
+        current = [x for x in logging_instance.handlers
+                   if isinstance(x, QueueHandler) and x.queue is queue]
+    else:
+        current = [x for x in logging_instance.handlers
+                   if isinstance(x, ConcurrentRotatingFileHandler)]
+    for old in list(logging_instance.handlers):
+        if old not in current:
+            logging_instance.removeHandler(old)
+            old.close()
+    if not current:
+        if queue is not None:
+            logging_instance.addHandler(QueueHandler(queue))
+        else:
+            logging_instance.addHandler(file_handler(logging_instance.name))
+    logging_instance.filters = [x for x in logging_instance.filters
+                                if not isinstance(x, SamplingFilter)]
+    if log_settings['sampling'] > 1:
+        logging_instance.addFilter(SamplingFilter(log_settings['sampling']))
+
+
+def configure_logging(mode='file', sampling=1, queue_size=10000):
+    """
+    Chooses how the loggers of setup_logging() write - including those that
+    exist already. In the 'file' mode every process writes (and rotates)
+    the log files itself, taking a file lock for every record. In the
+    'queue' mode the records go through a queue to a single writer thread
+    of this process; processes forked from now on use the same queue, so
+    their records no longer wait for each other.
+
+    :param mode: 'file' or 'queue'
+    :param sampling: write one of every <sampling> DEBUG records of each
+                     line of code (1 writes all of them)
+    :param queue_size: how many records may wait for the writer, the
+                       records that do not fit are dropped
+    :return: the LogWriter in the 'queue' mode, otherwise None
+    """
+    log_settings['sampling'] = sampling
+    if mode == 'queue' and log_settings['queue'] is None:
+        log_settings['queue'] = multiprocessing.Queue(queue_size)
+        log_settings['writer'] = LogWriter(log_settings['queue'])
+        log_settings['writer'].start()
+        atexit.register(log_settings['writer'].stop)
+    elif mode != 'queue':
+        log_settings['queue'] = None
+    for name_ in log_names:
+        attach_handlers(logging.getLogger(name_))
+    if mode != 'queue' and log_settings['writer'] is not None:
+        log_settings['writer'].stop()
+        log_settings['writer'] = None
+    return log_settings['writer']
+
+
+class QueueHandler(logging.Handler):
+    """
+    Hands the records to the LogWriter instead of writing them; it never
+    waits, when the queue is full the record is dropped (and counted)
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Formats the message (the arguments may not survive the trip to the
+        other process) and drops what cannot be pickled
+        """
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                                    record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+
+class LogWriter(threading.Thread):
+    """
+    The only writer of the log files: takes the records from the queue and
+    writes them into the file of their logger
+    """
+
+    def __init__(self, queue):
+        super(LogWriter, self).__init__(name='log-writer')
+        self.daemon = True
+        self.queue = queue
+        self.handlers = {}
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            if record.name not in self.handlers:
+                self.handlers[record.name] = file_handler(record.name)
+            self.handlers[record.name].handle(record)
+        while self.handlers:
+            self.handlers.popitem()[1].close()
+
+    def stop(self, timeout=5):
+        """
+        Writes what is in the queue and stops
+
+        :return: no return
+        """
+        if self.is_alive():
+            self.queue.put(None)
+            self.join(timeout)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through only one of every <rate> DEBUG records logged by the same
+    line of code (the first one included); other levels always pass
+    """
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.seen = defaultdict(int)
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        key = (record.pathname, record.lineno)
+        self.seen[key] += 1
+        return self.seen[key] % self.rate == 1 % self.rate
+
+
 def from_object(from_obj, to_obj):
     """Updates the values from the given object.  An object can be of one
     of the following two types:
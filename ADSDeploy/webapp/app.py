@@ -4,10 +4,14 @@ Application factory
 
 import logging.config
 import os
+from timeit import default_timer
 
-from flask import Flask
+from ADSDeploy import metrics
+from flask import Flask, request, g
 from flask.ext.restful import Api
-from views import GithubListener, RabbitMQListener
+from views import GithubListener, RabbitMQListener, MetricsView, \
+    rabbit_pool, ingest_buffer, deduplicator
+from .utils import DatabaseStore
 from .models import db
 
 
@@ -32,11 +36,52 @@ def create_app(name='ADSDeploy'):
     api = Api(app)
     api.add_resource(GithubListener, '/webhooks', methods=['POST'])
     api.add_resource(RabbitMQListener, '/rabbit', methods=['POST'])
+    api.add_resource(MetricsView, '/metrics', methods=['GET'])
     db.init_app(app)
 
+    # the gunicorn workers share METRICS_DIR; with preload_app this runs
+    # once, in the master, before the workers are forked
+    if app.config.get('METRICS_DIR'):
+        metrics.enable_multiprocess(app.config['METRICS_DIR'])
+    app.before_request(start_timer)
+    app.after_request(record_request)
+
+    rabbit_pool.size = app.config.get('RABBITMQ_POOL_SIZE', rabbit_pool.size)
+    ingest_buffer.size = app.config.get('INGEST_BUFFER_SIZE',
+                                        ingest_buffer.size)
+    ingest_buffer.batch_size = app.config.get('INGEST_BATCH_SIZE',
+                                              ingest_buffer.batch_size)
+    deduplicator.size = app.config.get('DEDUP_SIZE', deduplicator.size)
+    deduplicator.ttl = app.config.get('DEDUP_TTL', deduplicator.ttl)
+    if app.config.get('DEDUP_STORE') == 'database':
+        deduplicator.store = DatabaseStore()
+
     return app
 
 
+def start_timer():
+    """
+    Notes when the request started
+    """
+    g.request_started = default_timer()
+
+
+def record_request(response):
+    """
+    Counts the request (by endpoint and status) and observes its duration
+
+    :param response: flask.Response
+    :return: the same response
+    """
+    endpoint = request.endpoint or 'unknown'
+    metrics.REQUESTS.labels(endpoint, str(response.status_code)).inc()
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        metrics.REQUEST_TIME.labels(endpoint).observe(
+            default_timer() - started)
+    return response
+
+
 def load_config(app, basedir=os.path.dirname(__file__)):
     """
     Loads configuration in the following order:
@@ -1,4 +1,5 @@
 GITHUB_SIGNATURE_HEADER = 'X-Hub-Signature'
+GITHUB_DELIVERY_HEADER = 'X-GitHub-Delivery'
 GITHUB_SECRET = 'redacted'
 GITHUB_COMMIT_API = 'https://api.github.com/repos/adsabs/{repo}/git/commits/{hash}'
 GITHUB_TAG_FIND_API = 'https://api.github.com/repos/adsabs/{repo}/git/refs/tags/{tag}'
@@ -36,6 +37,29 @@ DEPLOY_LOGGING = {
 SQLALCHEMY_DATABASE_URI = 'sqlite://'
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# How many idle RabbitMQ connections each (gunicorn) worker keeps open
+RABBITMQ_POOL_SIZE = 4
+
+# 'sync' publishes to RabbitMQ before answering; 'buffered' puts the
+# message on an in-process buffer, answers 202 straight away (or 503 when
+# the buffer is full) and publishes in batches from a background thread
+INGEST_MODE = 'sync'
+INGEST_BUFFER_SIZE = 1000
+INGEST_BATCH_SIZE = 100
+
+# Redelivered webhooks (same delivery id, or same repository and commit)
+# are dropped if seen within DEDUP_TTL seconds. Each worker remembers up
+# to DEDUP_SIZE of them; with DEDUP_STORE = 'database' they are also
+# recorded in the database, so that all the workers see them
+DEDUP_SIZE = 10000
+DEDUP_TTL = 3600
+DEDUP_STORE = None
+
+# Directory where the gunicorn workers keep their metrics (served summed
+# up on /metrics); without it /metrics shows the worker that answered.
+# It must not be the METRICS_DIR of the pipeline, it is emptied at start
+METRICS_DIR = None
+
 EXCHANGE = 'test'
 ROUTE = 'test'
 
@@ -4,7 +4,7 @@ Database models
 
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Float
 from flask.ext.sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
@@ -32,3 +32,15 @@ class Packet(db.Model):
                     self.repository, self.deployed, self.tested,
                     self.application
                )
+
+
+class Delivery(db.Model):
+    """
+    A webhook delivery (or commit) that was already received; used to
+    drop redeliveries
+    """
+    key = Column(String, primary_key=True)
+    seen = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return '<Delivery (key: {}, seen: {})>'.format(self.key, self.seen)
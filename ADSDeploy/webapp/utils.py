@@ -3,8 +3,15 @@ Generic utilities
 """
 
 
+import threading
+import time
+from collections import OrderedDict
+
 from boto3.session import Session
 from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from .models import db, Delivery
 
 
 def get_boto_session():
@@ -18,3 +25,127 @@ def get_boto_session():
         aws_secret_access_key=current_app.config.get('AWS_SECRET_KEY'),
         region_name=current_app.config.get('AWS_REGION')
     )
+
+
+class DatabaseStore(object):
+    """
+    Dedup backing store in the webapp database, shared by all the
+    (gunicorn) workers; assumes an app context is active
+    """
+
+    def add(self, key, ttl):
+        """
+        Record the key
+
+        :param key: key to record
+        :param ttl: after how many seconds the key may be seen again
+        :return: False if the key was already recorded (and not expired)
+        """
+        now = time.time()
+        existing = Delivery.query.get(key)
+        if existing is not None:
+            if now - existing.seen < ttl:
+                return False
+            existing.seen = now
+            db.session.commit()
+            return True
+
+        try:
+            db.session.add(Delivery(key=key, seen=now))
+            db.session.commit()
+        except IntegrityError:
+            # another worker recorded it in the meantime
+            db.session.rollback()
+            return False
+        return True
+
+    def remove(self, key):
+        """
+        Forget the key
+
+        :param key: key to forget
+        """
+        Delivery.query.filter_by(key=key).delete()
+        db.session.commit()
+
+
+class Deduplicator(object):
+    """
+    Remembers recently seen keys in a bounded LRU with a time to live, and
+    optionally in a shared store so that other processes see them too
+    """
+
+    def __init__(self, size=10000, ttl=3600, store=None):
+        self.size = size
+        self.ttl = ttl
+        self.store = store
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, *keys):
+        """
+        Check the keys and record them
+
+        :param keys: keys identifying the message, e.g. its delivery id
+        :return: True if any of the keys was seen within the ttl
+        """
+        keys = [k for k in keys if k]
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                stamp = self.entries.get(key)
+                if stamp is not None and now - stamp < self.ttl:
+                    self.entries[key] = self.entries.pop(key)
+                    self.hits += 1
+                    return True
+
+            if self.store is not None:
+                for i, key in enumerate(keys):
+                    if not self.store.add(key, self.ttl):
+                        for k in keys[:i]:
+                            self.store.remove(k)
+                        self.remember(key, now)
+                        self.hits += 1
+                        return True
+
+            for key in keys:
+                self.remember(key, now)
+            self.misses += 1
+            return False
+
+    def remember(self, key, now):
+        """Put the key on top of the LRU, evicting the oldest ones"""
+        self.entries.pop(key, None)
+        self.entries[key] = now
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def forget(self, *keys):
+        """
+        Forget the keys, e.g. when the message could not be handled and
+        its redelivery should go through
+
+        :param keys: keys given to seen()
+        """
+        with self.lock:
+            for key in keys:
+                if key:
+                    self.entries.pop(key, None)
+                    if self.store is not None:
+                        self.store.remove(key)
+
+    def clear(self):
+        """Forget everything (only locally) and reset the counters"""
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        :return: dict with the hit and miss counters
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.entries)}
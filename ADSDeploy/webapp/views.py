@@ -5,13 +5,22 @@ Views
 import hashlib
 import hmac
 import json
+import logging
+import os
+import Queue
+import threading
+import time
+from contextlib import contextmanager
 
 import pika
 from ADSDeploy.config import RABBITMQ_URL
-from flask import current_app, request, abort
+from ADSDeploy.pipeline import memory
+from ADSDeploy import metrics
+from flask import current_app, request, abort, Response
 from flask.ext.restful import Resource
 
 from .exceptions import NoSignatureInfo, InvalidSignature
+from .utils import Deduplicator
 
 
 class MiniRabbit(object):
@@ -26,18 +35,62 @@ class MiniRabbit(object):
         self.channel = None
         self.url = url
         self.message = None
+        self.tx_channel = None
 
     def __enter__(self):
-        self.connection = pika.BlockingConnection(pika.URLParameters(self.url))
+        return self.open()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def open(self):
+        """
+        Open the connection and its channel
+
+        :return: MiniRabbit
+        """
+        if memory.is_memory(self.url):
+            self.connection = memory.MemoryConnection(self.url)
+        else:
+            self.connection = pika.BlockingConnection(pika.URLParameters(self.url))
         self.channel = self.connection.channel()
         self.channel.confirm_delivery()
         self.channel.basic_qos(prefetch_count=1)
 
         return self
 
-    def __exit__(self, type, value, traceback):
+    def close(self):
+        """
+        Close the connection
+        """
         self.connection.close()
 
+    @property
+    def is_open(self):
+        """
+        True if both the connection and the channel can be used
+
+        :return: bool
+        """
+        return self.connection is not None and self.connection.is_open \
+            and self.channel is not None and self.channel.is_open
+
+    def is_alive(self):
+        """
+        True if the connection is open and still works: an idle connection
+        does not notice that the broker dropped it (e.g. for missed
+        heartbeats) until it reads from the socket
+
+        :return: bool
+        """
+        if not self.is_open:
+            return False
+        try:
+            self.connection.process_data_events(0)
+        except Exception:
+            return False
+        return self.is_open
+
     def publish(self, payload, exchange, route):
         """
         Publish to a queue, on an exchange, with a specific route
@@ -53,6 +106,23 @@ class MiniRabbit(object):
         """
         self.channel.basic_publish(exchange, route, payload)
 
+    def publish_batch(self, messages):
+        """
+        Publish many messages and wait for the broker only once. As the
+        confirmed channel waits for every message, the batch goes through
+        a transactional channel and is committed at the end.
+
+        :param messages: (exchange, route, payload) tuples
+        :type messages: list
+        """
+        if self.tx_channel is None or not self.tx_channel.is_open:
+            self.tx_channel = self.connection.channel()
+            self.tx_channel.tx_select()
+
+        for exchange, route, payload in messages:
+            self.tx_channel.basic_publish(exchange, route, payload)
+        self.tx_channel.tx_commit()
+
     def message_count(self, queue):
         """
         Return the number of messages in the current queue
@@ -129,6 +199,269 @@ class MiniRabbit(object):
         )
 
 
+class RabbitPool(object):
+    """
+    Keeps open MiniRabbit connections between requests, so that a request
+    does not pay for the AMQP handshake. Connections are opened lazily and
+    belong to the process that opened them: after a fork (e.g. gunicorn
+    with preload_app) the inherited ones are forgotten, not closed, as the
+    socket is shared with the parent. An idle connection is checked before
+    it is re-used, and publish()/publish_batch() try once more on a new
+    connection if the one they got was dropped by the broker.
+    """
+
+    def __init__(self, url, size=4):
+        self.url = url
+        self.size = size
+        self.pid = os.getpid()
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def reset(self):
+        """
+        Forget all idle connections without closing them
+        """
+        with self.lock:
+            self.pid = os.getpid()
+            self.idle = []
+
+    def acquire(self):
+        """
+        Get an open connection, re-using an idle one if there is any
+
+        :return: MiniRabbit
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.idle = []
+            idle, self.idle = self.idle, []
+
+        # checked outside of the lock, it talks to the broker
+        while idle:
+            rabbit = idle.pop()
+            if rabbit.is_alive():
+                if idle:
+                    with self.lock:
+                        self.idle.extend(idle)
+                return rabbit
+            self.discard(rabbit)
+
+        rabbit = MiniRabbit(self.url)
+        rabbit.open()
+        return rabbit
+
+    def release(self, rabbit):
+        """
+        Give the connection back to the pool; it is closed if the pool
+        is full
+
+        :param rabbit: connection from acquire()
+        :type rabbit: MiniRabbit
+        """
+        with self.lock:
+            if self.pid == os.getpid() and len(self.idle) < self.size:
+                self.idle.append(rabbit)
+                return
+        self.discard(rabbit)
+
+    def discard(self, rabbit):
+        """
+        Close a connection that should not be used again
+
+        :param rabbit: connection from acquire()
+        :type rabbit: MiniRabbit
+        """
+        try:
+            rabbit.close()
+        except Exception:
+            pass
+
+    def publish(self, exchange, route, payload):
+        """
+        Publish through a pooled connection, see MiniRabbit.publish()
+        """
+        self.retry('publish', exchange=exchange, route=route, payload=payload)
+
+    def publish_batch(self, messages):
+        """
+        Publish many messages through a pooled connection, see
+        MiniRabbit.publish_batch()
+        """
+        self.retry('publish_batch', messages)
+
+    def retry(self, method, *args, **kwargs):
+        """
+        Call a method of a pooled connection; if the connection turns out
+        to be closed, it is dropped and the call is made once more on a
+        new one
+
+        :param method: name of the MiniRabbit method
+        :return: what the method returns
+        """
+        for attempt in (1, 2):
+            rabbit = self.acquire()
+            try:
+                result = getattr(rabbit, method)(*args, **kwargs)
+            except pika.exceptions.AMQPConnectionError, e:
+                self.discard(rabbit)
+                if attempt == 2:
+                    raise
+                current_logger().warning('Pooled RabbitMQ connection was '
+                                         'closed, reconnecting: {0}'.format(e))
+                continue
+            except Exception:
+                self.discard(rabbit)
+                raise
+            self.release(rabbit)
+            return result
+
+    @contextmanager
+    def __call__(self):
+        """
+        Use a pooled connection; a connection that failed is dropped, the
+        next request will open a new one
+
+        Use as:
+
+            with rabbit_pool() as w:
+                w.publish(...)
+        """
+        rabbit = self.acquire()
+        try:
+            yield rabbit
+        except Exception:
+            self.discard(rabbit)
+            raise
+        else:
+            self.release(rabbit)
+
+
+rabbit_pool = RabbitPool(RABBITMQ_URL)
+
+
+class IngestBuffer(object):
+    """
+    Bounded in-process buffer of messages waiting to be published, so that
+    the views can answer before RabbitMQ has the message. A background
+    thread (one per process, started lazily) publishes the buffered
+    messages in batches through the connection pool.
+    """
+
+    def __init__(self, size=1000, batch_size=100, interval=0.1):
+        self.size = size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pid = None
+        self.queue = None
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+        self.published = 0
+
+    def start(self):
+        """
+        Start the flusher of this process (a forked process gets a new
+        buffer and a new thread)
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.queue = Queue.Queue(maxsize=self.size)
+            self.running = True
+            self.thread = threading.Thread(target=self.flush_loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def put(self, exchange, route, payload):
+        """
+        Buffer a message
+
+        :param exchange: rabbitmq exchange
+        :param route: rabbitmq route
+        :param payload: serialized message
+        :return: False if the buffer is full (or being drained)
+        """
+        self.start()
+        if not self.running:
+            return False
+        try:
+            self.queue.put_nowait((exchange, route, payload))
+        except Queue.Full:
+            return False
+        return True
+
+    def next_batch(self):
+        """
+        Wait (up to the flush interval) for messages and take up to
+        batch_size of them
+
+        :return: list
+        """
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=self.interval))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return batch
+
+    def flush_loop(self):
+        """
+        Publishes the buffered messages until the buffer is stopped and
+        empty; a batch that could not be published is retried
+        """
+        batch = []
+        while self.running or batch or not self.queue.empty():
+            batch = batch or self.next_batch()
+            if not batch:
+                continue
+            try:
+                rabbit_pool.publish_batch(batch)
+                self.published += len(batch)
+                batch = []
+            except Exception, e:
+                current_logger().error('Failed to publish {0} buffered '
+                                       'messages: {1}'.format(len(batch), e))
+                time.sleep(self.interval)
+
+    def drain(self, timeout=30):
+        """
+        Stop accepting messages and wait until the buffer is published
+
+        :param timeout: how long to wait, in seconds
+        :return: number of messages left in the buffer
+        """
+        with self.lock:
+            thread = self.thread if self.pid == os.getpid() else None
+            self.running = False
+        if thread is None:
+            return 0
+        thread.join(timeout)
+        return self.queue.qsize()
+
+
+def current_logger():
+    """
+    The flask logger when there is an app context, module logger otherwise
+    """
+    try:
+        return current_app.logger
+    except RuntimeError:
+        return logging.getLogger(__name__)
+
+
+ingest_buffer = IngestBuffer()
+deduplicator = Deduplicator()
+
+
+# Answer given when the ingest buffer is full
+BUSY_RESPONSE = {'msg': 'too many requests, try again later'}, 503, \
+    {'Retry-After': '1'}
+
+
 class RabbitMQListener(Resource):
     """
     RabbitMQ Proxy
@@ -142,11 +475,30 @@ class RabbitMQListener(Resource):
 
         payload = request.get_json(force=True)
 
+        if current_app.config.get('INGEST_MODE') == 'buffered':
+            if not GithubListener.buffer_rabbitmq(payload):
+                return BUSY_RESPONSE
+            return {'msg': 'accepted'}, 202
+
         GithubListener.push_rabbitmq(payload)
 
         return {'msg': 'success'}, 200
 
 
+class MetricsView(Resource):
+    """
+    Metrics of the webapp in the Prometheus format
+    """
+
+    def get(self):
+        """
+        Answers the scrape of Prometheus; with METRICS_DIR set the numbers of
+        all the gunicorn workers are summed up
+        """
+        text, content_type = metrics.expose()
+        return Response(text, content_type=content_type)
+
+
 class GithubListener(Resource):
     """
     GitHub web hook logic and routes
@@ -199,12 +551,46 @@ class GithubListener(Resource):
         exchange = payload.pop('exchange')
         route = payload.pop('route')
 
-        with MiniRabbit(RABBITMQ_URL) as w:
-            w.publish(
-                exchange=exchange,
-                route=route,
-                payload=json.dumps(payload)
-            )
+        rabbit_pool.publish(
+            exchange=exchange,
+            route=route,
+            payload=json.dumps(payload)
+        )
+
+    @staticmethod
+    def buffer_rabbitmq(payload):
+        """
+        Puts the payload on the ingest buffer, it is published to RabbitMQ
+        in the background. See push_rabbitmq()
+        :param payload: GitHub webhook payload
+        :type payload: dict
+
+        :return: False if the buffer is full
+        """
+
+        exchange = payload.pop('exchange')
+        route = payload.pop('route')
+
+        return ingest_buffer.put(exchange, route, json.dumps(payload))
+
+    @staticmethod
+    def dedup_keys(request, payload):
+        """
+        Keys identifying a webhook: its delivery id and the commit (and tag)
+        it refers to
+        :param request: request containing the header and body
+        :param payload: parsed payload, see parse_github_payload()
+        :return: list of str (the delivery id may be None)
+        """
+
+        delivery = request.headers.get(
+            current_app.config.get('GITHUB_DELIVERY_HEADER', 'X-GitHub-Delivery')
+        )
+        return [
+            'delivery:{}'.format(delivery) if delivery else None,
+            'commit:{}:{}:{}'.format(payload['repository'], payload['commit'],
+                                     payload['tag'])
+        ]
 
     @staticmethod
     def parse_github_payload(request=None):
@@ -252,12 +638,31 @@ class GithubListener(Resource):
         except UnknownRepoError, e:
             return {"Unknown repo": "{}".format(e)}, 400
 
-        # Submit to RabbitMQ worker
-        GithubListener.push_rabbitmq(payload)
+        received = {'received': '{}@{}:{}'.format(payload['repository'],
+                                                  payload['commit'],
+                                                  payload['environment'])}
+
+        # GitHub redelivers webhooks; acknowledge the copies without
+        # touching the broker
+        keys = GithubListener.dedup_keys(request, payload)
+        if deduplicator.seen(*keys):
+            received['duplicate'] = True
+            return received
 
-        return {'received': '{}@{}:{}'.format(payload['repository'],
-                                              payload['commit'],
-                                              payload['environment'])}
+        try:
+            if current_app.config.get('INGEST_MODE') == 'buffered':
+                if not GithubListener.buffer_rabbitmq(payload):
+                    deduplicator.forget(*keys)
+                    return BUSY_RESPONSE
+                return received, 202
+
+            # Submit to RabbitMQ worker
+            GithubListener.push_rabbitmq(payload)
+        except:
+            deduplicator.forget(*keys)
+            raise
+
+        return received
 
 
 
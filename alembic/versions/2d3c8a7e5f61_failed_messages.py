@@ -0,0 +1,33 @@
+"""failed messages
+
+Revision ID: 2d3c8a7e5f61
+Revises: 4475ef3e98af
+Create Date: 2026-10-17 09:12:31.401226
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d3c8a7e5f61'
+down_revision = '4475ef3e98af'
+
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import Column, Integer, String, Text, TIMESTAMP
+                               
+
+
+def upgrade():
+    op.create_table('failed_messages',
+        Column('id', Integer, primary_key=True),
+        Column('worker', String(255)),
+        Column('queue', String(255)),
+        Column('payload', Text),
+        Column('exception', Text),
+        Column('created', TIMESTAMP),
+        Column('replayed', TIMESTAMP),
+    )
+
+
+def downgrade():
+    op.drop_table('failed_messages')
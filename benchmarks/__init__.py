@@ -0,0 +1,20 @@
+"""
+Benchmarks of the pipeline plumbing. They do not need a running RabbitMQ,
+the broker is replaced by simple stand-ins that simulate the network (or
+by the local transport); benchmarks.transports compares against a real
+broker when it is given one.
+
+Run them from the top level directory, e.g.:
+
+    python -m benchmarks.publish
+"""
+
+
+def percentile(values, p):
+    """
+    :param values: list of numbers
+    :param p: 0.0 - 1.0
+    :return: the value below which <p> of the values are
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
@@ -0,0 +1,174 @@
+"""
+Per-message overhead of the worker itself: RabbitMQWorker.on_message
+(decode, logging, process_payload, ack), publish() and forward(), driven
+with recorded method/header frames against a channel that does nothing.
+Reports messages per second and p50/p99 latency per payload size and
+saves the results as JSON; with --baseline the run is compared to an
+earlier one and fails when a case got slower than --tolerance.
+
+    python -m benchmarks.hotpath --output hotpath.json
+    python -m benchmarks.hotpath --baseline hotpath.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+from timeit import default_timer
+
+import pika
+
+from ADSDeploy.pipeline.generic import RabbitMQWorker
+from benchmarks import percentile
+
+
+class NullChannel(object):
+    """Channel that accepts everything and waits for nothing"""
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        return True
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        pass
+
+
+class RelayWorker(RabbitMQWorker):
+    """Publishes every message it receives, as most of the workers do"""
+
+    def process_payload(self, msg, **kwargs):
+        self.publish(msg)
+
+
+def make_worker():
+    worker = RelayWorker(params={'subscribe': 'bench.in',
+                                 'publish': 'bench.out',
+                                 'exchange': 'bench'})
+    worker.channel = NullChannel()
+    worker.fwd_channel = NullChannel()
+    worker.fwd_exchange = 'remote'
+    worker.fwd_topic = 'bench.remote'
+    return worker
+
+
+def make_payload(size):
+    """
+    :param size: approximate size of the serialized message in bytes
+    :return: dict that looks like a pipeline message
+    """
+    payload = {'repository': 'adsws', 'environment': 'staging',
+               'commit': 'f' * 40, 'author': 'someone', 'tags': [],
+               'files': []}
+    while len(json.dumps(payload)) < size:
+        payload['files'].append('adsws/api/{0:06d}/views.py'.format(
+                                    len(payload['files'])))
+    return payload
+
+
+def measure(call, count):
+    """
+    Calls <call> <count> times
+
+    :return: (messages per second, p50 seconds, p99 seconds)
+    """
+    timings = []
+    start = default_timer()
+    for i in range(count):
+        t = default_timer()
+        call(i)
+        timings.append(default_timer() - t)
+    elapsed = default_timer() - start
+    return count / elapsed, percentile(timings, 0.5), percentile(timings, 0.99)
+
+
+def run(count=5000, sizes=(100, 1024, 10240, 102400)):
+    """
+    Runs every case for every payload size
+
+    :return: list of result dicts
+    """
+    worker = make_worker()
+    header_frame = pika.BasicProperties(content_type='application/json',
+                                        delivery_mode=2)
+    results = []
+    for size in sizes:
+        payload = make_payload(size)
+        body = json.dumps(payload)
+        # recorded frames, as the broker would deliver them
+        method_frames = [pika.spec.Basic.Deliver('ctag1', i + 1, False,
+                                                 'bench', 'bench.in')
+                         for i in range(count)]
+        n = max(100, count * 1024 / max(size, 1024))
+        cases = (
+            ('on_message',
+             lambda i: worker.on_message(worker.channel, method_frames[i],
+                                         header_frame, body)),
+            ('publish', lambda i: worker.publish(payload)),
+            ('publish(str)', lambda i: worker.publish(body)),
+            ('forward', lambda i: worker.forward(payload)),
+        )
+        for name, call in cases:
+            call(0)  # warm up
+            rate, p50, p99 = measure(call, min(n, count))
+            results.append({'case': name, 'size': len(body),
+                            'count': min(n, count), 'msg_per_sec': rate,
+                            'p50_us': p50 * 1e6, 'p99_us': p99 * 1e6})
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of (case, size, change of msg/s) for the slower cases
+    """
+    before = dict(((x['case'], x['size']), x['msg_per_sec'])
+                  for x in baseline['results'])
+    slower = []
+    for x in results:
+        key = (x['case'], x['size'])
+        if key in before:
+            change = x['msg_per_sec'] / before[key] - 1
+            if change < -tolerance:
+                slower.append((x['case'], x['size'], change))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the worker hot path')
+    parser.add_argument('--count', type=int, default=5000,
+                        help='Messages per case (fewer for big payloads)')
+    parser.add_argument('--sizes', default='100,1024,10240,102400',
+                        help='Comma separated payload sizes in bytes')
+    parser.add_argument('--output', default=None,
+                        help='Save the results into this JSON file')
+    parser.add_argument('--baseline', default=None,
+                        help='JSON file of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed slowdown against the baseline (0.1 = 10%%)')
+    args = parser.parse_args()
+
+    results = run(args.count, [int(x) for x in args.sizes.split(',')])
+
+    print '{0:<14} {1:>8} {2:>12} {3:>10} {4:>10}'.format(
+        'case', 'bytes', 'msg/s', 'p50 us', 'p99 us')
+    for x in results:
+        print '{0:<14} {1:>8} {2:>12.0f} {3:>10.1f} {4:>10.1f}'.format(
+            x['case'], x['size'], x['msg_per_sec'], x['p50_us'], x['p99_us'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'timestamp': time.time(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for case, size, change in slower:
+            print 'SLOWER: {0} ({1} bytes) {2:+.1%}'.format(case, size, change)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
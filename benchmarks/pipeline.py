@@ -0,0 +1,181 @@
+"""
+End-to-end benchmark of the pipeline: a TaskMaster starts a chain of
+workers (as pstart.start_pipeline does) against the in-memory broker, the
+local transport or a real RabbitMQ; a timestamped stream of messages is
+injected at the head of the chain and collected at its end. Every stage
+stamps the message, so the latency is reported per stage as well as end
+to end. All the combinations of concurrency, payload size and prefetch
+are run and compared in one table. (The local transport has no
+prefetch, every worker takes what it can.)
+
+    python -m benchmarks.pipeline --stages 3 --concurrency 1,4 \
+        --sizes 100,10240 --prefetch 1,20 --url local://
+"""
+
+import argparse
+import itertools
+import time
+
+from ADSDeploy.pipeline import memory, pstart, transports
+from ADSDeploy.pipeline.generic import RabbitMQWorker
+from benchmarks import percentile
+
+
+MAX_STAGES = 8
+
+# workers started in this process (threads), closed after every run
+running = []
+
+
+class Stage(RabbitMQWorker):
+    """Stamps the message and passes it on to the next stage"""
+
+    def __init__(self, params=None):
+        super(Stage, self).__init__(params)
+        running.append(self)
+
+    def process_payload(self, msg, **kwargs):
+        msg['stamps'].append(time.time())
+        self.publish(msg)
+
+
+# the TaskMaster knows the workers by their class names (in this module,
+# which is __main__ when run with python -m)
+for _n in range(MAX_STAGES):
+    globals()['Stage{0}'.format(_n)] = type('Stage{0}'.format(_n), (Stage,), {})
+
+
+def make_workers(stages, concurrency, prefetch):
+    """
+    :return: WORKERS config of the chain bench.0 -> ... -> bench.<stages>
+    """
+    workers = {}
+    for n in range(stages):
+        workers['{0}.Stage{1}'.format(__name__, n)] = {
+            'subscribe': 'bench.{0}'.format(n),
+            'publish': 'bench.{0}'.format(n + 1),
+            'concurrency': concurrency,
+            'prefetch': prefetch,
+            'reconnect': False,
+        }
+    return workers
+
+
+def stop(task_master):
+    """Stops the workers of the TaskMaster and forgets the queues"""
+    for params in task_master.workers.values():
+        for active in params.get('active', []):
+            if hasattr(active['proc'], 'terminate'):
+                active['proc'].terminate()
+    while running:
+        worker = running.pop()
+        if worker.connection is not None:
+            worker.connection.close()
+    for params in task_master.workers.values():
+        for active in params.get('active', []):
+            active['proc'].join(5)
+    memory.reset()
+    transports.reset()
+
+
+def run(url, stages=3, concurrency=1, size=100, prefetch=1, count=2000,
+        rate=0, timeout=60):
+    """
+    Starts the chain, injects <count> messages (at <rate> per second, 0 is
+    as fast as possible) and waits for them at the end of the chain
+
+    :return: dict with the throughput and the latency percentiles
+    """
+    task_master = pstart.TaskMaster(url, 'bench', {},
+                                    make_workers(stages, concurrency, prefetch))
+    task_master.initialize_rabbitmq()
+    task_master.start_workers(verbose=False)
+
+    sink = RabbitMQWorker(params={'subscribe': 'bench.{0}'.format(stages),
+                                  'publish': 'bench.0', 'exchange': 'bench',
+                                  'prefetch': 100, 'TEST_RUN': True})
+    sink.connect(url)
+    if not (memory.is_memory(url) or transports.is_local(url)):
+        for n in range(stages + 1):
+            sink.channel.queue_purge(queue='bench.{0}'.format(n))
+
+    received = []
+    sink.process_payload = lambda msg, **kwargs: received.append(
+                                msg['stamps'] + [time.time()])
+    sink.subscribe(sink.on_message)
+
+    try:
+        padding = 'x' * size
+        start = time.time()
+        for i in range(count):
+            if rate:
+                wait = start + i / float(rate) - time.time()
+                if wait > 0:
+                    sink.connection.process_data_events(time_limit=wait)
+            sink.publish({'stamps': [time.time()], 'n': i, 'padding': padding})
+        deadline = time.time() + timeout
+        while len(received) < count and time.time() < deadline:
+            sink.connection.process_data_events(time_limit=0.05)
+        elapsed = max(x[-1] for x in received) - start if received else 0
+    finally:
+        sink.connection.close()
+        stop(task_master)
+
+    result = {'stages': stages, 'concurrency': concurrency, 'size': size,
+              'prefetch': prefetch, 'received': len(received),
+              'msg_per_sec': len(received) / elapsed if elapsed else 0}
+    if received:
+        latency = [x[-1] - x[0] for x in received]
+        result['p50_ms'] = percentile(latency, 0.5) * 1000
+        result['p99_ms'] = percentile(latency, 0.99) * 1000
+        result['stage_p50_ms'] = [
+            percentile([x[n + 1] - x[n] for x in received], 0.5) * 1000
+            for n in range(stages + 1)]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the whole pipeline')
+    parser.add_argument('--url', default=memory.MEMORY_URL,
+                        help='memory:// (default), local:// or a RabbitMQ url')
+    parser.add_argument('--stages', type=int, default=3,
+                        help='Number of workers in the chain (at most {0})'
+                             .format(MAX_STAGES))
+    parser.add_argument('--concurrency', default='1',
+                        help='Comma separated numbers of workers per stage')
+    parser.add_argument('--sizes', default='100,10240',
+                        help='Comma separated payload sizes in bytes')
+    parser.add_argument('--prefetch', default='1,20',
+                        help='Comma separated prefetch counts')
+    parser.add_argument('--count', type=int, default=2000,
+                        help='Number of messages per configuration')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='Messages per second to inject (0 = unlimited)')
+    args = parser.parse_args()
+
+    configurations = itertools.product(
+        [int(x) for x in args.concurrency.split(',')],
+        [int(x) for x in args.sizes.split(',')],
+        [int(x) for x in args.prefetch.split(',')])
+
+    print '{0:>5} {1:>8} {2:>9} {3:>10} {4:>9} {5:>9}  {6}'.format(
+        'conc', 'bytes', 'prefetch', 'msg/s', 'p50 ms', 'p99 ms',
+        'p50 ms per stage (last = sink)')
+    for concurrency, size, prefetch in configurations:
+        r = run(args.url, args.stages, concurrency, size, prefetch,
+                args.count, args.rate)
+        if not r['received']:
+            print '{0:>5} {1:>8} {2:>9} {3:>10}'.format(
+                concurrency, size, prefetch, 'timed out')
+            continue
+        print '{0:>5} {1:>8} {2:>9} {3:>10.0f} {4:>9.2f} {5:>9.2f}  {6}'.format(
+            concurrency, size, prefetch, r['msg_per_sec'], r['p50_ms'],
+            r['p99_ms'], ' '.join('{0:.2f}'.format(x)
+                                  for x in r['stage_p50_ms']))
+        if r['received'] < args.count:
+            print '      (only {0} of {1} messages arrived)'.format(
+                r['received'], args.count)
+
+
+if __name__ == '__main__':
+    main()
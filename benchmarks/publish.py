@@ -0,0 +1,99 @@
+"""
+Compares the one-at-a-time RabbitMQWorker.publish() against the windowed
+RabbitMQWorker.publish_batch() when delivery is confirmed. The broker is
+simulated by a channel that sleeps for one round trip every time the client
+has to wait for it (a confirm or a tx_commit).
+"""
+
+import argparse
+import time
+
+from ADSDeploy.pipeline.generic import RabbitMQWorker
+
+
+class SlowChannel(object):
+    """
+    Channel that costs one round trip per confirmed publish (in confirm
+    mode) or per tx_commit (in tx mode)
+    """
+
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.confirm = True
+        self.published = 0
+
+    def tx_select(self):
+        self.confirm = False
+        time.sleep(self.rtt)
+
+    def tx_commit(self):
+        time.sleep(self.rtt)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published += 1
+        if self.confirm:
+            time.sleep(self.rtt)
+        return True
+
+
+class SlowConnection(object):
+
+    def __init__(self, rtt):
+        self.rtt = rtt
+
+    def channel(self):
+        return SlowChannel(self.rtt)
+
+
+def make_worker(rtt):
+    worker = RabbitMQWorker(params={'publish': 'bench', 'exchange': 'bench'})
+    worker.connection = SlowConnection(rtt)
+    worker.channel = worker.connection.channel()
+    worker.confirm_delivery = True
+    return worker
+
+
+def run(count=2000, rtt=0.0005, windows=(10, 100, 1000)):
+    """
+    Publishes <count> messages with every strategy
+
+    :return: list of (name, seconds, messages per second)
+    """
+    messages = [{'commit': '{0:040d}'.format(i), 'repository': 'adsws'}
+                for i in range(count)]
+    results = []
+
+    worker = make_worker(rtt)
+    start = time.time()
+    for msg in messages:
+        worker.publish(msg)
+    elapsed = time.time() - start
+    results.append(('publish', elapsed, count / elapsed))
+
+    for window in windows:
+        worker = make_worker(rtt)
+        start = time.time()
+        failures = worker.publish_batch(messages, window=window)
+        elapsed = time.time() - start
+        assert not failures
+        results.append(('publish_batch(window={0})'.format(window),
+                        elapsed, count / elapsed))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark batched publishing')
+    parser.add_argument('--count', type=int, default=2000,
+                        help='Number of messages to publish')
+    parser.add_argument('--rtt', type=float, default=0.0005,
+                        help='Simulated broker round trip in seconds')
+    args = parser.parse_args()
+
+    print '{0:<30} {1:>10} {2:>12}'.format('strategy', 'seconds', 'msg/s')
+    for name, elapsed, rate in run(args.count, args.rtt):
+        print '{0:<30} {1:>10.3f} {2:>12.0f}'.format(name, elapsed, rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Measures how fast messages can be written into the disk spool (for a few
+fsync batch sizes) and how fast the spool is drained.
+"""
+
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+from ADSDeploy.pipeline.spool import Spool
+
+
+def run(count=20000, size=1024, fsync=(1, 10, 100, 1000)):
+    """
+    Spools and drains <count> messages of <size> bytes
+
+    :return: list of (name, seconds, messages per second)
+    """
+    body = json.dumps({'payload': 'x' * size})
+    results = []
+
+    for fsync_every in fsync:
+        directory = tempfile.mkdtemp()
+        try:
+            spool = Spool(directory, fsync_every=fsync_every)
+            n = count if fsync_every > 1 else min(count, 2000)
+            start = time.time()
+            for i in range(n):
+                spool.append('bench', 'bench', body)
+            spool.flush()
+            elapsed = time.time() - start
+            results.append(('append(fsync_every={0})'.format(fsync_every),
+                            elapsed, n / elapsed))
+
+            start = time.time()
+            drained = spool.drain(lambda *args: None)
+            elapsed = time.time() - start
+            assert drained == n
+            results.append(('drain', elapsed, n / elapsed))
+            spool.close()
+        finally:
+            shutil.rmtree(directory)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the disk spool')
+    parser.add_argument('--count', type=int, default=20000,
+                        help='Number of messages to spool')
+    parser.add_argument('--size', type=int, default=1024,
+                        help='Size of a message in bytes')
+    args = parser.parse_args()
+
+    print '{0:<30} {1:>10} {2:>12}'.format('operation', 'seconds', 'msg/s')
+    for name, elapsed, rate in run(args.count, args.size):
+        print '{0:<30} {1:>10.3f} {2:>12.0f}'.format(name, elapsed, rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+How long the TaskMaster takes to get its worker processes going: the cold
+start of all of them, and the respawn of one that died. The workers are
+forked from the master, which has the modules imported and the config
+loaded; for comparison the same is measured for processes that start from
+scratch (a new interpreter importing the pipeline and loading the config,
+as every worker would without the prefork).
+
+    python -m benchmarks.startup --workers 8 --repeat 5
+"""
+
+import argparse
+import os
+import select
+import subprocess
+import sys
+import time
+
+from ADSDeploy import app
+from ADSDeploy.pipeline import pstart
+from ADSDeploy.pipeline.generic import RabbitMQWorker
+from benchmarks import percentile
+
+
+# the workers write a line into the pipe when they are up (a write this
+# small is atomic, a worker killed in the middle cannot block the others as
+# it could with the lock of a multiprocessing.Queue)
+ready, up = os.pipe()
+
+# what a worker process starting from scratch has to do before it works
+SCRATCH = ('from ADSDeploy import app; '
+           'from ADSDeploy.pipeline import pstart; '
+           'app.init_app(); '
+           'pstart.get_worker_class("example.ExampleWorker")')
+
+
+@pstart.register('bench.ReadyWorker')
+class ReadyWorker(RabbitMQWorker):
+    """Reports that it is up instead of connecting"""
+
+    def run(self):
+        os.write(up, '{0!r}\n'.format(time.time()))
+        time.sleep(3600)
+
+
+def wait_ready(count, timeout=30):
+    """
+    :return: time when the last of <count> workers reported
+    """
+    data = ''
+    deadline = time.time() + timeout
+    while data.count('\n') < count:
+        if not select.select([ready], [], [], deadline - time.time())[0]:
+            raise RuntimeError('the workers did not start in time')
+        data += os.read(ready, 4096)
+    return max(float(x) for x in data.split())
+
+
+def cold_start(workers):
+    """
+    :return: (seconds to start all the workers, TaskMaster)
+    """
+    task_master = pstart.TaskMaster('amqp://localhost', 'bench', {}, {
+        'bench.ReadyWorker': {'concurrency': workers, 'subscribe': 'bench'}})
+    start = time.time()
+    task_master.start_workers(verbose=False)
+    return wait_ready(workers) - start, task_master
+
+
+def respawn(task_master):
+    """
+    Kills one worker and lets the TaskMaster replace it
+
+    :return: seconds until the new one is up
+    """
+    proc = task_master.workers['bench.ReadyWorker']['active'][0]['proc']
+    proc.terminate()
+    proc.join()
+    start = time.time()
+    task_master.reap_workers()
+    task_master.start_workers(verbose=False)
+    return wait_ready(1) - start
+
+
+def stop(task_master):
+    for active in task_master.workers['bench.ReadyWorker']['active']:
+        active['proc'].terminate()
+        active['proc'].join()
+
+
+def from_scratch(workers):
+    """
+    :return: seconds to start <workers> new interpreters that import the
+             pipeline and load the config
+    """
+    start = time.time()
+    procs = [subprocess.Popen([sys.executable, '-c', SCRATCH])
+             for i in range(workers)]
+    for proc in procs:
+        proc.wait()
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark starting workers')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of worker processes')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of measurements')
+    args = parser.parse_args()
+
+    app.init_app()
+    results = {'cold start (prefork)': [], 'respawn (prefork)': [],
+               'cold start (scratch)': []}
+    for i in range(args.repeat):
+        elapsed, task_master = cold_start(args.workers)
+        results['cold start (prefork)'].append(elapsed)
+        try:
+            results['respawn (prefork)'].append(respawn(task_master))
+        finally:
+            stop(task_master)
+        results['cold start (scratch)'].append(from_scratch(args.workers))
+
+    print '{0:<22} {1:>10} {2:>10}'.format('', 'p50 ms', 'max ms')
+    for name in sorted(results):
+        print '{0:<22} {1:>10.1f} {2:>10.1f}'.format(
+            name, percentile(results[name], 0.5) * 1000,
+            max(results[name]) * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,3 +18,16 @@ errorlog = '{}/{}.error.log'.format(LOG_DIR, APP_NAME)
 accesslog = '{}/{}.access.log'.format(LOG_DIR, APP_NAME)
 pidfile = '{}/{}.pid'.format(LOG_DIR, APP_NAME)
 loglevel="info"
+
+
+def worker_exit(server, worker):
+  # publish whatever is left in the ingest buffer before the worker dies
+  from ADSDeploy.webapp.views import ingest_buffer
+  ingest_buffer.drain()
+
+
+def child_exit(server, worker):
+  # the numbers of a dead worker stay in METRICS_DIR, its gauges must go
+  from prometheus_client import multiprocess
+  if 'prometheus_multiproc_dir' in os.environ:
+    multiprocess.mark_process_dead(worker.pid)
@@ -12,6 +12,7 @@ __email__ = 'ads@cfa.harvard.edu'
 __status__ = 'Production'
 __license__ = 'MIT'
 
+import os
 import sys
 import time
 import pika
@@ -19,7 +20,9 @@ import argparse
 import json
 from ADSDeploy import app
 from ADSDeploy.pipeline.example import ExampleWorker
+from ADSDeploy.pipeline import errors
 from ADSDeploy.pipeline import generic
+from ADSDeploy.pipeline import profiling
 from ADSDeploy.pipeline import pstart
 from ADSDeploy.utils import setup_logging
 
@@ -73,6 +76,64 @@ def run_example(claims_file, queue='example', **kwargs):
     logger.info('Done processing {0} claims.'.format(i))
 
 
+def replay_errors(worker=None, ids=None, limit=1000, rate=100):
+    """
+    Sends stored failures back to the queues they came from
+
+    :param worker: only replay failures of this worker class
+    :param ids: only replay failures with these ids
+    :param limit: replay at most this many failures
+    :param rate: messages per second
+    :return: no return
+    """
+
+    logger.info('Replaying failures (worker: {0}, ids: {1}, limit: {2}, '
+                'rate: {3}/s)'.format(worker, ids, limit, rate))
+    replayed, failed = errors.replay(worker=worker, ids=ids, limit=limit,
+                                     rate=rate)
+    logger.info('Replayed {0} failures, {1} could not be published.'.format(
+                replayed, failed))
+
+
+def profile_workers(output=None, top=20):
+    """
+    Profiles the running pipeline: signals the TaskMaster (which passes the
+    signal on to the workers), waits for the profiles and merges them
+
+    :param output: where to save the merged profile (collapsed stacks,
+                   e.g. for flamegraph.pl)
+    :param top: number of functions to print
+    :return: no return
+    """
+
+    with open(app.config.get('PIDFILE') or profiling.PIDFILE) as f:
+        pid = int(f.read().strip())
+    directory = app.config.get('PROFILE_DIR') or profiling.PROFILE_DIR
+    seconds = app.config.get('PROFILE_SECONDS', profiling.settings['seconds'])
+
+    started = time.time()
+    os.kill(pid, profiling.PROFILE_SIGNAL)
+    logger.info('Profiling the pipeline (pid {0}) for {1}s'.format(pid,
+                                                                  seconds))
+    time.sleep(seconds + 2)
+
+    paths = profiling.collect(directory, since=started)
+    if not paths:
+        logger.error('No profiles found in {0}'.format(directory))
+        return
+    counts = profiling.merge(paths)
+    output = output or os.path.join(directory, 'merged.{0}.txt'.format(
+                                        int(started)))
+    profiling.write_collapsed(counts, output)
+    logger.info('Merged {0} profiles into {1}'.format(len(paths), output))
+
+    samples = float(sum(counts.values()))
+    print '{0:>7} {1:>7}  {2}'.format('self %', 'total %', 'function')
+    for function, own, total in profiling.summary(counts, top):
+        print '{0:>7.1f} {1:>7.1f}  {2}'.format(100 * own / samples,
+                                               100 * total / samples, function)
+
+
 def start_pipeline():
     """Starts the workers and let them do their job"""
     pstart.start_pipeline({}, app)
@@ -103,7 +164,54 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Start the pipeline')
     
+    parser.add_argument('-r',
+                        '--replay_errors',
+                        dest='replay_errors',
+                        action='store_true',
+                        help='Replay failed messages to their source queues')
+
+    parser.add_argument('--worker',
+                        dest='worker',
+                        action='store',
+                        type=str,
+                        help='Replay only failures of this worker class')
+
+    parser.add_argument('--ids',
+                        dest='ids',
+                        action='store',
+                        type=int,
+                        nargs='+',
+                        help='Replay only failures with these ids')
+
+    parser.add_argument('--limit',
+                        dest='limit',
+                        action='store',
+                        type=int,
+                        default=1000,
+                        help='Replay at most this many failures')
+
+    parser.add_argument('--rate',
+                        dest='rate',
+                        action='store',
+                        type=float,
+                        default=100,
+                        help='Messages per second to replay')
+
+    parser.add_argument('--profile',
+                        dest='profile',
+                        action='store_true',
+                        help='Profile the running workers and merge their '
+                             'profiles')
+
+    parser.add_argument('--profile_output',
+                        dest='profile_output',
+                        action='store',
+                        type=str,
+                        help='Save the merged profile into this file')
+
+    parser.set_defaults(profile=False)
     parser.set_defaults(purge_queues=False)
+    parser.set_defaults(replay_errors=False)
     parser.set_defaults(start_pipeline=False)
     args = parser.parse_args()
     
@@ -118,11 +226,20 @@ if __name__ == '__main__':
         start_pipeline()
         work_done = True
         
-    if args.import_claims:
+    if args.run_example:
         # Send the files to be put on the queue
-        run_example(args.import_claims)
+        run_example(args.run_example)
+        work_done = True
+
+    if args.replay_errors:
+        replay_errors(worker=args.worker, ids=args.ids, limit=args.limit,
+                      rate=args.rate)
         work_done = True
         
+    if args.profile:
+        profile_workers(output=args.profile_output)
+        work_done = True
+
     if not work_done:
         parser.print_help()
         sys.exit(0)
\ No newline at end of file